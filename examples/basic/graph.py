@@ -21,8 +21,13 @@
 # a number of processes, simulating the well-known Dining Philosophers
 # problem. We count the number of steps to reach deadlock.
 #
+# The deadlock is detected as soon as a request closes a cycle, by
+# maintaining a topological order of the graph incrementally.
+#
 
 from modeling import *
+from modeling.mf import swap
+from modeling.indexes import DynamicTopologicalOrder
 from enum import Enum
 import random
 
@@ -64,7 +69,7 @@ class Resource(Vertex):
 	# Current resource owner process
 	def owner(self):
 		if self.outgoing:
-			return list(self.outgoing)[0].destination
+			return self.outgoing.any().destination
 		else:
 			return None
 
@@ -101,7 +106,7 @@ class Process(Vertex):
 
 	def release_all(self):
 		# release all resources
-		for req in list(self.incoming):
+		for req in self.incoming:
 			req.release()
 
 	def run(self):
@@ -135,7 +140,7 @@ class Request(Edge):
 		print("Grant", self.proc, "->", self.resource)
 
 		# flip edge to grant resource
-		self.source, self.destination = self.destination, self.source
+		swap(self, 'source', 'destination')
 
 	def __str__(self):
 		return "%s->%s" % (self.proc, self.resource)
@@ -156,6 +161,8 @@ class Executor:
 
 	def __init__(self):
 		self.cycle = 0
+		# a cycle of the process-resource graph is a deadlock
+		self.deadlocks = DynamicTopologicalOrder((Vertex.outgoing, Edge.destination))
 
 	def run(self):
 
@@ -179,6 +186,9 @@ class Executor:
 			step.run()
 			self.cycle+=1
 
+			if self.deadlocks.has_cycle():
+				break
+
 
 #
 # Model of the Dining Philisophers.
@@ -256,3 +266,6 @@ if __name__=='__main__':
 	for p in e.processes:
 		print("Phil.",p.i, "holds forks", [f.source.i for f in p.incoming])
 
+	for cycle in e.deadlocks.cycles():
+		print("Deadlock:", " -> ".join(str(v) for v in cycle if isinstance(v, Vertex)))
+
@@ -1,5 +1,5 @@
 
-from .mf import model, attr, ref, refs, ref_list, \
+from .mf import model, attr, ref, refs, ref_list, edge_refs, parent_ref, \
     annotation_class, Annotatable, annotations_of, \
-    validate_classes, CORE_CLASSES
+    validate_classes, validate_objects, CORE_CLASSES
 
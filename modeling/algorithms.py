@@ -0,0 +1,289 @@
+'''
+Graph algorithms over relationships.
+
+The graph of a relationship (or of a relationship path, as in
+:py:func:`~modeling.instrument.transitive_closure`) has an edge from each
+object to each object reached by one repetition of the path. The
+algorithms of this module work on the graph over the objects reachable
+from a sequence of objects, reading the relationships directly instead
+of copying the graph. None of them is recursive, so that long paths do
+not exhaust the stack.
+
+The analytics (:py:func:`pagerank`, :py:func:`degree_centrality` and
+:py:func:`core_numbers`) build the adjacency arrays of the graph once,
+by :py:func:`~modeling.csr.to_csr`, and iterate over them with NumPy,
+which is imported only when they are called. They return a dict mapping
+each object to its value and, if ``attr`` is given, also assign the
+values to that attribute of the objects.
+
+@author: vsam
+'''
+from .instrument import compile_path, _path_descriptors, _node_successors, \
+    _strong_components
+from .csr import to_csr, csr_neighbours
+
+
+def _components(objects, nupath):
+    successors = _node_successors(_path_descriptors(nupath))
+    comp, members = _strong_components([(x, 0) for x in objects], successors)
+    return successors, comp, members
+
+
+def _repetition(successors, node):
+    # the nodes at step 0, reached from node by one repetition of the path
+    nodes = successors(node)
+    while nodes and nodes[0][1] != 0:
+        nodes = [z for y in nodes for z in successors(y)]
+    return nodes
+
+
+def strongly_connected_components(objects, nupath):
+    """Return the strongly connected components of the graph of the
+    relationship path ``nupath``, over the objects reachable from
+    ``objects``, as a list of lists of objects.
+
+    The components are in topological order: every edge between two
+    components leads to a later one.
+    """
+    successors, comp, members = _components(objects, nupath)
+    result = []
+    for group in reversed(members):
+        group = [x for x, i in reversed(group) if i == 0]
+        if group:
+            result.append(group)
+    return result
+
+
+def topological_sort(objects, nupath):
+    """Return the objects reachable from ``objects`` in an order where
+    every edge of the graph of the relationship path ``nupath`` leads to
+    a later object.
+
+    Raise ValueError if the graph has a cycle.
+    """
+    successors, comp, members = _components(objects, nupath)
+    result = []
+    for group in reversed(members):
+        node = group[0]
+        if len(group) > 1 or node in successors(node):
+            cycle = [x for x, i in group if i == 0]
+            raise ValueError("the graph has a cycle through {0!r}".format(cycle))
+        if node[1] == 0:
+            result.append(node[0])
+    return result
+
+
+def weakly_connected_components(objects, nupath):
+    """Return the weakly connected components of the graph of the
+    relationship path ``nupath``, over the objects reachable from
+    ``objects``, as a list of lists of objects, in the order they are
+    reached.
+
+    The components are found by union-find over the links, so the
+    relationships need not have inverse endpoints.
+    """
+    successors = _node_successors(_path_descriptors(nupath))
+    parent = {}
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = x = parent[parent[x]]
+        return x
+
+    order = []
+    for s in objects:
+        root = (s, 0)
+        if root in parent:
+            continue
+        parent[root] = root
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node[1] == 0:
+                order.append(node[0])
+            for y in successors(node):
+                if y not in parent:
+                    parent[y] = find(node)
+                    stack.append(y)
+                else:
+                    a, b = find(node), find(y)
+                    if a != b:
+                        parent[b] = a
+
+    groups = {}
+    for x in order:
+        groups.setdefault(find((x, 0)), []).append(x)
+    return list(groups.values())
+
+
+def condensation(objects, nupath):
+    """Return the condensation of the graph of the relationship path
+    ``nupath``, over the objects reachable from ``objects``: the acyclic
+    graph with a vertex for each strongly connected component.
+
+    The result is a pair ``(components, links)``, where ``components`` is
+    as returned by :py:func:`strongly_connected_components`, and
+    ``links[i]`` is the sorted list of the indices of the components
+    linked from component ``i`` (all greater than ``i``).
+    """
+    successors, comp, members = _components(objects, nupath)
+    number = {}
+    components = []
+    for c in range(len(members)-1, -1, -1):
+        group = [x for x, i in reversed(members[c]) if i == 0]
+        if group:
+            number[c] = len(components)
+            components.append(group)
+
+    links = []
+    for n, group in enumerate(components):
+        targets = set()
+        for x in group:
+            for y in _repetition(successors, (x, 0)):
+                targets.add(number[comp[y]])
+        targets.discard(n)
+        links.append(sorted(targets))
+    return components, links
+
+
+#
+#  Analytics
+#
+
+
+def _arrays(objects, nupath):
+    # the CSR arrays of the graph over the objects reachable from objects
+    descs = _path_descriptors(nupath)
+    return to_csr(descs, list(compile_path(descs)(objects)))
+
+
+def _results(id_map, values, attr):
+    result = dict(zip(id_map, values.tolist()))
+    if attr is not None:
+        for obj, value in result.items():
+            setattr(obj, attr, value)
+    return result
+
+
+def pagerank(objects, nupath, alpha=0.85, personalization=None, tol=1.0e-8,
+             max_iter=100, attr=None):
+    """Return the PageRank of the objects reachable from ``objects`` (and
+    from the keys of ``personalization``), in the graph of the
+    relationship path ``nupath``.
+
+    ``alpha`` is the damping factor. ``personalization`` maps objects to
+    the (relative) probabilities of the random jumps, which are uniform by
+    default; objects without outgoing links jump the same way. Parallel
+    links count separately.
+
+    The ranks are computed by power iteration, until the sum of their
+    changes is less than ``n*tol``, where ``n`` is the number of objects.
+    Raise RuntimeError if this takes more than ``max_iter`` iterations.
+    """
+    import numpy as np
+
+    seeds = list(objects)
+    if personalization is not None:
+        seeds.extend(personalization)
+    id_map, indptr, indices = _arrays(seeds, nupath)
+    n = len(id_map)
+    if n == 0:
+        return {}
+
+    if personalization is None:
+        p = np.full(n, 1.0/n)
+    else:
+        ids = {obj: i for i, obj in enumerate(id_map)}
+        p = np.zeros(n)
+        for obj, weight in personalization.items():
+            p[ids[obj]] += weight
+        if p.sum() <= 0:
+            raise ValueError("personalization must have a positive sum")
+        p /= p.sum()
+
+    outdeg = np.diff(indptr)
+    source = np.repeat(np.arange(n), outdeg)
+    dangling = outdeg == 0
+    scale = np.zeros(n)
+    scale[~dangling] = 1.0 / outdeg[~dangling]
+
+    x = p.copy()
+    for it in range(max_iter):
+        flow = (x * scale)[source]
+        new = alpha * np.bincount(indices, weights=flow, minlength=n)
+        new += (alpha * x[dangling].sum() + 1.0 - alpha) * p
+        err = np.abs(new - x).sum()
+        x = new
+        if err < n * tol:
+            return _results(id_map, x, attr)
+    raise RuntimeError("pagerank did not converge in {0} iterations".format(max_iter))
+
+
+def personalized_pagerank(sources, nupath, **kwargs):
+    """Return the PageRank of the objects reachable from ``sources``, with
+    random jumps to ``sources`` only (see :py:func:`pagerank`)."""
+    sources = list(sources)
+    return pagerank(sources, nupath, personalization=dict.fromkeys(sources, 1.0), **kwargs)
+
+
+def degree_centrality(objects, nupath, incoming=False, attr=None):
+    """Return the out-degree (or in-degree, if ``incoming`` is True)
+    centrality of the objects reachable from ``objects``, in the graph of
+    the relationship path ``nupath``: the number of links of each object
+    over the number of other objects."""
+    import numpy as np
+
+    id_map, indptr, indices = _arrays(objects, nupath)
+    n = len(id_map)
+    if incoming:
+        degree = np.bincount(indices, minlength=n)
+    else:
+        degree = np.diff(indptr)
+    return _results(id_map, degree / max(n-1, 1), attr)
+
+
+def core_numbers(objects, nupath, attr=None):
+    """Return the core number of the objects reachable from ``objects``,
+    in the graph of the relationship path ``nupath``, ignoring the
+    direction of the links. The core number of an object is the largest
+    ``k`` such that the object belongs to the k-core: the largest subgraph
+    where every object has at least ``k`` links (counted with repetitions).
+
+    The graph is peeled in rounds: for each ``k``, all the remaining objects
+    with at most ``k`` links are removed at once, and the links of their
+    neighbours are recounted.
+    """
+    import numpy as np
+
+    id_map, indptr, indices = _arrays(objects, nupath)
+    n = len(id_map)
+    # the reverse links
+    counts = np.bincount(indices, minlength=n)
+    rindptr = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(counts, out=rindptr[1:])
+    source = np.repeat(np.arange(n), np.diff(indptr))
+    rindices = source[np.argsort(indices, kind='stable')]
+
+    degree = np.diff(indptr) + counts
+    core = np.zeros(n, dtype=np.int64)
+    alive = np.ones(n, dtype=bool)
+    k = 0
+    while alive.any():
+        k = max(k, int(degree[alive].min()))
+        peel = np.flatnonzero(alive & (degree <= k))
+        while peel.size:
+            alive[peel] = False
+            core[peel] = k
+            nbrs = np.concatenate((csr_neighbours(indptr, indices, peel),
+                                   csr_neighbours(rindptr, rindices, peel)))
+            np.subtract.at(degree, nbrs, 1)
+            nbrs = np.unique(nbrs)
+            peel = nbrs[alive[nbrs] & (degree[nbrs] <= k)]
+    return _results(id_map, core, attr)
+
+
+def k_core(objects, nupath, k):
+    """Return the list of the objects in the k-core of the graph of the
+    relationship path ``nupath``, over the objects reachable from
+    ``objects`` (see :py:func:`core_numbers`)."""
+    return [obj for obj, c in core_numbers(objects, nupath).items() if c >= k]
@@ -0,0 +1,102 @@
+'''
+Export of relationships to the compressed sparse row (CSR) form, and
+traversals over it with NumPy.
+
+In CSR form, a directed graph over ``n`` vertices, numbered ``0..n-1``,
+is given by two integer arrays. The successors of vertex ``i`` are
+``indices[indptr[i]:indptr[i+1]]``.
+
+NumPy is imported only when the functions of this module are called.
+
+@author: vsam
+'''
+from .instrument import path_successors, _path_descriptors
+
+
+def to_csr(rel, objects):
+    """Return the graph of relationship ``rel`` over ``objects``, in CSR
+    form, as a triple ``(id_map, indptr, indices)`` of NumPy arrays.
+
+    ``rel`` is a relationship endpoint or descriptor, or a sequence of
+    them (a relationship path, as in
+    :py:func:`~modeling.instrument.transitive_closure`), in which case
+    there is an edge for each object reached by one repetition of the path.
+
+    ``id_map`` is an object array, where ``id_map[i]`` is the object of
+    vertex ``i``. The vertices are numbered in the order of ``objects``,
+    ignoring repetitions. Edges to objects not in ``objects`` are dropped.
+    """
+    import numpy as np
+
+    descs = _path_descriptors(rel)
+    succ = path_successors(descs)
+    k = len(descs)
+
+    ids = {}
+    for obj in objects:
+        ids.setdefault(obj, len(ids))
+    id_map = np.empty(len(ids), dtype=object)
+    id_map[:] = list(ids)
+
+    counts = []
+    indices = []
+    for obj in ids:
+        targets = succ(obj, 0)
+        for step in range(1, k):
+            targets = [y for x in targets for y in succ(x, step)]
+        before = len(indices)
+        indices.extend(ids[y] for y in targets if y in ids)
+        counts.append(len(indices) - before)
+    indptr = np.zeros(len(ids)+1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return id_map, indptr, np.array(indices, dtype=np.int64)
+
+
+def csr_neighbours(indptr, indices, vertices):
+    """Return the concatenated successors of ``vertices`` (an integer array),
+    with repetitions."""
+    import numpy as np
+
+    starts = indptr[vertices]
+    counts = indptr[vertices+1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return indices[:0]
+    # the position of each successor in indices
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return indices[offsets + np.arange(total)]
+
+
+def csr_bfs(indptr, indices, sources, max_hops=None):
+    """Return the array of hop counts from ``sources`` (an integer or a
+    sequence of vertices) to every vertex, by level-synchronous breadth-first
+    search. Unreached vertices have count -1."""
+    import numpy as np
+
+    n = len(indptr) - 1
+    dist = np.full(n, -1, dtype=np.int64)
+    frontier = np.unique(np.asarray(sources, dtype=np.int64))
+    dist[frontier] = 0
+    hops = 0
+    while frontier.size and (max_hops is None or hops < max_hops):
+        hops += 1
+        nbrs = csr_neighbours(indptr, indices, frontier)
+        frontier = np.unique(nbrs[dist[nbrs] < 0])
+        dist[frontier] = hops
+    return dist
+
+
+def csr_closure(indptr, indices, sources):
+    """Return a boolean array, marking the vertices reachable from
+    ``sources`` (including them)."""
+    return csr_bfs(indptr, indices, sources) >= 0
+
+
+def csr_degree(indptr, indices, incoming=False):
+    """Return the array of the out-degrees (or the in-degrees, if
+    ``incoming`` is True) of the vertices."""
+    import numpy as np
+
+    if incoming:
+        return np.bincount(indices, minlength=len(indptr)-1)
+    return np.diff(indptr)
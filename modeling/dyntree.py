@@ -0,0 +1,155 @@
+'''
+Dynamic trees, for maintaining forests of rooted trees under link and cut
+operations.
+
+The implementation is a link-cut tree (Sleator and Tarjan), without
+re-rooting. Each object of the forest is represented by a node, stored
+on the object itself. All operations take O(log n) amortized time, where
+n is the number of objects in the forest.
+
+@author: vsam
+'''
+
+
+class LinkCutNode:
+    """A node of a link-cut tree.
+
+    The nodes of each preferred path are kept in a splay tree, ordered by
+    depth. The ``parent`` of the root of a splay tree is the path-parent,
+    i.e., the parent of the topmost node of the path.
+    """
+    __slots__ = ['obj', 'left', 'right', 'parent', 'size']
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.left = None
+        self.right = None
+        self.parent = None
+        self.size = 1
+
+    def is_root(self):
+        # True if this is the root of its splay tree
+        p = self.parent
+        return p is None or (p.left is not self and p.right is not self)
+
+
+def _update(x):
+    x.size = 1 + (x.left.size if x.left is not None else 0) \
+        + (x.right.size if x.right is not None else 0)
+
+
+def _rotate(x):
+    p = x.parent
+    g = p.parent
+    if not p.is_root():
+        if g.left is p:
+            g.left = x
+        else:
+            g.right = x
+    x.parent = g
+    if p.left is x:
+        p.left = x.right
+        if x.right is not None:
+            x.right.parent = p
+        x.right = p
+    else:
+        p.right = x.left
+        if x.left is not None:
+            x.left.parent = p
+        x.left = p
+    p.parent = x
+    _update(p)
+    _update(x)
+
+
+def _splay(x):
+    while not x.is_root():
+        p = x.parent
+        if not p.is_root():
+            g = p.parent
+            if (g.left is p) == (p.left is x):
+                _rotate(p)
+            else:
+                _rotate(x)
+        _rotate(x)
+
+
+def _access(x):
+    # Make the path from the root to x preferred, and splay x to the root of
+    # its splay tree. Return the last node where the path was switched.
+    last = None
+    y = x
+    while y is not None:
+        _splay(y)
+        y.right = last
+        _update(y)
+        last = y
+        y = y.parent
+    _splay(x)
+    return last
+
+
+class LinkCutForest:
+    """A forest of rooted trees over arbitrary objects, supporting
+    :py:meth:`link`, :py:meth:`cut` and ancestry queries in logarithmic
+    amortized time.
+
+    The node of each object is stored in attribute ``slot`` of the object.
+    Objects which have never been linked are single-node trees.
+    """
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def node(self, obj):
+        """Return the node of ``obj``, creating it if needed."""
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            n = LinkCutNode(obj)
+            setattr(obj, self.slot, n)
+            return n
+
+    def link(self, child, parent):
+        """Make ``parent`` the parent of ``child``, which must be a root,
+        and must not be an ancestor of ``parent``."""
+        c = self.node(child)
+        _access(c)
+        assert c.left is None, "child is not a root"
+        c.parent = self.node(parent)
+
+    def cut(self, child):
+        """Remove the link between ``child`` and its parent, if any."""
+        c = self.node(child)
+        _access(c)
+        if c.left is not None:
+            c.left.parent = None
+            c.left = None
+            _update(c)
+
+    def root_of(self, obj):
+        """Return the root of the tree of ``obj``."""
+        x = self.node(obj)
+        _access(x)
+        while x.left is not None:
+            x = x.left
+        _splay(x)
+        return x.obj
+
+    def depth(self, obj):
+        """Return the number of proper ancestors of ``obj``."""
+        x = self.node(obj)
+        _access(x)
+        return x.left.size if x.left is not None else 0
+
+    def lca(self, a, b):
+        """Return the lowest common ancestor of ``a`` and ``b``, or None
+        if they are in different trees."""
+        if self.root_of(a) is not self.root_of(b):
+            return None
+        _access(self.node(a))
+        return _access(self.node(b)).obj
+
+    def is_ancestor(self, a, x):
+        """Return True if ``a`` is ``x`` or an ancestor of ``x``."""
+        return a is x or self.lca(a, x) is a
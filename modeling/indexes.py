@@ -0,0 +1,784 @@
+'''
+Materialized indexes over model relationships, which are maintained
+incrementally as the relationships change.
+
+@author: vsam
+'''
+from collections import OrderedDict
+from itertools import repeat
+from operator import is_, attrgetter
+from .instrument import path_successors, _path_descriptor, _path_descriptors, _reverse_path, \
+    relationship_descriptor, one_relationship_descriptor, plain_storage, OrderedAssociation, \
+    adjacency_relationship_descriptor, associated
+
+# the descriptors whose storage is validated by their version
+_versioned = (plain_storage, adjacency_relationship_descriptor)
+
+
+class PathIndex:
+    """Base class of the indexes over a relationship path.
+
+    The relationship path is modeled as a graph over pairs ``(obj, i)``, 
+    where ``i`` is a step of the path: there is an edge from ``(x, i)`` 
+    to ``(y, i+1)`` (modulo the path length), if ``y`` is associated to 
+    ``x`` via the i-th relationship of the path.
+
+    The index observes the relationships of the path, and its methods
+    ``_link(u, v)`` and ``_unlink(u, v)`` are called after an edge ``u -> v``
+    of this graph is established or removed.
+    """
+
+    def __init__(self, path):
+        if not isinstance(path, (tuple, list)):
+            path = (path,)
+        self.descs = tuple(_path_descriptor(rel) for rel in path)
+        if not self.descs:
+            raise ValueError("empty relationship path")
+        self.succ = path_successors(self.descs)
+
+        # register one observer per distinct descriptor, for all its steps
+        self.observers = []
+        for desc in set(self.descs):
+            steps = [i for i,d in enumerate(self.descs) if d is desc]
+            observer = self._observer(desc, steps)
+            desc.observe(observer)
+            self.observers.append((desc, observer))
+
+    def close(self):
+        """Stop maintaining the index."""
+        for desc, observer in self.observers:
+            desc.unobserve(observer)
+        self.observers = []
+
+    def _observer(self, desc, steps):
+        k = len(self.descs)
+        symmetric = desc.peer is desc
+        def observer(own, other, linked):
+            update = self._link if linked else self._unlink
+            for i in steps:
+                j = (i+1) % k
+                update((own, i), (other, j))
+                if symmetric and own is not other:
+                    update((other, i), (own, j))
+        return observer
+
+    def _successors(self, node):
+        obj, i = node
+        j = (i+1) % len(self.descs)
+        return [(y, j) for y in self.succ(obj, i)]
+
+    def _link(self, u, v):
+        raise NotImplementedError()
+
+    def _unlink(self, u, v):
+        raise NotImplementedError()
+
+
+class ReachabilityIndex(PathIndex):
+    """A materialized transitive closure over a relationship path.
+
+    The index answers whether an object ``b`` is reachable from an object
+    ``a`` by repetitions of the path, as in
+    :py:func:`~modeling.instrument.transitive_closure`, in O(1) time.
+
+    The index stores the set of pairs reachable from each pair that it 
+    knows of (see :py:class:`PathIndex`), together with the reverse sets. 
+    The pairs reachable from the seeds given at construction are computed 
+    eagerly, the rest when first queried.
+
+    When a link is established, the pairs reachable from its target are 
+    added to the sets of the pairs which reach its source (Italiano's 
+    insertion algorithm). When a link is removed, the sets of the pairs 
+    which reach its source are recomputed. Thus, the index suits graphs 
+    which change slowly, mostly by insertions.
+
+    The counts of updates are kept in ``stats``.
+    """
+
+    def __init__(self, path, seeds=()):
+        super().__init__(path)
+        self.reach = {}
+        self.anc = {}
+        self.stats = dict(links=0, unlinks=0, pairs_added=0, pairs_removed=0, recomputed=0)
+        for obj in seeds:
+            self._known((obj, 0))
+
+    def _closure(self, node):
+        # the pairs reachable from node, by a traversal of the current graph
+        self.stats['recomputed'] += 1
+        k = len(self.descs)
+        succ = self.succ
+        seen = set()
+        stack = [node]
+        while stack:
+            obj, i = stack.pop()
+            j = (i+1) % k
+            for y in succ(obj, i):
+                if (y, j) not in seen:
+                    seen.add((y, j))
+                    stack.append((y, j))
+        seen.discard(node)
+        return seen
+
+    def _known(self, node):
+        # return the reachable set of node, computing it if it is not known
+        try:
+            return self.reach[node]
+        except KeyError:
+            r = self.reach[node] = self._closure(node)
+            for y in r:
+                self.anc.setdefault(y, set()).add(node)
+            self.stats['pairs_added'] += len(r)
+            return r
+
+    def _link(self, u, v):
+        self.stats['links'] += 1
+        # only the stored sets are extended, the rest are computed when
+        # first queried
+        sources = set(self.anc.get(u, ()))
+        if u in self.reach:
+            sources.add(u)
+        if not sources:
+            return
+        rv = self.reach.get(v)
+        new = set(rv) if rv is not None else self._closure(v)
+        new.add(v)
+        added = 0
+        for x in sources:
+            rx = self.reach[x]
+            for y in new:
+                if y not in rx and y != x:
+                    rx.add(y)
+                    self.anc.setdefault(y, set()).add(x)
+                    added += 1
+        self.stats['pairs_added'] += added
+
+    def _unlink(self, u, v):
+        self.stats['unlinks'] += 1
+        sources = set(self.anc.get(u, ()))
+        if u in self.reach:
+            sources.add(u)
+        for x in sources:
+            old = self.reach[x]
+            new = self._closure(x)
+            for y in old - new:
+                self.anc[y].discard(x)
+                self.stats['pairs_removed'] += 1
+            for y in new - old:
+                self.anc.setdefault(y, set()).add(x)
+                self.stats['pairs_added'] += 1
+            self.reach[x] = new
+
+    def reachable(self, a, b):
+        """Return True if ``b`` is reachable from ``a``."""
+        return a is b or (b, 0) in self._known((a, 0))
+
+    def reachable_from(self, a):
+        """Return the set of objects reachable from ``a`` (including ``a``)."""
+        result = {y for y,j in self._known((a, 0)) if j == 0}
+        result.add(a)
+        return result
+
+    def __len__(self):
+        """The number of reachable pairs stored."""
+        return sum(len(r) for r in self.reach.values())
+
+
+class DynamicTopologicalOrder(PathIndex):
+    """A topological order of the objects of a relationship path, which 
+    is maintained as links are established and removed, and which reports 
+    the cycles created by new links.
+
+    The order is maintained by the algorithm of Pearce and Kelly. When a
+    link ``u -> v`` is established against the order, only the objects 
+    ordered between ``v`` and ``u`` are visited; if ``u`` is reachable from
+    ``v``, the link closes a cycle. Removing a link never invalidates the 
+    order. The positions are tuples, so that a new object linked from
+    ``u`` (e.g., a new edge object) is placed right after ``u``.
+
+    Objects are ordered when first linked (or, at construction, for the 
+    given ``objects``), together with the objects reachable from them. 
+    Each link that closes a cycle is kept out of the order, and the cycle 
+    is passed, as a list of objects from the source of the link around to
+    itself, to callable ``on_cycle``. The cycle is retried when one of its
+    links is removed.
+
+    Every relationship of the path must have an inverse endpoint. The 
+    counts of updates are kept in ``stats``.
+    """
+
+    # the maximum length of a position extended by a new object
+    MAX_POSITION = 8
+
+    def __init__(self, path, objects=(), on_cycle=None):
+        super().__init__(path)
+        self.pred = path_successors(_reverse_path(self.descs))
+        self.on_cycle = on_cycle
+        self.ord = {}
+        self.low = self.high = 0
+        self.serial = 0
+        self.back = {}
+        self.retry = []
+        self.stats = dict(links=0, unlinks=0, visited=0, reordered=0, cycles=0)
+        for obj in objects:
+            if (obj, 0) not in self.ord:
+                self._adopt((obj, 0), None, None)
+
+    def _predecessors(self, node):
+        obj, i = node
+        j = (i-1) % len(self.descs)
+        return [(y, j) for y in self.pred(obj, i)]
+
+    def _cycle_found(self, u, cycle, report):
+        # keep the link u -> cycle[0] out of the order
+        self.back[(u, cycle[0])] = [u] + cycle
+        self.stats['cycles'] += 1
+        if report and self.on_cycle is not None:
+            self.on_cycle([obj for obj, i in self.back[(u, cycle[0])]])
+
+    def _adopt(self, root, skip, after):
+        # Order the unordered objects reachable from root, by depth-first
+        # search (ignoring the link skip). They are placed before all 
+        # ordered objects, or, if they reach none, after object 'after' 
+        # (keeping positions short) or after all ordered objects.
+        ord = self.ord
+        below = False
+        postorder = []
+        postorder_set = set()
+        visited = {root}
+        path = [root]
+        stack = [iter(self._successors(root))]
+        while stack:
+            for y in stack[-1]:
+                if (path[-1], y) == skip:
+                    continue
+                if y in ord:
+                    below = True
+                    continue
+                if y in visited:
+                    if y not in postorder_set:
+                        # y is on the path, so this is a back link
+                        self._cycle_found(path[-1], path[path.index(y):], True)
+                    continue
+                visited.add(y)
+                path.append(y)
+                stack.append(iter(self._successors(y)))
+                break
+            else:
+                stack.pop()
+                x = path.pop()
+                postorder.append(x)
+                postorder_set.add(x)
+        if below:
+            for x in postorder:
+                self.low -= 1
+                ord[x] = (self.low,)
+        elif after is not None and len(ord[after]) < self.MAX_POSITION:
+            for x in reversed(postorder):
+                self.serial += 1
+                ord[x] = ord[after] + (self.serial,)
+        else:
+            for x in reversed(postorder):
+                self.high += 1
+                ord[x] = (self.high,)
+        self.stats['visited'] += len(postorder)
+
+    def _link(self, u, v):
+        self.stats['links'] += 1
+        if v not in self.ord:
+            self._adopt(v, (u, v), u if u in self.ord else None)
+        if u not in self.ord:
+            # u is placed before everything reachable from it
+            self._adopt(u, None, None)
+        else:
+            self._insert(u, v, True)
+        self._retry()
+
+    def _retry(self):
+        # retry the links released by removed links, once the links of the
+        # same update are ordered; drop the ones removed in the meantime
+        while self.retry:
+            link = self.retry.pop()
+            if self.back.pop(link, None) is not None and link[1] in self._successors(link[0]):
+                self._insert(link[0], link[1], False)
+
+    def _insert(self, u, v, report):
+        ord, back = self.ord, self.back
+        if u not in ord or v not in ord:
+            # ordered when its own link is observed
+            return
+        lb, ub = ord[v], ord[u]
+        if lb > ub:
+            return
+        if u == v:
+            self._cycle_found(u, [u], report)
+            return
+
+        # forward search from v, among the objects ordered before u
+        parent = {v: None}
+        stack = [v]
+        while stack:
+            x = stack.pop()
+            for y in self._successors(x):
+                if (x, y) in back:
+                    continue
+                if y == u:
+                    cycle = [u]
+                    while x is not None:
+                        cycle.append(x)
+                        x = parent[x]
+                    cycle.reverse()
+                    self._cycle_found(u, cycle, report)
+                    self.stats['visited'] += len(parent)
+                    return
+                if y not in parent and ord.get(y, ub) < ub:
+                    parent[y] = x
+                    stack.append(y)
+        forward = list(parent)
+
+        # backward search from u, among the objects ordered after v
+        seen = {u}
+        stack = [u]
+        while stack:
+            x = stack.pop()
+            for y in self._predecessors(x):
+                if y not in seen and ord.get(y, lb) > lb and (y, x) not in back:
+                    seen.add(y)
+                    stack.append(y)
+        backward = list(seen)
+
+        # reassign the positions of the visited objects, placing the 
+        # ones reaching u before the ones reachable from v
+        backward.sort(key=ord.__getitem__)
+        forward.sort(key=ord.__getitem__)
+        moved = backward + forward
+        for x, p in zip(moved, sorted(ord[x] for x in moved)):
+            ord[x] = p
+        self.stats['visited'] += len(moved)
+        self.stats['reordered'] += len(moved)
+
+    def _unlink(self, u, v):
+        self.stats['unlinks'] += 1
+        if self.back.pop((u, v), None) is not None:
+            return
+        # the links held back by cycles through u -> v are retried after
+        # the new links of the same update (observers are notified after
+        # the whole update, removals first); until then, they stay out of
+        # the order
+        for link, cycle in self.back.items():
+            if link not in self.retry and \
+                    any(cycle[i] == u and cycle[i+1] == v for i in range(len(cycle)-1)):
+                self.retry.append(link)
+
+    def has_cycle(self):
+        """Return True if the observed graph has a cycle."""
+        self._retry()
+        return bool(self.back)
+
+    def cycles(self):
+        """Return a list of cycles, one for each link held out of the order
+        (see the class documentation)."""
+        self._retry()
+        return [[obj for obj, i in cycle] for cycle in self.back.values()]
+
+    def precedes(self, a, b):
+        """Return True if object ``a`` is ordered before object ``b``.
+        Both objects must be ordered."""
+        self._retry()
+        return self.ord[(a, 0)] < self.ord[(b, 0)]
+
+    def order(self):
+        """Return the ordered objects, in topological order."""
+        self._retry()
+        return [obj for (obj, i), p in sorted(self.ord.items(), key=lambda item: item[1]) if i == 0]
+
+
+class ClosureCache:
+    """A cache of transitive closures, keyed by the set of seed objects and
+    the relationship path.
+
+    Each entry records the storage it read: the association container (and
+    its ``version``) or the value of each relationship slot visited. On a 
+    lookup, an entry is validated against the current storage, which is 
+    much cheaper than recomputing the closure. Relationships with plain 
+    or adjacency storage are validated by the ``version`` of their descriptor.
+
+    The least recently used entries are evicted when there are more than
+    ``maxsize`` entries, or when the entries hold more than ``maxobjects``
+    objects in total. The counts of lookups are kept in ``stats``.
+    """
+
+    def __init__(self, maxsize=128, maxobjects=None):
+        self.maxsize = maxsize
+        self.maxobjects = maxobjects
+        self.entries = OrderedDict()
+        self.objects = 0
+        self.stats = dict(hits=0, misses=0, invalidated=0, evicted=0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.objects = 0
+
+    def closure(self, seed, nupath):
+        """Return the objects reachable from the objects in ``seed`` by 
+        repetitions of the relationship path ``nupath``, as a tuple (see 
+        :py:func:`~modeling.instrument.transitive_closure`).
+        """
+        descs = _path_descriptors(nupath)
+        key = (frozenset(seed), descs)
+        entry = self.entries.get(key)
+        if entry is not None:
+            if self._valid(descs, entry):
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['invalidated'] += 1
+            self._remove(key)
+        else:
+            self.stats['misses'] += 1
+
+        entry = self._compute(key[0], descs)
+        self.entries[key] = entry
+        self.objects += len(entry[0])
+        while len(self.entries) > self.maxsize or \
+                (self.maxobjects is not None and self.objects > self.maxobjects and len(self.entries) > 1):
+            self._remove(next(iter(self.entries)))
+            self.stats['evicted'] += 1
+        return entry[0]
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.objects -= len(entry[0])
+
+    @staticmethod
+    def _flush(descs):
+        for desc in descs:
+            if desc.lazy and desc.log:
+                desc.flush()
+
+    def _valid(self, descs, entry):
+        result, (objs, names, values), (containers, versions) = entry
+        self._flush(descs)
+        return all(map(is_, map(getattr, objs, names, repeat(None)), values)) and \
+            list(map(attrgetter('version'), containers)) == versions
+
+    def _compute(self, seed, descs):
+        # the closure, with the storage it reads
+        self._flush(descs)
+        k = len(descs)
+        succ = path_successors(descs)
+        slots = []
+        versions = [(desc, desc.version) for desc in set(descs) if isinstance(desc, _versioned)]
+        plain = [isinstance(desc, _versioned) for desc in descs]
+
+        result = []
+        seen = [set() for desc in descs]
+        stack = [(s, 0) for s in seed]
+        while stack:
+            x, i = stack.pop()
+            if x in seen[i]:
+                continue
+            seen[i].add(x)
+            if i == 0:
+                result.append(x)
+            j = (i+1) % k
+            desc = descs[i]
+            if plain[i]:
+                stack.extend((y, j) for y in succ(x, i))
+                continue
+            value = getattr(x, desc.attr_name, None)
+            slots.append((x, desc.attr_name, value))
+            if value is None:
+                continue
+            if isinstance(desc, one_relationship_descriptor):
+                stack.append((value, j))
+            else:
+                versions.append((value, value.version))
+                items = value.seq if isinstance(value, OrderedAssociation) else value.elements
+                stack.extend((y, j) for y in items)
+        return tuple(result), tuple(zip(*slots)) or ((), (), ()), \
+            (tuple(c for c, v in versions), [v for c, v in versions])
+
+
+class TreeIntervalIndex(PathIndex):
+    """An index of a forest-shaped relationship, which answers ancestor
+    queries by comparing interval labels.
+
+    ``rel`` is the ONE relationship from an object to its parent (or its
+    inverse, from an object to its children); it must have an inverse 
+    endpoint. Each object of the forest is labeled by an interval 
+    ``(lo, hi)`` of integers, nested inside the interval of its parent, so
+    that :py:meth:`is_ancestor` takes two comparisons.
+
+    The labels are gapped: a new leaf object is labeled inside the free 
+    part of its parent's interval, and a leaf object which is detached 
+    from its parent is labeled as a new root. Other changes of the forest,
+    or a full interval, invalidate the labels, and all labels are 
+    recomputed on the next query. The counts are kept in ``stats``.
+    """
+
+    # the gap left after each label, when labels are recomputed
+    GAP = 1 << 32
+
+    def __init__(self, rel, objects=()):
+        desc = _path_descriptor(rel)
+        if not isinstance(desc, one_relationship_descriptor):
+            desc = desc.peer
+        if not isinstance(desc, one_relationship_descriptor) or \
+                not isinstance(desc.peer, relationship_descriptor):
+            raise ValueError("a ONE relationship with an inverse endpoint is required")
+        super().__init__(desc)
+        self.parent = desc
+        self.children = desc.peer
+        self.labels = {}
+        self.free = {}
+        self.top = 0
+        self.dirty = True
+        self.known = set(objects)
+        self.stats = dict(links=0, unlinks=0, relabeled=0, inserted=0)
+
+    def _link(self, u, v):
+        self.stats['links'] += 1
+        child, parent = u[0], v[0]
+        if self.dirty:
+            return
+        labels, free = self.labels, self.free
+        if parent in labels and self._is_leaf(child):
+            # label the new leaf in the lower half of the parent's free part,
+            # keeping the upper half for later siblings
+            lo, hi = free[parent], labels[parent][1]
+            if hi - lo >= 4:
+                mid = lo + (hi - lo) // 2
+                labels[child] = (lo, mid)
+                free[child] = lo + 1
+                free[parent] = mid + 1
+                self.stats['inserted'] += 1
+                return
+        self.known.add(child)
+        self.known.add(parent)
+        self.dirty = True
+
+    def _unlink(self, u, v):
+        self.stats['unlinks'] += 1
+        child = u[0]
+        if self.dirty:
+            return
+        if child not in self.labels:
+            return
+        if self._is_leaf(child):
+            # the leaf becomes a root
+            self._label_root(child)
+        else:
+            self.dirty = True
+
+    def _is_leaf(self, obj):
+        for c in associated(self.children, obj):
+            return False
+        return True
+
+    def _label_root(self, obj):
+        lo = self.top
+        self.top += 2*self.GAP
+        self.labels[obj] = (lo, lo + self.GAP)
+        self.free[obj] = lo + 1
+
+    def relabel(self):
+        """Recompute all labels, for the trees of the known objects."""
+        parent, children = self.parent, self.children
+        self.known.update(self.labels)
+        roots = []
+        checked = set()
+        for obj in self.known:
+            path = []
+            while obj is not None and obj not in checked:
+                checked.add(obj)
+                path.append(obj)
+                obj = parent.__get__(obj, None)
+            if obj is None:
+                roots.append(path[-1])
+            elif obj in path:
+                raise ValueError("relationship {0} is not a forest".format(parent.name))
+
+        labels, free = {}, {}
+        gap = self.GAP
+        c = 0
+        for root in roots:
+            # iterative depth-first traversal
+            labels[root] = c
+            c += gap
+            stack = [(root, iter(list(associated(children, root))))]
+            while stack:
+                x, it = stack[-1]
+                for y in it:
+                    labels[y] = c
+                    c += gap
+                    stack.append((y, iter(list(associated(children, y)))))
+                    break
+                else:
+                    stack.pop()
+                    free[x] = c
+                    labels[x] = (labels[x], c + gap - 1)
+                    c += gap
+        self.labels, self.free = labels, free
+        self.known = set(labels)
+        self.top = c
+        self.dirty = False
+        self.stats['relabeled'] += 1
+
+    def _labeled(self, *objs):
+        # relabel once, if the labels are invalid or some object is new
+        if self.dirty or not all(obj in self.labels for obj in objs):
+            self.known.update(objs)
+            self.relabel()
+
+    def label(self, obj):
+        """Return the label ``(lo, hi)`` of ``obj``."""
+        self._labeled(obj)
+        return self.labels[obj]
+
+    def is_ancestor(self, a, b):
+        """Return True if ``a`` is ``b`` or an ancestor of ``b``."""
+        self._labeled(a, b)
+        la, ha = self.labels[a]
+        lb, hb = self.labels[b]
+        return la <= lb and hb <= ha
+
+
+class JumpPointerIndex(PathIndex):
+    """An index of the chains of a ONE relationship (e.g., parent or
+    previous-version pointers), which answers level-ancestor and lowest
+    common ancestor queries in O(log n) time.
+
+    Each object is given its depth and one jump pointer to an ancestor, 
+    by the skew-binary scheme of Myers: the jump of an object is either 
+    its parent, or the jump of the jump of its parent. The depth of the 
+    jump depends only on the depth of the object, and any ancestor is 
+    reached by O(log n) jumps and parent steps.
+
+    The entries are computed when first needed, from the entry of the
+    parent. When an object without children (e.g., the head of a version
+    chain) is linked or unlinked, only its own entry is recomputed; other 
+    changes observed on the relationship invalidate all entries. The 
+    relationship must have an inverse endpoint for the former case to be 
+    recognized. The counts are kept in ``stats``.
+    """
+
+    def __init__(self, rel):
+        desc = _path_descriptor(rel)
+        if not isinstance(desc, one_relationship_descriptor):
+            raise ValueError("a ONE relationship is required")
+        super().__init__(desc)
+        self.desc = desc
+        self.slot = desc.attr_name
+        self.children = desc.peer if isinstance(desc.peer, relationship_descriptor) else None
+        self.entries = {}
+        self.epoch = 0
+        self.stats = dict(computed=0, invalidated=0)
+
+    def _changed(self, child):
+        if self.children is not None:
+            for c in associated(self.children, child):
+                break
+            else:
+                return
+        # the entries of the descendants of child are stale
+        self.epoch += 1
+        self.stats['invalidated'] += 1
+
+    def _link(self, u, v):
+        self._changed(u[0])
+
+    def _unlink(self, u, v):
+        self._changed(u[0])
+
+    def _entry(self, x):
+        # the entry (epoch, parent, depth, jump) of x, recomputed if needed
+        slot, entries, epoch = self.slot, self.entries, self.epoch
+        e = entries.get(x)
+        if e is not None and e[0] == epoch and e[1] is getattr(x, slot, None):
+            return e
+
+        # find the nearest ancestor with a valid entry
+        path = []
+        onpath = set()
+        y = x
+        while True:
+            if y in onpath:
+                raise ValueError("relationship {0} has a cycle".format(self.desc.name))
+            onpath.add(y)
+            p = getattr(y, slot, None)
+            path.append((y, p))
+            if p is None:
+                break
+            e = entries.get(p)
+            if e is not None and e[0] == epoch and e[1] is getattr(p, slot, None):
+                break
+            y = p
+
+        for y, p in reversed(path):
+            if p is None:
+                e = (epoch, None, 0, y)
+            else:
+                _, _, dp, jp = entries[p]
+                _, _, djp, jjp = entries[jp]
+                if dp - djp == djp - entries[jjp][2]:
+                    e = (epoch, p, dp+1, jjp)
+                else:
+                    e = (epoch, p, dp+1, p)
+            entries[y] = e
+        self.stats['computed'] += len(path)
+        return entries[x]
+
+    def depth(self, x):
+        """Return the number of proper ancestors of ``x``."""
+        return self._entry(x)[2]
+
+    def level_ancestor(self, x, k):
+        """Return the ancestor of ``x`` at distance ``k`` (``x`` itself for
+        ``k == 0``), or None if ``x`` has fewer than ``k`` ancestors."""
+        e = self._entry(x)
+        target = e[2] - k
+        if k < 0 or target < 0:
+            return None
+        return self._ascend(x, e, target)
+
+    def _ascend(self, x, e, target):
+        # the ancestor of x at depth target
+        entries = self.entries
+        while e[2] > target:
+            j = e[3]
+            ej = entries[j]
+            if ej[2] >= target:
+                x, e = j, ej
+            else:
+                x = e[1]
+                e = entries[x]
+        return x
+
+    def root(self, x):
+        """Return the first object of the chain of ``x``."""
+        return self.level_ancestor(x, self.depth(x))
+
+    def lca(self, a, b):
+        """Return the lowest common ancestor of ``a`` and ``b``, or None
+        if they are not in the same tree."""
+        ea, eb = self._entry(a), self._entry(b)
+        if ea[2] > eb[2]:
+            a = self._ascend(a, ea, eb[2])
+        elif eb[2] > ea[2]:
+            b = self._ascend(b, eb, ea[2])
+        entries = self.entries
+        while a is not b:
+            ea, eb = entries[a], entries[b]
+            if ea[1] is None:
+                # distinct roots
+                return None
+            if ea[3] is not eb[3]:
+                # the jumps are at the same depth, below the lca
+                a, b = ea[3], eb[3]
+            else:
+                a, b = ea[1], eb[1]
+        return a
@@ -5,8 +5,14 @@ Created on Oct 24, 2014
 
 @author: vsam
 '''
+from collections import namedtuple, Counter, defaultdict
 from collections.abc import MutableSet, MutableSequence
+from itertools import count, repeat
+from array import array
+from bisect import bisect_left, insort
+import random
 from .constraints import is_legal_identifier, Constraint
+from .dyntree import LinkCutForest
 
 
 
@@ -36,6 +42,14 @@ class AssociationNoneError(ValueError, AssociationError):
     """Thrown if None is offered for association to Set or Ordered ."""
     pass
 
+class AssociationCardinalityError(ValueError, AssociationError):
+    """Thrown when an association would exceed the maximum cardinality of a container."""
+    pass
+
+class AssociationCycleError(ValueError, AssociationError):
+    """Thrown when an association would create a cycle in a tree relationship."""
+    pass
+
 
 
 
@@ -204,16 +218,48 @@ class  SetAssociation(Association, MutableSet):
     """The set container implements a set of unlimited size. 
     Its implementation uses the MutableSet abstract base class.
     
+    The members are stored in an indexable layout: a dense list of the 
+    members, and a dict mapping each member to its position in the list.
+    A member is removed by moving the last member of the list into its 
+    position. Thus, an arbitrary member (:py:meth:`any`) or a random sample
+    of members (:py:meth:`sample`) can be obtained without copying the 
+    container.
+
+    Iteration is done over a copy-on-write snapshot: an iterator holds
+    on to the current list, and a snapshot marks the list as ``shared``, so
+    that the next mutation replaces the list with a copy instead of 
+    changing it in place. Thus, the container can be mutated (even from 
+    within the loop body) while it is being iterated, and the iterator sees
+    the contents at the time it was created. When no snapshot has been 
+    taken since the last mutation, mutations are done in place and nothing 
+    is copied.
+
+    Readers take no lock, and may run in other threads than the writer 
+    (concurrent writers must still be serialized). A mutation increments
+    ``version`` before it touches the list, and stores it in ``written`` 
+    when it is done. A snapshot first reads ``written``, then marks the 
+    list as shared with a single store, and then captures the list; if
+    ``version`` has moved meanwhile, a mutation overlapped and the snapshot
+    is retried. Otherwise, every later mutation sees the mark and leaves 
+    the captured list alone.
+
+    Each mutation of the storage increments ``version``, so that results
+    computed from the contents can be validated cheaply.
+    
     TODO: Note that this implementation requires the objects to be
     hashable. A more general implementation based on dicts of object ids,
     would probably be more appropriate.
     """
 
-    __slots__=['values']
+    __slots__=['values', 'elements', 'shared', 'version', 'written']
     
     def __init__(self, owner, peer_associator):
         super().__init__(owner, peer_associator)
-        self.values = set()                    
+        self.values = {}
+        self.elements = []
+        self.shared = False
+        self.version = 0
+        self.written = 0
 
     def __contains__(self, x):
         return x in self.values
@@ -222,27 +268,99 @@ class  SetAssociation(Association, MutableSet):
         return len(self.values)
     
     def __iter__(self):
-        return iter(self.values)
+        return self.snapshot()
+
+    def snapshot(self):
+        """Return an iterator over the current contents, which is not
+        affected by subsequent mutations of the container.
+        """
+        while True:
+            written = self.written
+            self.shared = True
+            elements = self.elements
+            if self.version == written:
+                return iter(elements)
+
+    def _detach(self):
+        # copy-on-write: leave the current list to the snapshots
+        self.shared = False
+        self.elements = list(self.elements)
+
+    def link(self, value):
+        """Add value to the storage, without any association maintenance."""
+        self.values[value] = len(self.elements)
+        self.version += 1
+        if self.shared: self._detach()
+        self.elements.append(value)
+        self.written = self.version
+
+    def link_many(self, values):
+        """Add a list of new values to the storage, without any association
+        maintenance."""
+        n = len(self.elements)
+        self.values.update(zip(values, range(n, n+len(values))))
+        self.version += 1
+        if self.shared: self._detach()
+        self.elements.extend(values)
+        self.written = self.version
+
+    def unlink(self, value):
+        """Remove value from the storage, without any association maintenance."""
+        pos = self.values.pop(value)
+        self.version += 1
+        if self.shared: self._detach()
+        elements = self.elements
+        last = elements.pop()
+        moved = pos < len(elements)
+        if moved:
+            elements[pos] = last
+        self.written = self.version
+        if moved:
+            self.values[last] = pos
+
+    def any(self):
+        """Return an arbitrary member, in O(1) time. Raise KeyError if the
+        container is empty."""
+        if not self.elements:
+            raise KeyError("any(): empty association")
+        return self.elements[0]
+
+    def sample(self, k, rng=None):
+        """Return a list of ``k`` distinct members chosen at random, in O(k) 
+        time. 
+        
+        ``rng`` is an instance of ``random.Random``, by default the shared 
+        instance of the random module.
+        """
+        if rng is None:
+            rng = random
+        elements = self.elements
+        return [elements[i] for i in rng.sample(range(len(elements)), k)]
 
     def add(self, value):
         if value not in self.values:
             self.peer_associator.peer.validate_object(value)
-            self.values.add(value)
+            self.link(value)
             self.peer_associator.associate(value, self.owner)
         
     def discard(self, value):
         if value in self.values:
-            self.values.discard(value)
+            self.unlink(value)
             self.peer_associator.dissociate(value, self.owner)
     
     # override to make it fast
     def clear(self):
-        for x in self.values:
+        elements = self.elements
+        self.version += 1
+        self.values = {}
+        self.elements = []
+        self.shared = False
+        self.written = self.version
+        for x in elements:
             self.peer_associator.dissociate(x, self.owner)
-        self.values.clear()
     
     def isdisjoint(self, other):
-        return self.values.isdisjoint(other)
+        return self.values.keys().isdisjoint(other)
     
     def assign(self, sobj):
         self.clear()
@@ -254,16 +372,208 @@ class  SetAssociation(Association, MutableSet):
         return set(it)
 
     def union(self, other):
-        return self.values.union(other)
+        return set(self.values).union(other)
     
     def __le__(self, other):
-        return set.__le__(self.values, other)
+        return self.values.keys() <= other
 
     def __repr__(self):
-        return "Association(%s) at 0x%x" % (repr(self.values), id(self))
+        return "Association(%s) at 0x%x" % (repr(set(self.values)), id(self))
     def __str__(self):
-        return "Association(%s)" % str(self.values)
+        return "Association(%s)" % str(set(self.values))
+    
+
+
+class BoundedSetAssociation(SetAssociation):
+    """A set container with a maximum capacity.
     
+    The capacity is checked when a new object is linked, before anything is
+    modified.
+    """
+
+    __slots__=['capacity']
+
+    def __init__(self, owner, peer_associator, capacity):
+        super().__init__(owner, peer_associator)
+        self.capacity = capacity
+
+    def link(self, value):
+        if len(self.values) >= self.capacity:
+            raise AssociationCardinalityError("association cannot hold more than %d objects" % self.capacity)
+        super().link(value)
+
+    def link_many(self, values):
+        if len(self.values)+len(values) > self.capacity:
+            raise AssociationCardinalityError("association cannot hold more than %d objects" % self.capacity)
+        super().link_many(values)
+
+
+
+class TreeAssociation(SetAssociation):
+    """The container of the children of an object, in a tree relationship
+    (see :py:class:`tree_relationship_descriptor`).
+
+    A child is checked for cycles before anything is changed.
+    """
+
+    __slots__=[]
+
+    def add(self, value):
+        if value not in self.values:
+            self.peer_associator.peer.validate_object(value)
+            self.peer_associator.check_link(value, self.owner)
+            self.link(value)
+            self.peer_associator.associate(value, self.owner)
+
+
+
+class AdjacencyAssociation(Association, MutableSet):
+    """The container of an object in an adjacency relationship (see 
+    :py:class:`adjacency_relationship_descriptor`).
+
+    The neighbours are kept as a sorted array of the integer ids which the
+    descriptor gives to the objects, ``node`` is the id of the owner (or -1,
+    while it has no neighbours), and all updates go through the descriptor,
+    which maintains both ends of an edge in a single call. Membership takes
+    a binary search.
+
+    Iteration is done over a list of the neighbours, built from the array
+    in one step when the iterator is created, so the container can be 
+    mutated while it is being iterated.
+    """
+
+    __slots__=['node', 'ids']
+
+    def __init__(self, owner, peer_associator):
+        super().__init__(owner, peer_associator)
+        self.node = -1
+        self.ids = array(peer_associator.typecode)
+
+    def __contains__(self, x):
+        other = getattr(x, self.peer_associator.attr_name, None)
+        return other is not None and other.node >= 0 and _sorted_find(self.ids, other.node) >= 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return self.snapshot()
+
+    def snapshot(self):
+        """Return an iterator over the current neighbours, which is not
+        affected by subsequent mutations of the container."""
+        return iter(list(map(self.peer_associator.nodes.__getitem__, self.ids)))
+
+    def add(self, value):
+        self.peer_associator.connect(self.owner, value)
+
+    def discard(self, value):
+        self.peer_associator.disconnect(self.owner, value)
+
+    def clear(self):
+        for x in self.snapshot():
+            self.peer_associator.disconnect(self.owner, x)
+
+    def assign(self, sobj):
+        self.clear()
+        for x in sobj:
+            self.add(x)
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def any(self):
+        """Return an arbitrary neighbour, in O(1) time. Raise KeyError if 
+        there are none."""
+        if not self.ids:
+            raise KeyError("any(): empty association")
+        return self.peer_associator.nodes[self.ids[0]]
+
+    def sample(self, k, rng=None):
+        """Return a list of ``k`` distinct neighbours chosen at random, in 
+        O(k) time (see :py:meth:`SetAssociation.sample`)."""
+        if rng is None:
+            rng = random
+        ids, nodes = self.ids, self.peer_associator.nodes
+        return [nodes[ids[i]] for i in rng.sample(range(len(ids)), k)]
+
+    def __repr__(self):
+        return "Association(%s) at 0x%x" % (repr(set(self)), id(self))
+    def __str__(self):
+        return "Association(%s)" % str(set(self))
+
+
+def _sorted_find(ids, i):
+    # the position of i in the sorted array ids, or -1
+    pos = bisect_left(ids, i)
+    return pos if pos < len(ids) and ids[pos] == i else -1
+
+
+
+class EdgeAssociation(Association):
+    """The container of an object in an edge relationship (see
+    :py:class:`edge_relationship_descriptor`).
+
+    This is a transient view, like :py:class:`AdjacencyAssociation`.
+    Iteration yields pairs ``(neighbour, payload)``, where ``payload`` is a
+    named tuple of the payload fields of the edge. The payload values are
+    read as the iteration proceeds.
+    """
+
+    __slots__=[]
+
+    def __len__(self):
+        return len(self.peer_associator.peer.neighbours(self.owner))
+
+    def __contains__(self, other):
+        return other in self.peer_associator.peer.neighbours(self.owner)
+
+    def __iter__(self):
+        desc = self.peer_associator.peer
+        store = desc.neighbours(self.owner)
+        table = desc.table
+        for other in desc.snapshot(self.owner):
+            yield other, table.record(store[other])
+
+    def __getitem__(self, other):
+        return self.peer_associator.peer.payload(self.owner, other)
+
+    def neighbours(self):
+        """Return an iterator over the neighbours, without the payloads."""
+        return self.peer_associator.peer.snapshot(self.owner)
+
+    def add(self, other, **payload):
+        """Link to ``other`` with the given payload, or update the payload of
+        an existing link."""
+        self.peer_associator.peer.connect(self.owner, other, **payload)
+
+    def discard(self, other):
+        self.peer_associator.peer.disconnect(self.owner, other)
+
+    def remove(self, other):
+        if other not in self:
+            raise KeyError(other)
+        self.discard(other)
+
+    def clear(self):
+        for other in self.neighbours():
+            self.discard(other)
+
+    def assign(self, items):
+        """Replace the contents by ``items``, each of which is either a neighbour,
+        or a pair of a neighbour and a payload dict."""
+        self.clear()
+        for item in items:
+            if isinstance(item, tuple):
+                other, payload = item
+                self.add(other, **payload)
+            else:
+                self.add(item)
+
+    def __repr__(self):
+        return "EdgeAssociation(%s) at 0x%x" % (repr(list(self)), id(self))
+
 
 
 class SetAssociator(PeerAssociator):
@@ -279,14 +589,14 @@ class SetAssociator(PeerAssociator):
         except AttributeError:
             coll = self.create_container(own)
             setattr(own, self.attr_name, coll)
-        coll.values.add(other)
+        coll.link(other)
     
     def dissociate(self, own, other):
         # symmetric relation check
         if own is other and self.peer is self: return 
         coll = getattr(own, self.attr_name)
         assert other in coll
-        coll.values.remove(other)        
+        coll.unlink(other)        
     
 
 
@@ -302,16 +612,75 @@ class  OrderedAssociation(Association, MutableSequence):
     in the list. Also, None is not allowed in the list.
     
     If on operation violates these constraints, an AssociationDuplicate
+    
+    Like :py:class:`SetAssociation`, iteration is done over a copy-on-write
+    snapshot of the sequence, taken without locking, and each mutation 
+    increments ``version``.
     """
 
-    __slots__=['seq','values','association_index']
+    __slots__=['seq','values','association_index', 'shared', 'version', 'written']
     
     def __init__(self, owner, peer_associator):
         super().__init__(owner, peer_associator)
                 
         self.seq = list()
         self.values = set()
+        self.shared = False
+        self.version = 0
+        self.written = 0
 
+    def snapshot(self):
+        """Return an iterator over the current sequence, which is not
+        affected by subsequent mutations of the container.
+        """
+        # as in SetAssociation
+        while True:
+            written = self.written
+            self.shared = True
+            seq = self.seq
+            if self.version == written:
+                return iter(seq)
+
+    def _detach(self):
+        # copy-on-write: leave the current sequence to the snapshots
+        self.shared = False
+        self.seq = list(self.seq)
+
+    def _modify(self):
+        # called before every mutation of the sequence
+        self.version += 1
+        if self.shared: self._detach()
+
+    def _modified(self):
+        # called after every mutation of the sequence
+        self.written = self.version
+
+    def link(self, value, index=None):
+        """Insert value in the storage (by default, at the end), without 
+        any association maintenance."""
+        self.values.add(value)
+        self._modify()
+        if index is None:
+            self.seq.append(value)
+        else:
+            self.seq.insert(index, value)
+        self._modified()
+
+    def link_many(self, values):
+        """Append a list of new values to the storage, without any 
+        association maintenance."""
+        self.values.update(values)
+        self._modify()
+        self.seq.extend(values)
+        self._modified()
+
+    def unlink(self, value):
+        """Remove value from the storage, without any association maintenance."""
+        self.values.remove(value)
+        index = self.seq.index(value)
+        self._modify()
+        del self.seq[index]
+        self._modified()
         
     def __getitem__(self, index):
         return self.seq[index]
@@ -340,12 +709,16 @@ class  OrderedAssociation(Association, MutableSequence):
             if not self.values.isdisjoint(new_not_removed):
                 raise AssociationDuplicateError("cannot have duplicates in an association")
                 
-            # finally, check validity
+            # finally, check validity of the new objects
             valfunc = self.peer_associator.peer.validate_object
-            for obj in newvalue:
+            for obj in new_not_removed:
                 valfunc(obj)  # may throw
                 
-            self.seq[index] = newvalue  # may throw
+            self._modify()
+            try:
+                self.seq[index] = newvalue  # may throw
+            finally:
+                self._modified()
             self.values.difference_update(removed_not_new)
             self.values.update(new_not_removed)
 
@@ -369,9 +742,11 @@ class  OrderedAssociation(Association, MutableSequence):
             self.peer_associator.peer.validate_object(newvalue)
             
             # ok, do it
+            self._modify()
+            self.seq[index] = newvalue
+            self._modified()
             self.values.remove(oldvalue)
             self.values.add(newvalue)
-            self.seq[index] = newvalue
 
             self.peer_associator.dissociate(oldvalue, self.owner)
             self.peer_associator.associate(newvalue, self.owner)
@@ -381,7 +756,9 @@ class  OrderedAssociation(Association, MutableSequence):
     def __delitem__(self, index):
         # Here we support slices!
         U = self.seq[index]
+        self._modify()
         del self.seq[index]
+        self._modified()
         if isinstance(index, slice):
             for x in U:
                 self.values.remove(x)
@@ -396,8 +773,7 @@ class  OrderedAssociation(Association, MutableSequence):
             raise AssociationDuplicateError("cannot have duplicates in an association")
         
         self.peer_associator.peer.validate_object(newvalue)
-        self.seq.insert(index, newvalue)
-        self.values.add(newvalue)        
+        self.link(newvalue, index)
         self.peer_associator.associate(newvalue, self.owner)
         
     
@@ -411,7 +787,11 @@ class  OrderedAssociation(Association, MutableSequence):
         return value in self.values
 
     def sort(self, key=None, reverse=False):
-        return self.seq.sort(key=key, reverse=reverse)
+        # the key is not called while the sequence is being modified
+        seq = sorted(self.seq, key=key, reverse=reverse)
+        self._modify()
+        self.seq[:] = seq
+        self._modified()
         
     def copy(self):
         return self.seq.copy()
@@ -423,7 +803,9 @@ class  OrderedAssociation(Association, MutableSequence):
         return self.seq.index(*args, **kwargs)
     
     def reverse(self):
-        return self.seq.reverse()
+        self._modify()
+        self.seq.reverse()
+        self._modified()
 
     def __repr__(self):
         return "Association(%s) at 0x%x" % (repr(self.seq),id(self))
@@ -431,7 +813,85 @@ class  OrderedAssociation(Association, MutableSequence):
         return "Association(%s)" % str(self.seq)
 
     def __iter__(self):
-        return iter(self.seq)
+        return self.snapshot()
+
+
+
+class BoundedOrderedAssociation(OrderedAssociation):
+    """An ordered container with a maximum capacity.
+    
+    The capacity is checked when a new object is linked, or a slice is 
+    assigned, before anything is modified.
+    """
+
+    __slots__=['capacity']
+
+    def __init__(self, owner, peer_associator, capacity):
+        super().__init__(owner, peer_associator)
+        self.capacity = capacity
+
+    def link(self, value, index=None):
+        if len(self.values) >= self.capacity:
+            raise AssociationCardinalityError("association cannot hold more than %d objects" % self.capacity)
+        super().link(value, index)
+
+    def link_many(self, values):
+        if len(self.values)+len(values) > self.capacity:
+            raise AssociationCardinalityError("association cannot hold more than %d objects" % self.capacity)
+        super().link_many(values)
+
+    def __setitem__(self, index, newvalue):
+        if isinstance(index, slice):
+            if not isinstance(newvalue, (list, tuple, set)):
+                newvalue = list(newvalue)
+            if len(self.seq)-len(self.seq[index])+len(newvalue) > self.capacity:
+                raise AssociationCardinalityError("association cannot hold more than %d objects" % self.capacity)
+        super().__setitem__(index, newvalue)
+
+
+
+def _flush_before(*names):
+    """Class decorator for the containers of a lazy relationship endpoint:
+    the named methods apply the pending updates of the endpoint first."""
+    def wrap(method):
+        def wrapper(self, *args, **kwargs):
+            desc = self.peer_associator.peer
+            if desc.log:
+                desc.flush()
+            return method(self, *args, **kwargs)
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    def decorate(cls):
+        for name in names:
+            setattr(cls, name, wrap(getattr(cls, name)))
+        return cls
+    return decorate
+
+
+@_flush_before('__contains__', '__len__', 'snapshot', 'any', 'sample', 'add', 'discard',
+               'clear', 'isdisjoint', 'assign', 'union', '__le__', '__repr__', '__str__')
+class LazySetAssociation(SetAssociation):
+    """The set container of a lazy relationship endpoint.
+
+    Every operation applies the pending updates of the endpoint first, so a
+    container that is held across writes to the peer endpoint is never
+    stale when it is read.
+    """
+
+    __slots__=[]
+
+
+
+@_flush_before('__contains__', '__len__', 'snapshot', '__getitem__', '__setitem__',
+               '__delitem__', 'insert', 'assign', 'sort', 'copy', 'count', 'index',
+               'reverse', '__repr__', '__str__')
+class LazyOrderedAssociation(OrderedAssociation):
+    """The ordered container of a lazy relationship endpoint (see
+    :py:class:`LazySetAssociation`)."""
+
+    __slots__=[]
 
 
 
@@ -463,19 +923,14 @@ class OrderedAssociator(PeerAssociator):
             coll = self.create_container(own)
             setattr(own, self.attr_name, coll)
         assert other not in coll.values
-        coll.values.add(other)
-        if self.association_index is None:
-            coll.seq.append(other)
-        else:
-            coll.seq.insert(self.assoc_index, other)
+        coll.link(other, self.association_index)
         
     def dissociate(self, own, other):
         # symmetric relation check
         if own is other and self.peer is self: return 
         coll = getattr(own, self.attr_name)
         assert other in coll
-        coll.values.remove(other)
-        coll.seq.remove(other)
+        coll.unlink(other)
         
     
 
@@ -494,6 +949,25 @@ class attr_descriptor:  # this is mostly a 'marker' class
         self.nullable=nullable
         self.content_type=content_type
         self.constraint=constraint
+        self.observers=[]
+
+    def observe(self, observer):
+        """Register a callable ``observer(obj)``, to be called after the 
+        attribute of ``obj`` is set or deleted.
+
+        The descriptor is recompiled to notify its observers.
+        """
+        self.observers.append(observer)
+        self.__class__ = attribute_descriptor_class(self.name, self.default, self.nullable,
+                                                    self.content_type, self.constraint, True)
+
+    def unobserve(self, observer):
+        """Unregister an observer registered by :py:meth:`observe`."""
+        self.observers.remove(observer)
+        self.__class__ = attribute_descriptor_class(self.name, self.default, self.nullable,
+                                                    self.content_type, self.constraint,
+                                                    bool(self.observers))
+
 
 def attribute_descriptor(name, default=Ellipsis, nullable=True, content_type=object, constraint=None):
     """Return an attribute descriptor for the given arguments.
@@ -506,6 +980,16 @@ def attribute_descriptor(name, default=Ellipsis, nullable=True, content_type=obj
     assert isinstance(nullable, bool)
     #assert istypespec(content_type)
 
+    if constraint is not None and not isinstance(constraint, Constraint):
+        constraint = Constraint(constraint,"<for "+name+">")
+
+    cls = attribute_descriptor_class(name, default, nullable, content_type, constraint)
+    return cls(name, default, nullable, content_type, constraint)
+
+
+def attribute_descriptor_class(name, default, nullable, content_type, constraint, observed=False):
+    """Return the specially compiled attribute descriptor class for the given spec.
+    """
     has_default = default is not Ellipsis
     has_content_type = content_type is not object
     has_constraint = constraint is not None
@@ -513,9 +997,6 @@ def attribute_descriptor(name, default=Ellipsis, nullable=True, content_type=obj
     # Just in case something is read-only (! to be used later)
     has_setter = True
 
-    if has_constraint and not isinstance(constraint, Constraint):
-        constraint = Constraint(constraint,"<for "+name+">")
-
     path_access = "_ATTR_%s" % name
 
     if isinstance(content_type, tuple):
@@ -573,43 +1054,112 @@ class {{name}}_descriptor(attr_descriptor):
         % end
     % end
         obj.{{path_access}} = value
+    % if observed:
+        for notify in self.observers: notify(obj)
+    % end
 %end
 
     def __delete__(self, obj):
         del obj.{{path_access}}
+% if observed:
+        for notify in self.observers: notify(obj)
+% end
 """
     from bottle import template
     source = template(template_text, locals(), template_settings={'noescape':True})
     names = dict(globals())
     names.update(locals())
     exec(source, names)
-    cls = names[name+"_descriptor"]
-    return cls(name, default, nullable, content_type, constraint)
+    return names[name+"_descriptor"]
 
 
 
 class relationship_descriptor(PeerAssociator):
     PREFIX='REF'
-    """Implements the semantics of RelationshipEndpoint access
+    """Implements the semantics of RelationshipEndpoint access.
+
+    The methods of this class (and its subclasses) are generic. When a
+    descriptor is initialized with its peer, its class is replaced by a
+    specially compiled subclass (see :py:func:`relationship_descriptor_class`),
+    which hard-wires the storage names, the peer kind and the content type.
     """
     def __init__(self, name, target):
-        super().__init__(None, target, "__%s_%s" % (self.PREFIX, name))
+        super().__init__(None, target, "_%s_%s" % (self.PREFIX, name))
+        self.name = name
+        self.owner = None
+        self.read_only = False
+        self.min = 0
+        self.max = None
+        self.observers = []
+        self.lazy = False
+        self.log = []
+        self.generic_class = type(self)
 
     def create_container(self, obj):
         raise NotImplementedError()
 
     def initialize(self, peer):
         self.peer = peer
+        self.__class__ = relationship_descriptor_class(self)
+
+    def observe(self, observer):
+        """Register a callable ``observer(own, other, linked)``, to be called 
+        whenever a link between ``own`` (an object on this side) and ``other``
+        is established (``linked`` is True) or removed (``linked`` is False).
         
+        The peer descriptor is registered with the reverse orientation.
+        Both descriptors are recompiled to notify their observers.
+        """
+        if self.peer is None:
+            raise ValueError("relationship descriptor is not initialized")
+        self.observers.append(observer)
+        if self.peer is not self:
+            self.peer.observers.append(_reverse_observer(observer))
+            self.peer.initialize(self)
+        self.initialize(self.peer)
+
+    def unobserve(self, observer):
+        """Unregister an observer registered by :py:meth:`observe`."""
+        self.observers.remove(observer)
+        if self.peer is not self:
+            for o in self.peer.observers:
+                if isinstance(o, _reverse_observer) and o.observer is observer:
+                    self.peer.observers.remove(o)
+                    break
+            self.peer.initialize(self)
+        self.initialize(self.peer)
+
+    def where(self, predicate, depends_on=()):
+        """Return a :py:class:`RelationshipView` of the objects associated 
+        via this relationship, which satisfy ``predicate``.
+        """
+        return RelationshipView(self, predicate, depends_on)
+
     def __delete__(self, obj):
         raise NotImplementedError("Cannot delete Relationship")
+
+    def __reduce__(self):
+        # Descriptors are shared by all instances, so pickle them by reference
+        if self.owner is None:
+            raise TypeError("cannot pickle a relationship descriptor without an owner")
+        return (getattr, (self.owner, self.name))
         
 
+class _reverse_observer:
+    # Adapts an observer registered on one side, to the peer side
+    __slots__ = ['observer']
+    def __init__(self, observer):
+        self.observer = observer
+    def __call__(self, own, other, linked):
+        self.observer(other, own, linked)
+
+
 class one_relationship_descriptor(relationship_descriptor):
     PREFIX='REF'
     def __init__(self, name, target, read_only=False):
         super().__init__(name, target)
 
+        self.read_only = read_only
         if read_only:
             self.set = self.read_only_set
         else:
@@ -652,13 +1202,54 @@ class one_relationship_descriptor(relationship_descriptor):
         self.set(obj, val)   
     
 
+class tree_relationship_descriptor(one_relationship_descriptor):
+    """The descriptor of the parent endpoint of a tree relationship.
+
+    The parent links are mirrored in a :py:class:`~modeling.dyntree.LinkCutForest`,
+    so that a link which would create a cycle is rejected, and the ancestry
+    queries of this class take logarithmic amortized time.
+    """
+    PREFIX='REF'
+
+    def __init__(self, name, target, read_only=False):
+        super().__init__(name, target, read_only)
+        self.forest = LinkCutForest("_TREE_%s" % name)
+
+    def check_link(self, child, parent):
+        """Raise AssociationCycleError if making ``parent`` the parent of 
+        ``child`` would create a cycle."""
+        if self.forest.is_ancestor(child, parent):
+            raise AssociationCycleError("object {0} is an ancestor of {1}".format(child, parent))
+
+    def root_of(self, obj):
+        """Return the root of the tree of ``obj``."""
+        return self.forest.root_of(obj)
+
+    def depth(self, obj):
+        """Return the number of ancestors of ``obj``."""
+        return self.forest.depth(obj)
+
+    def is_ancestor(self, a, obj):
+        """Return True if ``a`` is ``obj`` or an ancestor of ``obj``."""
+        return self.forest.is_ancestor(a, obj)
+
+    def lca(self, a, b):
+        """Return the lowest common ancestor of ``a`` and ``b``, or None if 
+        they are in different trees."""
+        return self.forest.lca(a, b)
+
+
+
 class many_relationship_descriptor(relationship_descriptor):
     PREFIX='REFS'
+    container_class = SetAssociation
+    bounded_container_class = BoundedSetAssociation
+
     def __init__(self, name, target, read_only=False):
         super().__init__(name, target)
 
     def create_container(self, obj):
-        return SetAssociation(obj, self.peer)
+        return self.container_class(obj, self.peer)
                 
     def __get__(self, obj, cls):
         try:
@@ -676,49 +1267,1725 @@ class many_relationship_descriptor(relationship_descriptor):
     associate = SetAssociator.associate
     dissociate = SetAssociator.dissociate
 
+    def flush(self):
+        """Apply the pending updates of a lazy relationship endpoint.
+
+        The updates made through the peer endpoint are logged by a lazy 
+        endpoint, and applied in batch when the endpoint is next read, or 
+        when this method is called.
+        """
+        if not self.log:
+            return
+        # the log is a flat list of (own, other, linked) triples, to avoid 
+        # keeping a tuple per update alive
+        log = self.log
+        self.log = []
+        owns, others, linkeds = log[0::3], log[1::3], log[2::3]
+        slot = self.attr_name
+
+        def container(own):
+            try:
+                return getattr(own, slot)
+            except AttributeError:
+                coll = self.create_container(own)
+                setattr(own, slot, coll)
+                return coll
+
+        if all(linkeds):
+            # only insertions: one bulk insertion per object
+            groups = defaultdict(list)
+            for own, other in zip(owns, others):
+                groups[own].append(other)
+            create = self.create_container
+            for own, values in groups.items():
+                try:
+                    coll = getattr(own, slot)
+                except AttributeError:
+                    coll = create(own)
+                    setattr(own, slot, coll)
+                    coll.link_many(list(dict.fromkeys(values)))
+                else:
+                    coll.link_many([x for x in dict.fromkeys(values) if x not in coll])
+        else:
+            for own, other, linked in zip(owns, others, linkeds):
+                coll = container(own)
+                if linked:
+                    if other not in coll:
+                        coll.link(other)
+                elif other in coll:
+                    coll.unlink(other)
+
     
 class ordered_relationship_descriptor(many_relationship_descriptor):
     PREFIX='REF_LIST'
+    container_class = OrderedAssociation
+    bounded_container_class = BoundedOrderedAssociation
+
     def __init__(self, name, target, read_only=False, assoc_index=None):
         super().__init__(name, target, read_only)
         self.association_index = assoc_index
-    
-    def create_container(self, obj):
-        return OrderedAssociation(obj, self.peer)
 
     associate = OrderedAssociator.associate
     dissociate = OrderedAssociator.dissociate
 
+
+
+class plain_storage:
+    """Mixin for relationship descriptors which keep the storage of each object
+    in a plain container (of type ``storage_class``), stored on the object,
+    instead of in an association container.
+
+    Iteration is done over copy-on-write snapshots, as in 
+    :py:class:`SetAssociation`; the reader counts are kept by the descriptor,
+    for the objects which are currently iterated. The ``version`` of the 
+    descriptor is incremented whenever a link is added or removed.
+    """
+    storage_class = set
+    version = 0
+
+    def initialize(self, peer):
+        # the methods of these classes are generic, observers are checked at runtime
+        self.peer = peer
+
+    def neighbours(self, obj):
+        """Return the storage of ``obj``. It must not be modified."""
+        try:
+            return getattr(obj, self.attr_name)
+        except AttributeError:
+            store = self.storage_class()
+            setattr(obj, self.attr_name, store)
+            return store
+
+    def writable(self, obj):
+        """Return the storage of ``obj`` for modification, copying it first 
+        if it is being iterated."""
+        store = self.neighbours(obj)
+        if obj in self.readers:
+            del self.readers[obj]
+            store = self.storage_class(store)
+            setattr(obj, self.attr_name, store)
+        return store
+
+    def snapshot(self, obj):
+        """Return an iterator over the current neighbours of ``obj``."""
+        it = self._iterate(obj, self.neighbours(obj))
+        next(it)
+        return it
+
+    def _iterate(self, obj, store):
+        # started by snapshot(), as in SetAssociation
+        self.readers[obj] = self.readers.get(obj, 0) + 1
+        try:
+            yield
+            yield from store
+        finally:
+            # if the storage was copied, our reader no longer counts
+            if getattr(obj, self.attr_name) is store:
+                n = self.readers[obj] - 1
+                if n:
+                    self.readers[obj] = n
+                else:
+                    del self.readers[obj]
+
+
+
+class adjacency_relationship_descriptor(many_relationship_descriptor):
+    """The descriptor of an adjacency: a symmetric MANY relationship with
+    compact storage.
+
+    The descriptor numbers the objects which have neighbours, in ``nodes``
+    (a list mapping each id to its object, where the ids of objects which 
+    lost all their neighbours are reused), and each object holds an 
+    :py:class:`AdjacencyAssociation` with the sorted array of the ids of 
+    its neighbours. An edge thus takes two array items (of ``typecode``, 4 
+    bytes by default) instead of two entries in the hash tables of two 
+    containers. Objects are referenced by ``nodes`` while they have 
+    neighbours.
+
+    An edge is inserted or removed by one call to :py:meth:`connect` or 
+    :py:meth:`disconnect`, which updates both ends, instead of a pair of 
+    associate/dissociate calls. The ``version`` of the descriptor is 
+    incremented whenever an edge is added or removed.
+    """
+    PREFIX='REFS'
+    container_class = AdjacencyAssociation
+    bounded_container_class = AdjacencyAssociation
+    typecode = 'i'
+
+    def __init__(self, name, target, read_only=False):
+        super().__init__(name, target, read_only)
+        self.nodes = []
+        self.free = []
+        self.version = 0
+
+    def initialize(self, peer):
+        # the methods of this class are generic, observers are checked at runtime
+        assert peer is self
+        self.peer = peer
+
+    def create_container(self, obj):
+        return AdjacencyAssociation(obj, self)
+
+    def __get__(self, obj, cls):
+        try:
+            return getattr(obj, self.attr_name)
+        except AttributeError:
+            if obj is None:
+                return self
+            coll = AdjacencyAssociation(obj, self)
+            setattr(obj, self.attr_name, coll)
+            return coll
+
+    def __set__(self, obj, val):
+        self.__get__(obj, None).assign(val)
+
+    def neighbours(self, obj):
+        """Return a list of the neighbours of ``obj``."""
+        coll = getattr(obj, self.attr_name, None)
+        return [] if coll is None else list(map(self.nodes.__getitem__, coll.ids))
+
+    def _number(self, coll):
+        # give an id to the owner of coll
+        if self.free:
+            coll.node = self.free.pop()
+            self.nodes[coll.node] = coll.owner
+        else:
+            coll.node = len(self.nodes)
+            self.nodes.append(coll.owner)
+
+    def _release(self, coll):
+        # take back the id of the owner of coll, which has no neighbours
+        self.nodes[coll.node] = None
+        self.free.append(coll.node)
+        coll.node = -1
+
+    def connect(self, a, b):
+        """Add the edge between ``a`` and ``b``, if it does not exist."""
+        self.validate_object(a)
+        self.validate_object(b)
+        ca = self.__get__(a, None)
+        cb = self.__get__(b, None)
+        if ca.node >= 0 and cb.node >= 0 and _sorted_find(ca.ids, cb.node) >= 0:
+            return
+        if self.max is not None and (len(ca.ids) >= self.max or len(cb.ids) >= self.max):
+            raise AssociationCardinalityError("association cannot hold more than %d objects" % self.max)
+        if ca.node < 0:
+            self._number(ca)
+        if cb.node < 0:
+            self._number(cb)
+        self.version += 1
+        insort(ca.ids, cb.node)
+        if a is not b:
+            insort(cb.ids, ca.node)
+        for notify in self.observers: notify(a, b, True)
+
+    def disconnect(self, a, b):
+        """Remove the edge between ``a`` and ``b``, if it exists."""
+        ca = getattr(a, self.attr_name, None)
+        cb = getattr(b, self.attr_name, None)
+        if ca is None or cb is None or ca.node < 0 or cb.node < 0:
+            return
+        pos = _sorted_find(ca.ids, cb.node)
+        if pos < 0:
+            return
+        self.version += 1
+        del ca.ids[pos]
+        if a is not b:
+            del cb.ids[_sorted_find(cb.ids, ca.node)]
+            if not cb.ids:
+                self._release(cb)
+        if not ca.ids:
+            self._release(ca)
+        for notify in self.observers: notify(a, b, False)
+
+    # both ends are maintained in one call
+    associate = connect
+    dissociate = disconnect
+
+
+
+class EdgeTable:
+    """The payload storage of an edge relationship.
+
+    Edges are numbered, and each payload field is stored in a column indexed
+    by the edge number: a list, or a typed ``array.array`` if the field is
+    given with a typecode (e.g., ``{'weight':'d', 'label':None}``). The 
+    numbers of removed edges are reused.
+    """
+
+    def __init__(self, fields=()):
+        if isinstance(fields, dict):
+            spec = list(fields.items())
+        else:
+            spec = [(f, None) for f in fields]
+        self.fields = tuple(f for f,tc in spec)
+        self.columns = [[] if tc is None else array(tc) for f,tc in spec]
+        self.defaults = [None if tc is None else 0 for f,tc in spec]
+        self.record_class = namedtuple('payload', self.fields)
+        self.free = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size - len(self.free)
+
+    def _values(self, payload):
+        values = [payload.pop(f, d) for f,d in zip(self.fields, self.defaults)]
+        if payload:
+            raise TypeError("unknown payload fields: {0}".format(', '.join(payload)))
+        return values
+
+    def new(self, payload, reuse=True):
+        """Allocate an edge with the given payload dict and return its number.
+
+        If ``reuse`` is false, the number of a removed edge is not reused.
+        """
+        values = self._values(dict(payload))
+        if reuse and self.free:
+            eid = self.free.pop()
+            for col,v in zip(self.columns, values):
+                col[eid] = v
+        else:
+            eid = self.size
+            for col,v in zip(self.columns, values):
+                col.append(v)
+            self.size += 1
+        return eid
+
+    def delete(self, eid):
+        """Release the number of a removed edge."""
+        self.free.append(eid)
+
+    def record(self, eid):
+        """Return the payload of an edge, as a named tuple."""
+        return self.record_class(*[col[eid] for col in self.columns])
+
+    def update(self, eid, payload):
+        """Update some payload fields of an edge, from a dict."""
+        for f,v in payload.items():
+            try:
+                col = self.columns[self.fields.index(f)]
+            except ValueError:
+                raise TypeError("unknown payload field: {0}".format(f))
+            col[eid] = v
+
+
+
+class edge_relationship_descriptor(plain_storage, relationship_descriptor):
+    """The descriptor of an edge relationship: a MANY relationship whose 
+    links carry a small payload.
+
+    The two peers of the relationship share an :py:class:`EdgeTable` for the
+    payloads. Each object keeps a plain dict, mapping its neighbours to edge
+    numbers; accessing the relationship returns a transient 
+    :py:class:`EdgeAssociation`. A link is established or removed by one call
+    to :py:meth:`connect` or :py:meth:`disconnect`, which updates both ends.
+    """
+    PREFIX='EDGES'
+    storage_class = dict
+
+    def __init__(self, name, target, fields=(), read_only=False):
+        super().__init__(name, target)
+        self.fields = fields
+        self.table = None
+        self.readers = {}
+
+    def initialize(self, peer):
+        self.peer = peer
+        if self.table is None:
+            self.table = peer.table if peer.table is not None else EdgeTable(self.fields)
+
+    def create_container(self, obj):
+        return EdgeAssociation(obj, self.peer)
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        return EdgeAssociation(obj, self.peer)
+
+    def __set__(self, obj, val):
+        EdgeAssociation(obj, self.peer).assign(val)
+
+    def connect(self, own, other, **payload):
+        """Link ``own`` to ``other``, with the given payload values. If the
+        link exists, its payload is updated."""
+        self.validate_object(other)
+        mine = self.neighbours(own)
+        eid = mine.get(other)
+        if eid is not None:
+            if payload:
+                self.table.update(eid, payload)
+            return
+        peer = self.peer
+        theirs = peer.neighbours(other)
+        if self.max is not None and len(mine) >= self.max:
+            raise AssociationCardinalityError("association cannot hold more than %d objects" % self.max)
+        if peer.max is not None and own not in theirs and len(theirs) >= peer.max:
+            raise AssociationCardinalityError("association cannot hold more than %d objects" % peer.max)
+        # do not reuse edge numbers while a snapshot may still refer to them
+        eid = self.table.new(payload, not (self.readers or peer.readers))
+        if self.readers:
+            mine = self.writable(own)
+        if peer.readers:
+            theirs = peer.writable(other)
+        self.version += 1
+        peer.version += 1
+        mine[other] = eid
+        theirs[own] = eid
+        for notify in self.observers: notify(own, other, True)
+
+    def disconnect(self, own, other):
+        """Remove the link between ``own`` and ``other``, if it exists."""
+        mine = self.neighbours(own)
+        eid = mine.get(other)
+        if eid is None:
+            return
+        if self.readers:
+            mine = self.writable(own)
+        self.version += 1
+        self.peer.version += 1
+        del mine[other]
+        if not (own is other and self.peer is self):
+            del self.peer.writable(other)[own]
+        self.table.delete(eid)
+        for notify in self.observers: notify(own, other, False)
+
+    def payload(self, own, other):
+        """Return the payload of the link between ``own`` and ``other``."""
+        return self.table.record(self.neighbours(own)[other])
+
+    def update(self, own, other, **payload):
+        """Update the payload of the link between ``own`` and ``other``."""
+        self.table.update(self.neighbours(own)[other], payload)
+
+    # both ends are maintained in one call
+    associate = connect
+    dissociate = disconnect
+
+
+
+def relationship_descriptor_class(desc):
+    """Return a specially compiled subclass of ``desc.generic_class``, for an 
+    initialized relationship descriptor.
+
+    The generated class hard-wires the storage names of both sides, the kind
+    of the peer, the symmetric-relationship checks, the content type and the
+    maximum cardinality of both sides. Notification of observers is only
+    compiled in if the descriptor has observers.
+    """
+    peer = desc.peer
+    assert isinstance(peer, relationship_descriptor)
+
+    GENERIC = desc.generic_class
+    CONTENT_TYPE = desc.content_type
+    PEER = peer
+
+    name = desc.name
+    one = isinstance(desc, one_relationship_descriptor)
+    read_only = desc.read_only
+    symmetric = peer is desc
+    observed = bool(desc.observers)
+    slot = desc.attr_name
+    peer_slot = peer.attr_name
+    peer_one = isinstance(peer, one_relationship_descriptor)
+    lazy = desc.lazy
+    peer_lazy = peer.lazy
+    tree = isinstance(desc, tree_relationship_descriptor)
+    if tree:
+        FOREST = desc.forest
+
+    def container_spec(d):
+        # return the container class and the extra constructor arguments
+        if d.max is None:
+            return d.container_class, ""
+        else:
+            return d.bounded_container_class, ", %d" % d.max
+
+    if not one:
+        CONTAINER, container_args = container_spec(desc)
+    if isinstance(desc, ordered_relationship_descriptor) and desc.association_index is not None:
+        link_args = ", %d" % desc.association_index
+    else:
+        link_args = ""
+    if isinstance(peer, ordered_relationship_descriptor) and peer.association_index is not None:
+        peer_link_args = ", %d" % peer.association_index
+    else:
+        peer_link_args = ""
+    PEER_MAX = None
+    if not peer_one:
+        PEER_CONTAINER, peer_container_args = container_spec(peer)
+        PEER_MAX = peer.max
+
+    template_text = """
+class {{name}}_relationship_descriptor(GENERIC):
+
+% if one:
+    def __get__(self, obj, cls):
+        try:
+            return obj.{{slot}}
+        except AttributeError:
+            if obj is None:
+                return self
+            obj.{{slot}} = None
+            return None
+
+    % if read_only:
+    def __set__(self, obj, value):
+        raise AttributeError("Relationship endpoint is read-only")
+    % else:
+    def __set__(self, obj, value):
+        if value is not None and not isinstance(value, CONTENT_TYPE):
+            raise ValueError("An instance of {0} is expected".format(CONTENT_TYPE))
+        try:
+            old = obj.{{slot}}
+        except AttributeError:
+            old = None
+        if old is value:
+            return
+        % if tree:
+        if value is not None and FOREST.is_ancestor(obj, value):
+            raise AssociationCycleError("object {0} is an ancestor of {1}".format(obj, value))
+        % end
+        % if observed and peer_one:
+        vold = None
+        % end
+        % if PEER_MAX is not None:
+        if value is not None:
+            try:
+                coll = value.{{peer_slot}}
+            except AttributeError:
+                pass
+            else:
+                if len(coll) >= PEER_MAX:
+                    raise AssociationCardinalityError("association cannot hold more than {{PEER_MAX}} objects")
+        % end
+        if old is not None:
+        % if peer_one:
+            old.{{peer_slot}} = None
+        % elif peer_lazy:
+            PEER.log.extend((old, obj, False))
+        % else:
+            old.{{peer_slot}}.unlink(obj)
+        % end
+        obj.{{slot}} = value
+        % if symmetric:
+        if value is not None and value is not obj:
+        % else:
+        if value is not None:
+        % end
+        % if peer_one:
+            try:
+                vold = value.{{peer_slot}}
+            except AttributeError:
+                vold = None
+            if vold is not None:
+                vold.{{slot}} = None
+            value.{{peer_slot}} = obj
+        % elif peer_lazy:
+            PEER.log.extend((value, obj, True))
+        % else:
+            try:
+                coll = value.{{peer_slot}}
+            except AttributeError:
+                coll = value.{{peer_slot}} = PEER_CONTAINER(value, self{{peer_container_args}})
+            coll.link(obj{{peer_link_args}})
+        % end
+        % if tree:
+        if old is not None:
+            FOREST.cut(obj)
+        if value is not None:
+            FOREST.link(obj, value)
+        % end
+        % if observed:
+        # notify after all updates are done
+        if old is not None:
+            for notify in self.observers: notify(obj, old, False)
+        if value is not None:
+            % if peer_one:
+            if vold is not None:
+                for notify in self.observers: notify(vold, value, False)
+            % end
+            for notify in self.observers: notify(obj, value, True)
+        % end
+    % end
+
+    def associate(self, own, other):
+        try:
+            old = own.{{slot}}
+        except AttributeError:
+            old = None
+        if old is not None and old is not other:
+        % if peer_one:
+            old.{{peer_slot}} = None
+        % elif peer_lazy:
+            PEER.log.extend((old, own, False))
+        % else:
+            old.{{peer_slot}}.unlink(own)
+        % end
+        own.{{slot}} = other
+        % if tree:
+        if old is not other:
+            if old is not None:
+                FOREST.cut(own)
+            FOREST.link(own, other)
+        % end
+        % if observed:
+        if old is not None and old is not other:
+            for notify in self.observers: notify(own, old, False)
+        for notify in self.observers: notify(own, other, True)
+        % end
+
+    def dissociate(self, own, other):
+        own.{{slot}} = None
+        % if tree:
+        FOREST.cut(own)
+        % end
+        % if observed:
+        for notify in self.observers: notify(own, other, False)
+        % end
+
+% else:
+    % if lazy:
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        if self.log:
+            self.flush()
+        try:
+            return obj.{{slot}}
+        except AttributeError:
+            coll = obj.{{slot}} = CONTAINER(obj, PEER{{container_args}})
+            return coll
+    % else:
+    def __get__(self, obj, cls):
+        try:
+            return obj.{{slot}}
+        except AttributeError:
+            if obj is None:
+                return self
+            coll = obj.{{slot}} = CONTAINER(obj, PEER{{container_args}})
+            return coll
+    % end
+
+    def __set__(self, obj, value):
+    % if lazy:
+        if self.log:
+            self.flush()
+    % end
+        try:
+            coll = obj.{{slot}}
+        except AttributeError:
+            coll = obj.{{slot}} = CONTAINER(obj, PEER{{container_args}})
+        coll.assign(value)
+
+    def create_container(self, obj):
+        return CONTAINER(obj, PEER{{container_args}})
+
+    % if lazy:
+    def associate(self, own, other):
+        self.log.extend((own, other, True))
+    % if observed:
+        for notify in self.observers: notify(own, other, True)
+    % end
+
+    def dissociate(self, own, other):
+        self.log.extend((own, other, False))
+    % if observed:
+        for notify in self.observers: notify(own, other, False)
+    % end
+    % else:
+    def associate(self, own, other):
+    % if symmetric:
+        if own is other:
+        % if observed:
+            for notify in self.observers: notify(own, other, True)
+        % end
+            return
+    % end
+        try:
+            coll = own.{{slot}}
+        except AttributeError:
+            coll = own.{{slot}} = CONTAINER(own, PEER{{container_args}})
+        coll.link(other{{link_args}})
+    % if observed:
+        for notify in self.observers: notify(own, other, True)
+    % end
+
+    def dissociate(self, own, other):
+    % if symmetric:
+        if own is other:
+        % if observed:
+            for notify in self.observers: notify(own, other, False)
+        % end
+            return
+    % end
+        own.{{slot}}.unlink(other)
+    % if observed:
+        for notify in self.observers: notify(own, other, False)
+    % end
+    % end
+
+% end
+    def validate_object(self, obj):
+        if obj is None:
+            raise AssociationNoneError("cannot establish association with None")
+        if not isinstance(obj, CONTENT_TYPE):
+            raise AssociationTypeError("object {0} is not a instance of {1}".format(obj, CONTENT_TYPE))
+% if PEER_MAX is not None:
+        try:
+            coll = obj.{{peer_slot}}
+        except AttributeError:
+            pass
+        else:
+            if len(coll) >= PEER_MAX:
+                raise AssociationCardinalityError("association cannot hold more than {{PEER_MAX}} objects")
+% end
+"""
+    from bottle import template
+    source = template(template_text, locals(), template_settings={'noescape':True})
+    names = dict(globals())
+    names.update(locals())
+    exec(source, names)
+    return names[name+"_relationship_descriptor"]
+
+    
+
+#
+#  Rewiring primitives
+#
+
+def _check_link(desc, obj, value):
+    # Check that ``obj`` can be linked to ``value`` via the ONE descriptor ``desc``,
+    # without changing anything.
+    if value is None:
+        return
+    if not isinstance(value, desc.content_type):
+        raise ValueError("An instance of {0} is expected".format(desc.content_type))
+    peer = desc.peer
+    if peer.max is not None and not isinstance(peer, one_relationship_descriptor):
+        coll = peer.__get__(value, None)
+        if obj not in coll and len(coll) >= peer.max:
+            raise AssociationCardinalityError("association cannot hold more than %d objects" % peer.max)
+
+
+def swap(obj, name1, name2):
+    """Exchange the values of two ONE relationships of ``obj``.
+
+    Both new values are validated before anything is changed, so that the
+    operation either completes or leaves ``obj`` untouched. Each side is then
+    updated once, e.g., flipping an edge ``swap(edge, 'source', 'destination')``
+    performs exactly one unlink and one link on the container of each vertex.
+    """
+    cls = type(obj)
+    d1 = getattr(cls, name1, None)
+    d2 = getattr(cls, name2, None)
+    if not (isinstance(d1, one_relationship_descriptor) and isinstance(d2, one_relationship_descriptor)):
+        raise TypeError("swap() requires two ONE relationships")
+    v1 = d1.__get__(obj, cls)
+    v2 = d2.__get__(obj, cls)
+    if v1 is v2:
+        return
+    _check_link(d1, obj, v2)
+    _check_link(d2, obj, v1)
+    d1.__set__(obj, v2)
+    d2.__set__(obj, v1)
+
+
+def _check_move(item, target, desc):
+    # raise the errors that adding item to target would raise, before item
+    # is removed from source
+    if item in target:
+        raise AssociationDuplicateError("cannot have duplicates in an association")
+    capacity = getattr(desc, 'max', None)
+    if capacity is not None and len(target) >= capacity:
+        raise AssociationCardinalityError("association cannot hold more than %d objects" % capacity)
+    # the type and the capacity of the peer side are checked by the descriptor
+    desc.validate_object(item)
+    if isinstance(desc.peer, tree_relationship_descriptor):
+        desc.peer.check_link(item, target.owner)
+
+
+def move(item, source, target, index=None):
+    """Move ``item`` from association container ``source`` to association
+    container ``target``, at position ``index`` if ``target`` is ordered
+    (by default, at the end).
+
+    If both containers belong to the same relationship endpoint, the item is
+    moved without dissociating it: its peer side is re-pointed directly, and 
+    observers see one removal and one addition. If ``source`` is ``target``,
+    the item is just repositioned and the peer side is not touched at all.
+    """
+    if item not in source:
+        raise ValueError("object {0} is not in the source container".format(item))
+    ordered = isinstance(target, OrderedAssociation)
+
+    if source is target:
+        if ordered:
+            source.unlink(item)
+            source.link(item, index)
+        return
+
+    desc = target.peer_associator.peer
+    if source.peer_associator is not target.peer_associator or desc.peer is desc:
+        # different (or symmetric) relationships: check everything that
+        # the association may fail on first, then dissociate and associate
+        _check_move(item, target, desc)
+        if isinstance(source, OrderedAssociation):
+            source.remove(item)
+        else:
+            source.discard(item)
+        if ordered:
+            target.insert(len(target) if index is None else index, item)
+        else:
+            target.add(item)
+        return
+
+    if isinstance(desc.peer, tree_relationship_descriptor):
+        # re-parent through the tree endpoint, which checks for cycles
+        desc.peer.__set__(item, target.owner)
+        return
+
+    if not isinstance(item, desc.content_type):
+        raise AssociationTypeError("object {0} is not a instance of {1}".format(item, desc.content_type))
+    if item in target:
+        raise AssociationDuplicateError("cannot have duplicates in an association")
+
+    # same relationship: re-point the peer side directly
+    if ordered:
+        target.link(item, index)     # may raise for a full container
+    else:
+        target.link(item)
+    source.unlink(item)
+
+    peer = desc.peer
+    if isinstance(peer, one_relationship_descriptor):
+        setattr(item, peer.attr_name, target.owner)
+    else:
+        coll = peer.__get__(item, None)
+        coll.unlink(source.owner)
+        coll.link(target.owner)
+
+    for notify in desc.observers:
+        notify(source.owner, item, False)
+        notify(target.owner, item, True)
+
+
+def replace(container, old, new):
+    """Replace ``old`` by ``new`` in an association container.
+
+    The new object is validated before anything is changed. In an ordered
+    container, ``new`` takes the position of ``old``.
+    """
+    if isinstance(container, OrderedAssociation):
+        container[container.index(old)] = new
+        return
+    if old not in container:
+        raise KeyError(old)
+    if new is old:
+        return
+    if new in container:
+        raise AssociationDuplicateError("cannot have duplicates in an association")
+    container.peer_associator.peer.validate_object(new)
+    container.discard(old)
+    container.add(new)
+
+
+#
+#  Bulk loading
+#
+
+def _as_list(seq):
+    # sequences, including numpy arrays, to lists
+    if hasattr(seq, 'tolist'):
+        return seq.tolist()
+    return list(seq)
+
+
+def _check_types(objs, content_type):
+    # validate once per distinct type
+    for t in set(map(type, objs)):
+        if not issubclass(t, content_type):
+            bad = next(x for x in objs if type(x) is t)
+            if bad is None:
+                raise AssociationNoneError("cannot establish association with None")
+            raise AssociationTypeError("object {0} is not a instance of {1}".format(bad, content_type))
+
+
+def _check_groups(desc, groups):
+    # check that the objects of ``groups[obj]`` can be linked to ``obj`` via
+    # ``desc``: no duplicates, no existing links, no cardinality overflow
+    one = isinstance(desc, one_relationship_descriptor)
+    limit = 1 if one else desc.max
+    for obj, values in groups.items():
+        if len(values) > 1 and len(set(values)) < len(values):
+            dup = next(x for x,n in Counter(values).items() if n > 1)
+            raise AssociationDuplicateError("link between {0} and {1} is repeated".format(obj, dup))
+        current = desc.__get__(obj, None)
+        if one:
+            have = 0 if current is None else 1
+            if current in values:
+                raise AssociationDuplicateError("link between {0} and {1} already exists".format(obj, current))
+        else:
+            have = len(current)
+            if have:
+                for x in values:
+                    if x in current:
+                        raise AssociationDuplicateError("link between {0} and {1} already exists".format(obj, x))
+        if limit is not None and have + len(values) > limit:
+            raise AssociationCardinalityError("{0} would be associated with more than {1} objects via '{2}'"
+                                              .format(obj, limit, desc.name))
+
+
+def _group_handles(np, keys, values, objs):
+    # group the objects of handles ``values`` by the handles ``keys``
+    # (integer arrays), as a dict from object to list of objects
+    order = np.argsort(keys, kind='stable')
+    k = keys[order]
+    v = objs[values[order]].tolist()
+    starts = np.flatnonzero(np.diff(k, prepend=-1)).tolist()
+    ends = starts[1:] + [len(v)]
+    owners = objs[k[starts]].tolist()
+    return dict(zip(owners, map(v.__getitem__, map(slice, starts, ends))))
+
+
+def _handle_side(np, desc, keys, values, objs):
+    # check the links of handles ``keys`` to handles ``values`` via ``desc``
+    # (as _check_groups, for links which are not repeated), and return them
+    # grouped per object; for a ONE relationship, each object is mapped to
+    # its single value
+    if isinstance(desc, one_relationship_descriptor):
+        counts = np.bincount(keys)
+        if len(counts) and counts.max() > 1:
+            h = int(np.argmax(counts > 1))
+            _check_groups(desc, {objs[h]: objs[values[keys == h]].tolist()})
+        groups = dict(zip(objs[keys].tolist(), objs[values].tolist()))
+        current = map(getattr, groups, repeat(desc.attr_name), repeat(None))
+        suspect = [obj for obj, c in zip(groups, current) if c is not None]
+        if suspect:
+            _check_groups(desc, {obj: [groups[obj]] for obj in suspect})
+        return groups
+
+    groups = _group_handles(np, keys, values, objs)
+    # only the objects which are already linked, or which overflow, are
+    # checked one by one
+    owners = list(groups)
+    if not desc.lazy and not isinstance(desc, plain_storage):
+        current = map(getattr, owners, repeat(desc.attr_name), repeat(None))
+    else:
+        current = [desc.__get__(obj, None) for obj in owners]
+    limit = desc.max
+    suspect = [obj for obj, c in zip(owners, current)
+               if c or (limit is not None and len(groups[obj]) > limit)]
+    if suspect:
+        _check_groups(desc, {obj: groups[obj] for obj in suspect})
+    return groups
+
+
+def _load_handles(desc, sources, targets, objects):
+    # the vectorized pre-pass of load_edges, for integer handle arrays:
+    # return the lists of objects and the links grouped per object on
+    # each side (the second is None for a symmetric relationship)
+    import numpy as np
+
+    peer = desc.peer
+    src = np.asarray(sources, dtype=np.int64)
+    tgt = np.asarray(targets, dtype=np.int64)
+    if src.shape != tgt.shape:
+        raise ValueError("sources and targets differ in length")
+    objs = np.empty(len(objects), dtype=object)
+    objs[:] = list(objects)
+    _check_types(objs[np.unique(src)].tolist(), peer.content_type)
+    _check_types(objs[np.unique(tgt)].tolist(), desc.content_type)
+
+    # repeated links, as repeated keys of (ordered) pairs of handles
+    symmetric = peer is desc
+    n = len(objs)
+    if symmetric:
+        keys = np.minimum(src, tgt) * n + np.maximum(src, tgt)
+    else:
+        keys = src * n + tgt
+    uniq, counts = np.unique(keys, return_counts=True)
+    if len(uniq) < len(keys):
+        dup = int(uniq[np.argmax(counts > 1)])
+        raise AssociationDuplicateError("link between {0} and {1} is repeated"
+                                        .format(objs[dup // n], objs[dup % n]))
+
+    if symmetric:
+        loops = src == tgt
+        out = _handle_side(np, desc, np.concatenate((src, tgt[~loops])),
+                           np.concatenate((tgt, src[~loops])), objs)
+        inc = None
+    else:
+        out = _handle_side(np, desc, src, tgt, objs)
+        inc = _handle_side(np, peer, tgt, src, objs)
+    return objs[src].tolist(), objs[tgt].tolist(), out, inc
+
+
+def load_edges(desc, sources, targets, objects=None):
+    """Link ``sources[i]`` to ``targets[i]`` via relationship descriptor 
+    ``desc``, for every ``i``, and return the number of links.
+
+    ``sources`` and ``targets`` are sequences (or NumPy arrays) of objects, 
+    or, if ``objects`` is given, of integer handles into ``objects``.
+
+    The whole batch is checked before anything is changed: the types of 
+    the objects are validated once per distinct type, and a pre-pass over
+    the links grouped per object rejects links which are repeated in the 
+    batch or already exist, and links which would exceed the cardinality
+    of either side (including a ONE side which is already set). Then, the
+    containers of both sides are filled directly, one bulk insertion per 
+    object, and the observers (if any) are notified of each link.
+
+    If ``sources`` and ``targets`` are NumPy arrays of handles, the 
+    pre-pass is vectorized: repeated links are found by sorting the 
+    pairs of handles, the links are grouped per object by sorting, and
+    only the objects which already have links, or which would overflow,
+    are checked one by one.
+    """
+    peer = desc.peer
+    if peer is None:
+        raise ValueError("relationship descriptor is not initialized")
+    symmetric = peer is desc
+    # the groups of a ONE side map each object to its value, not to a list
+    single = objects is not None and hasattr(sources, 'dtype') and hasattr(targets, 'dtype')
+    if single:
+        sources, targets, out, inc = _load_handles(desc, sources, targets, objects)
+    else:
+        sources = _as_list(sources)
+        targets = _as_list(targets)
+        if objects is not None:
+            sources = list(map(objects.__getitem__, sources))
+            targets = list(map(objects.__getitem__, targets))
+        if len(sources) != len(targets):
+            raise ValueError("sources and targets differ in length")
+
+        _check_types(sources, peer.content_type)
+        _check_types(targets, desc.content_type)
+
+        # group the links per object, on each side
+        out = defaultdict(list)
+        for s,t in zip(sources, targets):
+            out[s].append(t)
+        if symmetric:
+            for s,t in zip(sources, targets):
+                if s is not t:
+                    out[t].append(s)
+            _check_groups(desc, out)
+        else:
+            inc = defaultdict(list)
+            for s,t in zip(sources, targets):
+                inc[t].append(s)
+            _check_groups(desc, out)
+            _check_groups(peer, inc)
+
+    if isinstance(desc, (plain_storage, adjacency_relationship_descriptor)):
+        for s,t in zip(sources, targets):
+            desc.connect(s, t)
+        return len(sources)
+
+    if isinstance(desc, tree_relationship_descriptor):
+        tree, pairs = desc, zip(sources, targets)
+    elif isinstance(peer, tree_relationship_descriptor):
+        tree, pairs = peer, zip(targets, sources)
+    else:
+        tree = None
+    if tree is not None:
+        # link one by one, to check for cycles; on a cycle, undo the links
+        # (the children had no parent, by the checks above)
+        done = []
+        try:
+            for child, parent in pairs:
+                tree.__set__(child, parent)
+                done.append(child)
+        except AssociationCycleError:
+            for child in done:
+                tree.__set__(child, None)
+            raise
+        return len(sources)
+
+    def fill(d, groups):
+        if isinstance(d, one_relationship_descriptor):
+            slot = d.attr_name
+            if single:
+                for obj, value in groups.items():
+                    setattr(obj, slot, value)
+            else:
+                for obj, values in groups.items():
+                    setattr(obj, slot, values[0])
+        else:
+            for obj, values in groups.items():
+                d.__get__(obj, None).link_many(values)
+
+    fill(desc, out)
+    if not symmetric:
+        fill(peer, inc)
+
+    for notify in desc.observers:
+        for s,t in zip(sources, targets):
+            notify(s, t, True)
+    return len(sources)
+
+
+#
+#  Live filtered views of relationships
+#
+
+class ViewAssociation(SetAssociation):
+    """The read-only container holding the view of a :py:class:`RelationshipView`
+    for a single object.
+    """
+    __slots__=[]
+
+    def add(self, value):
+        raise TypeError("relationship views are read-only")
+
+    def discard(self, value):
+        raise TypeError("relationship views are read-only")
+
+    def clear(self):
+        raise TypeError("relationship views are read-only")
+
+
+_view_serial = count()
+
+class RelationshipView:
+    """A live view of the objects associated to an object via a relationship 
+    endpoint, which satisfy a predicate.
+    
+    The view of an object is computed on first access, by scanning the 
+    relationship, and from then on it is maintained incrementally, by observing
+    the relationship and the features (attributes or relationships) of the 
+    associated objects which are named in ``depends_on``. Reading a view thus
+    takes time proportional to the size of the view, not of the relationship.
     
+    The predicate must only depend on the features named in ``depends_on``.
+    A view which is no longer needed should be closed, by :py:meth:`close`,
+    so that writes to these features stop maintaining it.
+    
+    Example::
+    
+        heavy = Node.out.where(lambda arc: arc.weight > 10, depends_on=['weight'])
+        for arc in heavy(node): ...
+    """
+
+    def __init__(self, desc, predicate, depends_on=()):
+        self.desc = desc
+        self.predicate = predicate
+        self.depends_on = tuple(depends_on)
+        self.slot = "_VIEW_%d" % next(_view_serial)
+        self.owners = []
+        self.observers = []
+
+        features = []
+        for name in self.depends_on:
+            feature = getattr(desc.content_type, name)
+            if isinstance(feature, relationship_descriptor) and feature.peer is feature:
+                features.append((feature, self.member_symmetric_changed))
+            elif isinstance(feature, relationship_descriptor):
+                features.append((feature, self.member_relationship_changed))
+            elif isinstance(feature, attr_descriptor):
+                features.append((feature, self.member_changed))
+            else:
+                raise TypeError("{0} is not an instrumented attribute or relationship".format(name))
+        features.append((desc, self.relationship_changed))
+        for feature, observer in features:
+            feature.observe(observer)
+            self.observers.append((feature, observer))
+
+    def close(self):
+        """Stop maintaining the view, and drop the views of all objects."""
+        for feature, observer in self.observers:
+            feature.unobserve(observer)
+        self.observers = []
+        for obj in self.owners:
+            try:
+                delattr(obj, self.slot)
+            except AttributeError:
+                pass
+        self.owners = []
+
+    def __call__(self, obj):
+        """Return the view of ``obj``, a read-only set."""
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            view = ViewAssociation(obj, None)
+            members = self.desc.__get__(obj, None)
+            if isinstance(self.desc, one_relationship_descriptor):
+                members = () if members is None else (members,)
+            predicate = self.predicate
+            for x in members:
+                if predicate(x):
+                    view.link(x)
+            setattr(obj, self.slot, view)
+            self.owners.append(obj)
+            return view
+
+    def _update(self, owner, member, linked):
+        try:
+            view = getattr(owner, self.slot)
+        except AttributeError:
+            return     # not materialized
+        if linked and self.predicate(member):
+            if member not in view.values:
+                view.link(member)
+        elif member in view.values:
+            view.unlink(member)
+
+    def relationship_changed(self, own, other, linked):
+        self._update(own, other, linked)
+        if self.desc.peer is self.desc and own is not other:
+            self._update(other, own, linked)
+
+    def member_relationship_changed(self, own, other, linked):
+        self.member_changed(own)
+
+    def member_symmetric_changed(self, own, other, linked):
+        self.member_changed(own)
+        if own is not other:
+            self.member_changed(other)
+
+    def member_changed(self, member):
+        owners = self.desc.peer.__get__(member, None)
+        if isinstance(self.desc.peer, one_relationship_descriptor):
+            owners = () if owners is None else (owners,)
+        for owner in owners:
+            self._update(owner, member, True)
+
 
 #
 #  Transitive closure implementation
 #
 
 
-def transitive_closure(seed, nupath, CHECK=False):
-    if isinstance(nupath, RelationshipEndpoint):
-        nupath = (nupath,)
+def transitive_closure(seed, nupath, CHECK=False, max_depth=None, node=None, 
+                       edge=None, prune=None, limit=None):
+    """Return an iterator over the objects reachable from the objects in 
+    ``seed`` by repetitions of the relationship path ``nupath`` (including 
+    the seed objects).
+
+    The path is a relationship endpoint (of :py:mod:`~modeling.mf`) or an
+    instrumented relationship descriptor, or a sequence of them. The
+    traversal is done by the compiled function of :py:func:`compile_path`.
+
+    The traversal can be restricted by the following options, which are
+    evaluated as it proceeds:
+
+    - ``max_depth``: objects farther than this number of repetitions of 
+      the path are not reached.
+    - ``node(obj)``: only objects (at any step of the path) for which 
+      this predicate is true are visited.
+    - ``edge(obj, other)``: a link is followed only if this predicate
+      is true.
+    - ``prune(obj)``: objects for which this predicate is true are 
+      visited, but the traversal does not proceed beyond them.
+    - ``limit``: the traversal stops after this number of objects.
 
-    if CHECK:  # maybe we should allow other kinds of sequence?
-        assert isinstance(nupath, (tuple, list))
+    When any option is given, the traversal is breadth-first (see 
+    :py:func:`restricted_closure`).
+    """
+    if not isinstance(nupath, (tuple, list)):
+        nupath = (nupath,)
 
     if len(nupath)==0:
         return seed
 
-    next = [(i+1) % len(nupath) for i in range(len(nupath))]
-
     if CHECK:  # other checks
-        assert all(isinstance(rel, RelationshipEndpoint) for rel in nupath)
-        for i in range(nupath):
-            r1 = nupath[i]
-            r2 = nupath[next[i]]
-            assert r1.target is r2.owner
+        from .mf import RelationshipEndpoint
+        if all(isinstance(rel, RelationshipEndpoint) for rel in nupath):
+            for i in range(len(nupath)):
+                r1 = nupath[i]
+                r2 = nupath[(i+1) % len(nupath)]
+                assert r1.target is r2.owner
+
+    if max_depth is None and node is None and edge is None and prune is None and limit is None:
+        return compile_path(nupath)(seed)
+    return restricted_closure(seed, _path_descriptors(nupath), max_depth, node, edge, prune, limit)
+
+
+def restricted_closure(seed, descs, max_depth=None, node=None, edge=None, prune=None, limit=None):
+    """Return an iterator over the objects reachable from ``seed`` via a
+    path of relationship descriptors, in breadth-first order, restricted 
+    by the options of :py:func:`transitive_closure`.
+    """
+    succ = path_successors(descs)
+    k = len(descs)
+    if limit is not None and limit <= 0:
+        return
+    count = 0
+
+    seen = set()
+    frontier = []
+    for s in seed:
+        if (s, 0) not in seen:
+            seen.add((s, 0))
+            if node is None or node(s):
+                frontier.append((s, 0))
+
+    depth = 0
+    while frontier:
+        last = max_depth is not None and depth == max_depth*k
+        layer = []
+        for x, i in frontier:
+            if i == 0:
+                yield x
+                count += 1
+                if count == limit:
+                    return
+            if last or (prune is not None and prune(x)):
+                continue
+            j = (i+1) % k
+            for y in succ(x, i):
+                if (y, j) in seen:
+                    continue
+                if edge is not None and not edge(x, y):
+                    continue
+                seen.add((y, j))
+                if node is None or node(y):
+                    layer.append((y, j))
+        frontier = layer
+        depth += 1
 
-    one = [rel.kind == RelKind.ONE for rel in nupath]
-    name = [rel.name for rel in nupath]
 
-    return unchecked_transitive_closure_n(seed, name, one)
+#
+#  Compiled traversal plans
+#
+
+_path_cache = {}
+
+
+def _path_descriptor(rel):
+    # the instrumented descriptor of a relationship endpoint
+    if isinstance(rel, relationship_descriptor):
+        return rel
+    from .mf import python_type
+    return getattr(python_type.get(rel.owner).type, rel.name)
+
+
+def compile_path(rel_seq):
+    """Return the compiled closure function of a relationship path.
+
+    ``rel_seq`` is a relationship descriptor or endpoint, or a sequence 
+    of them. The returned generator function takes an iterable of seed 
+    objects and yields the objects reachable from them by repetitions of
+    the path, as :py:func:`transitive_closure` does. 
+    
+    The function is generated once per path and cached. It reads the 
+    storage slots of the relationships directly, with a specialized loop
+    per step of the path. Lazy relationship endpoints are flushed before 
+    they are read.
+    """
+    if not isinstance(rel_seq, (tuple, list)):
+        rel_seq = (rel_seq,)
+    descs = tuple(_path_descriptor(rel) for rel in rel_seq)
+    try:
+        return _path_cache[descs]
+    except KeyError:
+        pass
+    if not descs:
+        raise ValueError("empty relationship path")
+    func = path_closure_function(descs)
+    _path_cache[descs] = func
+    return func
+
+
+def path_closure_function(descs):
+    """Generate the closure function of a path of relationship descriptors
+    (see :py:func:`compile_path`)."""
+
+    # one step per descriptor: (kind, slot, storage suffix, lazy, next step)
+    steps = []
+    for i, desc in enumerate(descs):
+        if desc.peer is None:
+            raise ValueError("relationship descriptor {0} is not initialized".format(desc.name))
+        nxt = (i+1) % len(descs)
+        if isinstance(desc, one_relationship_descriptor):
+            steps.append(('one', desc.attr_name, '', False, nxt))
+        elif isinstance(desc, adjacency_relationship_descriptor):
+            steps.append(('ids', desc.attr_name, '.ids', False, nxt))
+        elif isinstance(desc, plain_storage):
+            steps.append(('many', desc.attr_name, '', False, nxt))
+        elif issubclass(desc.container_class, OrderedAssociation):
+            steps.append(('many', desc.attr_name, '.seq', desc.lazy, nxt))
+        else:
+            steps.append(('many', desc.attr_name, '.elements', desc.lazy, nxt))
+
+    name = "closure_" + "_".join(desc.name for desc in descs)
+    any_pending = " or ".join("stack%d" % i for i in range(len(steps)))
+
+    template_text = """
+def {{name}}(seed):
+% for i in range(len(steps)):
+    seen{{i}} = set()
+    stack{{i}} = []
+% end
+    for s in seed:
+        stack0.append(s)
+        while {{any_pending}}:
+% for i, (kind, slot, suffix, lazy, nxt) in enumerate(steps):
+            while stack{{i}}:
+                x = stack{{i}}.pop()
+                if x in seen{{i}}:
+                    continue
+                seen{{i}}.add(x)
+    % if i == 0:
+                yield x
+    % end
+    % if lazy:
+                if D{{i}}.log:
+                    D{{i}}.flush()
+    % end
+    % if kind == 'one':
+                try:
+                    y = x.{{slot}}
+                except AttributeError:
+                    continue
+                if y is not None:
+                    stack{{nxt}}.append(y)
+    % elif kind == 'ids':
+                try:
+                    stack{{nxt}}.extend(map(N{{i}}, x.{{slot}}{{suffix}}))
+                except AttributeError:
+                    pass
+    % else:
+                try:
+                    stack{{nxt}}.extend(x.{{slot}}{{suffix}})
+                except AttributeError:
+                    pass
+    % end
+% end
+"""
+    from bottle import template
+    source = template(template_text, locals(), template_settings={'noescape':True})
+    names = dict(globals())
+    names.update(("D%d" % i, desc) for i, desc in enumerate(descs))
+    names.update(("N%d" % i, desc.nodes.__getitem__) for i, desc in enumerate(descs)
+                 if isinstance(desc, adjacency_relationship_descriptor))
+    exec(source, names)
+    return names[name]
+
+
+#
+#  Breadth-first traversals and shortest paths
+#
+
+
+def associated(desc, obj):
+    """Return an iterable over the objects associated to ``obj`` via the 
+    relationship descriptor ``desc``."""
+    if isinstance(desc, one_relationship_descriptor):
+        y = desc.__get__(obj, None)
+        return () if y is None else (y,)
+    elif isinstance(desc, edge_relationship_descriptor):
+        return list(desc.neighbours(obj))
+    else:
+        return desc.__get__(obj, None)
+
+
+def _reader(desc):
+    # a function returning the objects associated via desc, which reads the
+    # storage slot directly where possible
+    slot = desc.attr_name
+    if isinstance(desc, one_relationship_descriptor):
+        def read(x):
+            y = getattr(x, slot, None)
+            return () if y is None else (y,)
+    elif isinstance(desc, adjacency_relationship_descriptor):
+        nodes = desc.nodes
+        def read(x):
+            c = getattr(x, slot, None)
+            return () if c is None else list(map(nodes.__getitem__, c.ids))
+    elif isinstance(desc, many_relationship_descriptor) and not desc.lazy \
+            and not isinstance(desc, plain_storage):
+        field = 'seq' if issubclass(desc.container_class, OrderedAssociation) else 'elements'
+        def read(x):
+            c = getattr(x, slot, None)
+            return () if c is None else getattr(c, field)
+    else:
+        def read(x):
+            return associated(desc, x)
+    return read
+
+
+def path_successors(descs):
+    """Return a function ``succ(obj, i)``, returning the objects associated 
+    to ``obj`` via the i-th descriptor of a path of relationship descriptors.
+    """
+    def succ(obj, i):
+        return associated(descs[i], obj)
+    return succ
+
+
+def _path_descriptors(nupath):
+    if not isinstance(nupath, (tuple, list)):
+        nupath = (nupath,)
+    descs = tuple(_path_descriptor(rel) for rel in nupath)
+    if not descs:
+        raise ValueError("empty relationship path")
+    return descs
+
+
+def _reverse_path(descs):
+    # descriptor i of the reverse path leads from step i to step i-1
+    for desc in descs:
+        if not isinstance(desc.peer, relationship_descriptor):
+            raise ValueError("relationship {0} has no inverse endpoint".format(desc.name))
+    return tuple(descs[i-1].peer for i in range(len(descs)))
+
+
+def bfs_tree(seed, nupath, targets=None, max_hops=None):
+    """Traverse the objects reachable from ``seed`` by repetitions of the 
+    relationship path ``nupath``, in breadth-first order.
+
+    Return a pair ``(hops, parent)``. ``hops`` maps each reached object 
+    to the least number of repetitions of the path that reach it (the 
+    seed objects are reached in 0 hops). ``parent`` records the 
+    breadth-first tree; pass it to :py:func:`path_to` to reconstruct a 
+    shortest path to a reached object.
+
+    If ``targets`` is given, the traversal stops as soon as all of them 
+    are reached. If ``max_hops`` is given, objects farther away are not 
+    reached.
+    """
+    descs = _path_descriptors(nupath)
+    succ = path_successors(descs)
+    k = len(descs)
+    pending = None if targets is None else set(targets)
+
+    hops = {}
+    parent = {}
+    frontier = []
+    for s in seed:
+        if (s, 0) not in parent:
+            parent[(s, 0)] = None
+            hops[s] = 0
+            frontier.append((s, 0))
+    if pending is not None:
+        pending.difference_update(hops)
+
+    depth = 0
+    while frontier and pending != set():
+        if max_hops is not None and depth == max_hops*k:
+            break
+        depth += 1
+        layer = []
+        for node in frontier:
+            x, i = node
+            j = (i+1) % k
+            for y in succ(x, i):
+                if (y, j) not in parent:
+                    parent[(y, j)] = node
+                    layer.append((y, j))
+                    if j == 0 and y not in hops:
+                        hops[y] = depth // k
+                        if pending is not None:
+                            pending.discard(y)
+        frontier = layer
+    return hops, parent
+
+
+def path_to(parent, obj):
+    """Return the path to ``obj`` in the breadth-first tree ``parent`` 
+    returned by :py:func:`bfs_tree`, as the list of objects from a seed 
+    object to ``obj``, including the intermediate objects of the 
+    relationship path.
+    """
+    node = (obj, 0)
+    if node not in parent:
+        raise KeyError(obj)
+    path = []
+    while node is not None:
+        path.append(node[0])
+        node = parent[node]
+    path.reverse()
+    return path
+
+
+def _tree_depth(parent, node):
+    d = 0
+    while parent[node] is not None:
+        node = parent[node]
+        d += 1
+    return d
+
+
+def shortest_path(source, target, nupath, bidirectional=False):
+    """Return a shortest path from ``source`` to ``target`` by repetitions 
+    of the relationship path ``nupath``, as a list of objects (see 
+    :py:func:`path_to`), or None if ``target`` is not reachable.
+
+    The number of repetitions of the path is ``(len(path)-1)//len(nupath)``.
+
+    If ``bidirectional`` is True, the search proceeds from both ends, 
+    expanding the smaller frontier each time, and traversing the inverse 
+    endpoints of the relationships backwards. This explores far fewer 
+    objects on large graphs, but requires every relationship of the path 
+    to have an inverse endpoint.
+    """
+    if not bidirectional:
+        hops, parent = bfs_tree((source,), nupath, targets=(target,))
+        return path_to(parent, target) if target in hops else None
+
+    descs = _path_descriptors(nupath)
+    rdescs = _reverse_path(descs)
+    k = len(descs)
+    succ = path_successors(descs)
+    pred = path_successors(rdescs)
+
+    fwd = {(source, 0): None}
+    bwd = {(target, 0): None}
+    ffront = [(source, 0)]
+    bfront = [(target, 0)]
+    meet = (source, 0) if source is target else None
+    while meet is None and ffront and bfront:
+        # expand a whole layer of the smaller frontier
+        if len(ffront) <= len(bfront):
+            front, seen, other, step, forward = ffront, fwd, bwd, succ, True
+        else:
+            front, seen, other, step, forward = bfront, bwd, fwd, pred, False
+        layer = []
+        for node in front:
+            x, i = node
+            j = (i+1) % k if forward else (i-1) % k
+            for y in step(x, i):
+                if (y, j) not in seen:
+                    seen[(y, j)] = node
+                    layer.append((y, j))
+        # all new nodes are equally far from their end, so pick the 
+        # meeting node closest to the other end
+        meets = [node for node in layer if node in other]
+        if meets:
+            meet = min(meets, key=lambda node: _tree_depth(other, node))
+        if forward:
+            ffront = layer
+        else:
+            bfront = layer
+
+    if meet is None:
+        return None
+    path = []
+    node = meet
+    while node is not None:
+        path.append(node[0])
+        node = fwd[node]
+    path.reverse()
+    node = bwd[meet]
+    while node is not None:
+        path.append(node[0])
+        node = bwd[node]
+    return path
+
+
+#
+#  Batched reachability from many seeds
+#
+
+
+def _node_successors(descs):
+    # the successors of a node (obj, i) of a relationship path, as nodes
+    readers = [_reader(desc) for desc in descs]
+    k = len(descs)
+    def successors(node):
+        x, i = node
+        j = (i+1) % k
+        return [(y, j) for y in readers[i](x)]
+    return successors
+
+
+def _strong_components(roots, successors):
+    # Tarjan's algorithm, without recursion, over the nodes reachable from 
+    # roots. Return (comp, members), where comp maps each node to the number 
+    # of its strongly connected component, and members lists the nodes of 
+    # each component. Components are numbered in reverse topological order 
+    # (every edge leads to a component with an equal or lower number).
+    index = {}
+    low = {}
+    comp = {}
+    members = []
+    stack = []
+    for root in roots:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        work = [(root, iter(successors(root)))]
+        while work:
+            v, it = work[-1]
+            for w in it:
+                if w not in index:
+                    index[w] = low[w] = len(index)
+                    stack.append(w)
+                    work.append((w, iter(successors(w))))
+                    break
+                elif w not in comp and index[w] < low[v]:
+                    # w is still on the stack
+                    low[v] = index[w]
+            else:
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    if low[v] < low[u]:
+                        low[u] = low[v]
+                if low[v] == index[v]:
+                    c = len(members)
+                    group = []
+                    while True:
+                        w = stack.pop()
+                        comp[w] = c
+                        group.append(w)
+                        if w is v:
+                            break
+                    members.append(group)
+    return comp, members
+
+
+def reachability_masks(seeds, nupath):
+    """Return a dict mapping each object reachable from some of the objects 
+    of the sequence ``seeds`` by repetitions of the relationship path 
+    ``nupath``, to the bitset (an int) of the seeds that reach it: bit 
+    ``i`` is set if the object is reachable from ``seeds[i]``. This is the 
+    seed-by-object reachability matrix, by columns.
+
+    All seeds are traversed in one sweep: the strongly connected components 
+    of the reachable objects are found first, and then the bitsets are 
+    propagated once along each link, in topological order of the components.
+    """
+    successors = _node_successors(_path_descriptors(nupath))
+    seeds = list(seeds)
+    comp, members = _strong_components([(s, 0) for s in seeds], successors)
+    mask = [0] * len(members)
+    for i, s in enumerate(seeds):
+        mask[comp[(s, 0)]] |= 1 << i
+    for c in range(len(members)-1, -1, -1):
+        m = mask[c]
+        for node in members[c]:
+            for y in successors(node):
+                d = comp[y]
+                if d != c:
+                    mask[d] |= m
+    return {node[0]: mask[c] for node, c in comp.items() if node[1] == 0}
+
+
+def batched_closure(seeds, nupath):
+    """Return an iterator over pairs ``(seed, closure)``, one for each 
+    object of the sequence ``seeds``, where ``closure`` is the list of the 
+    objects reachable from ``seed`` by repetitions of the relationship 
+    path ``nupath`` (including the seed), as by :py:func:`transitive_closure`.
+
+    The closures are computed together, by :py:func:`reachability_masks`.
+    """
+    seeds = list(seeds)
+    # objects with equal bitsets (e.g., in a common cycle) are distributed 
+    # together
+    groups = defaultdict(list)
+    for x, m in reachability_masks(seeds, nupath).items():
+        groups[m].append(x)
+    closures = [[] for s in seeds]
+    for m, objs in groups.items():
+        while m:
+            low = m & -m
+            closures[low.bit_length()-1].extend(objs)
+            m ^= low
+    return zip(seeds, closures)
 
 
 
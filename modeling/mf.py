@@ -20,7 +20,12 @@ from .forward import ForwardReference, forward_setattr, forward_invoke
 from .validation import Validation
 from .instrument import attribute_descriptor, relationship_descriptor,\
 	one_relationship_descriptor, many_relationship_descriptor,\
-	ordered_relationship_descriptor
+	ordered_relationship_descriptor, adjacency_relationship_descriptor,\
+	edge_relationship_descriptor, tree_relationship_descriptor, TreeAssociation,\
+	LazySetAssociation, LazyOrderedAssociation,\
+	swap, move, replace, load_edges, compile_path, transitive_closure,\
+	bfs_tree, path_to, shortest_path, reachability_masks, batched_closure
+from .csr import to_csr
 
 
 
@@ -636,10 +641,13 @@ class RelKind(Enum):
 	
 	Used to denote 1:1, 1:m, etc. relationships.
 	ORDERED implies MANY (naturally!)
+	TREE implies ONE: it is the parent endpoint of a relationship
+	whose links cannot form cycles.
 	"""
 	ONE=1
 	MANY=2
 	ORDERED=3
+	TREE=4
 
 
 
@@ -665,10 +673,33 @@ class RelationshipEndpoint(ClassFeature):
 	A symmetric relationship is modeled by a single RelationshipEndpoint
 	instance.
 
+	The cardinality of an endpoint can be bounded by ``min`` and ``max``.
+	The upper bound is enforced when objects are associated, whereas the
+	lower bound is checked by :py:func:`validate_objects`.
+
+	A symmetric MANY relationship can be an *adjacency*, with compact 
+	storage: the relationship numbers the objects, each object holds a 
+	sorted array of the numbers of its neighbours, and an edge is inserted
+	or removed in one operation.
+
+	An *edge relationship* is a MANY relationship whose links carry a 
+	payload, i.e., values for the named fields in ``payload`` (see 
+	:py:func:`edge_refs`). For other relationships, ``payload`` is None.
+
+	A *lazy* MANY or ORDERED endpoint is not updated immediately, when its 
+	peer is written; the updates are logged and applied in batch when the 
+	endpoint is next read (see :py:func:`refs`).
+
 	"""
 
-	def __init__(self, name=None, owner=None, target=None, kind=None, peer=None):
+	def __init__(self, name=None, owner=None, target=None, kind=None, peer=None, min=0, max=None, adjacency=False,
+			payload=None, lazy=False):
 		super().__init__(name, owner)
+		self.min = min
+		self.max = max
+		self.adjacency = adjacency
+		self.payload = payload
+		self.lazy = lazy
 
 		if owner is not None:
 			owner.add_relationship(self)
@@ -720,6 +751,26 @@ class RelationshipEndpoint(ClassFeature):
 			raise TypeError("RelKind expected")
 		self.__kind = kind
 	
+	@property
+	def min(self):
+		"""The minimum number of associated objects."""
+		return self.__min
+	@min.setter
+	def min(self, min):
+		if not isinstance(min, int) or min<0:
+			raise ValueError("A non-negative integer is expected")
+		self.__min = min
+
+	@property
+	def max(self):
+		"""The maximum number of associated objects, or None for unbounded."""
+		return self.__max
+	@max.setter
+	def max(self, max):
+		if max is not None and (not isinstance(max, int) or max<1):
+			raise ValueError("A positive integer or None is expected")
+		self.__max = max
+
 	@property
 	def peer(self):
 		return self.__peer
@@ -743,8 +794,8 @@ def relationships(C1, rel1, kind1, C2, rel2, kind2):
 	return r1, r2
 
 
-def symmetric_relationship(C, rel, kind):
-	r = RelationshipEndpoint(rel, C, C, kind, None)
+def symmetric_relationship(C, rel, kind, adjacency=False):
+	r = RelationshipEndpoint(rel, C, C, kind, None, adjacency=adjacency)
 	r.peer = r
 	return r
 
@@ -778,8 +829,12 @@ ReadOnly = annotation_class('ReadOnly', [])()
 
 
 #  Private helper
-def _ref_create(target, inv, kind):
+def _ref_create(target, inv, kind, min=0, max=None, adjacency=False, payload=None, lazy=False):
 	assert isinstance(kind, RelKind)
+	if adjacency and inv is not True:
+		raise ValueError("Only symmetric relationships can be adjacencies")
+	if lazy and (inv is True or max is not None):
+		raise ValueError("A lazy relationship endpoint cannot be symmetric or bounded")
 	
 	if not (target is None or isinstance(target, (Class, ForwardReference))):
 		if hasattr(target, '__model_class__'):
@@ -788,11 +843,11 @@ def _ref_create(target, inv, kind):
 			raise ValueError("Target must be an mf.Class, or a modeled python class or a forward reference")
 	
 	if inv is None:
-		return RelationshipEndpoint(target=target, kind=kind)
+		return RelationshipEndpoint(target=target, kind=kind, min=min, max=max, payload=payload, lazy=lazy)
 	elif isinstance(inv, (RelationshipEndpoint, ForwardReference)):
-		return RelationshipEndpoint(target=target, kind=kind, peer=inv)
+		return RelationshipEndpoint(target=target, kind=kind, peer=inv, min=min, max=max, payload=payload, lazy=lazy)
 	elif inv is True:
-		ret = RelationshipEndpoint(target=target, kind=kind)
+		ret = RelationshipEndpoint(target=target, kind=kind, min=min, max=max, adjacency=adjacency, payload=payload)
 		ret.peer = ret
 		return ret
 	else:
@@ -819,12 +874,55 @@ def ref(target=None, inv=None):
 	"""
 	return _ref_create(target, inv, RelKind.ONE)
 
-def refs(target=None, inv=None):
+def parent_ref(target=None, inv=None):
+	"""Return a nameless :py:class:`~modeling.mf.RelationshipEndpoint` instance
+	for the parent endpoint of a tree relationship, for binding to some 
+	class attribute. The peer endpoint (the children) must be a ``refs()``.
+
+	Assigning a parent which would create a cycle raises an
+	``AssociationCycleError``, and nothing is changed. The instrumented 
+	endpoint provides the queries ``root_of(obj)``, ``depth(obj)``,
+	``is_ancestor(a, obj)`` and ``lca(a, b)``. Cycle checks and queries take
+	logarithmic amortized time (see :py:mod:`modeling.dyntree`).
+
+	The ``RelKind`` is ``TREE``.
+	::
+
+		class Folder:
+			parent = parent_ref()
+			children = refs(inv=parent)
+		...
+		Folder.parent.is_ancestor(root, folder)
+	"""
+	return _ref_create(target, inv, RelKind.TREE)
+
+def refs(target=None, inv=None, min=0, max=None, adjacency=False, lazy=False):
 	"""Return a nameless RelationshipEndpoint instance for binding to some class attribute.
 	If inv is provided and is an instance of RelationshipEndpoint,
 	then peer this RelationshipEndpoint to the given one.
 	If inv is True, then define a self-relationship (a symmetric relationship).
 
+	If ``max`` is provided, associating more than ``max`` objects raises
+	an ``AssociationCardinalityError``. If ``min`` is provided, holding
+	fewer than ``min`` objects is reported by :py:func:`validate_objects`.
+
+	If ``adjacency`` is True (for symmetric relationships only), the 
+	relationship gives integer ids to the objects, and each object holds
+	a sorted array of the ids of its neighbours instead of a set, so an 
+	edge takes a few bytes instead of about a hundred. Both ends of an edge
+	are updated in one operation. Inserting an edge and testing membership
+	take a binary search, and iterating over the neighbours maps their ids 
+	back to objects. The objects are referenced by the relationship while 
+	they have neighbours.
+
+	If ``lazy`` is True, the endpoint is not updated when its peer is 
+	written: the updates are logged, and applied in batch on the next read 
+	of the endpoint (from any object), or on an explicit ``flush()`` of the 
+	descriptor. This speeds up write-heavy phases, when the endpoint is 
+	rarely read. A container of a lazy endpoint also applies the pending 
+	updates before each operation, so it may be held across writes to the
+	peer. A lazy endpoint cannot be symmetric or have a maximum cardinality.
+
 	The ``RelKind`` is ``MANY``.
 	::		
 		class Person:
@@ -834,10 +932,21 @@ def refs(target=None, inv=None):
 		class UndirectedGraphNode:
 			neighbors = refs(int=True)
 			...
+
+		class Vertex:
+			adjacent = refs(inv=True, adjacency=True)
+
+		class Resource:
+			owners = refs(max=1)
+
+		class Node:
+			incoming = refs(lazy=True)
+		class Arc:
+			destination = ref(inv=Node.incoming)
 	"""
-	return _ref_create(target, inv, RelKind.MANY)
+	return _ref_create(target, inv, RelKind.MANY, min, max, adjacency, lazy=lazy)
 
-def ref_list(target=None, inv=None):
+def ref_list(target=None, inv=None, min=0, max=None, lazy=False):
 	"""Return a nameless :py:class:`~modeling.mf.RelationshipEndpoint`
 	instance for binding to some class attribute.
 
@@ -846,6 +955,8 @@ def ref_list(target=None, inv=None):
 	
 	If ``inv`` is ``True``, then define a self-relationship (a symmetric relationship).
 
+	The cardinality bounds ``min`` and ``max``, and ``lazy``, are as in :py:func:`refs`.
+
 	The ``RelKind`` is ``ORDERED``.
 	::
 	
@@ -855,7 +966,35 @@ def ref_list(target=None, inv=None):
 		class Table:
 			 rows = ref_list(inv=TableRow.table)
 	"""
-	return _ref_create(target, inv, RelKind.ORDERED)
+	return _ref_create(target, inv, RelKind.ORDERED, min, max, lazy=lazy)
+
+def edge_refs(target=None, inv=None, payload=(), min=0, max=None):
+	"""Return a nameless RelationshipEndpoint instance of an edge relationship,
+	for binding to some class attribute.
+
+	An edge relationship is a MANY relationship whose links carry a payload:
+	values for the fields named in ``payload``. It is stored in a compact
+	form: there are no container objects, each object keeps a dict from its 
+	neighbours to edge numbers, and the payloads are kept in columns, in a 
+	table shared by the two peers. A field can be given a typecode of
+	``array.array``, for a typed column, by passing ``payload`` as a dict.
+
+	The payload is declared on one of the two peers (or on both, identically). 
+	``inv`` and the cardinality bounds ``min`` and ``max`` are as in 
+	:py:func:`refs`.
+
+	Iterating over an edge relationship yields pairs ``(neighbour, payload)``.
+	::
+
+		class City:
+			roads = edge_refs(payload={'length':'d', 'name':None})
+			incoming = edge_refs(inv=roads)
+
+		athens.roads.add(patras, length=210.0, name='E65')
+		for city, road in athens.roads:
+			print(city, road.length)
+	"""
+	return _ref_create(target, inv, RelKind.MANY, min, max, payload=payload)
 
 
 #
@@ -1004,22 +1143,36 @@ def instrument_relationship(cls, rel):
 	# Else, we have a peer, so we instrument both sides, if needed
 
 	# A utility function for creation of descriptors
-	def create_descriptor(kind, name, target, owner):        
-		if kind is RelKind.ONE:
+	def create_descriptor(rel, target, owner):
+		kind, name = rel.kind, rel.name
+		if rel.adjacency:
+			desc = adjacency_relationship_descriptor(name, target, read_only=False)
+		elif rel.payload is not None:
+			desc = edge_relationship_descriptor(name, target, rel.payload or rel.peer.payload or ())
+		elif kind is RelKind.ONE:
 			desc = one_relationship_descriptor(name, target, read_only=False)
+		elif kind is RelKind.TREE:
+			desc = tree_relationship_descriptor(name, target, read_only=False)
 		elif kind is RelKind.MANY:
 			desc = many_relationship_descriptor(name, target, read_only=False)
 		elif kind is RelKind.ORDERED:
 			desc = ordered_relationship_descriptor(name, target, read_only=False)
 		else:
 			raise ValueError("Cannot instrument for this relationship kind: {0}".format(kind))
+		desc.owner = owner
+		desc.min, desc.max = rel.min, rel.max
+		desc.lazy = rel.lazy
+		if rel.peer.kind is RelKind.TREE and kind is RelKind.MANY:
+			desc.container_class = TreeAssociation
+		elif rel.lazy:
+			desc.container_class = LazyOrderedAssociation if kind is RelKind.ORDERED else LazySetAssociation
 		setattr(owner, name, desc)
 		return desc
 
 	
 	if rel.peer is rel:
 		# We have a symmetric relationship, just instrument it
-		d = create_descriptor(rel.kind, rel.name, cls, cls)
+		d = create_descriptor(rel, cls, cls)
 		d.initialize(d)
 		
 	else:
@@ -1028,9 +1181,9 @@ def instrument_relationship(cls, rel):
 		assert getattr(ocls, rel.peer.name) is rel.peer
 	
 		# the descriptor for rel
-		d = create_descriptor(rel.kind, rel.name, ocls, cls)
+		d = create_descriptor(rel, ocls, cls)
 		# the descriptor for rel peer
-		od = create_descriptor(rel.peer.kind, rel.peer.name, cls, ocls)
+		od = create_descriptor(rel.peer, cls, ocls)
 			
 		d.initialize(od)
 		od.initialize(d)
@@ -1139,6 +1292,25 @@ class ClassValidation(Validation):
 			if rel.peer is not None:
 				V(rel.peer.peer is rel, "Peer's peer is self")
 				V(rel.peer.owner is rel.target, "Target is peer's owner")
+			if rel.max is not None:
+				V(rel.kind not in (RelKind.ONE, RelKind.TREE), "Maximum cardinality is given for a collection")
+				V(rel.min <= rel.max, "Minimum cardinality does not exceed maximum")
+			if rel.adjacency:
+				V(rel.peer is rel and rel.kind is RelKind.MANY, "An adjacency is a symmetric MANY relationship")
+			if rel.lazy:
+				V(rel.kind not in (RelKind.ONE, RelKind.TREE), "A lazy relationship endpoint is a collection")
+				V(rel.peer is not rel, "A lazy relationship endpoint is not symmetric")
+				V(rel.max is None and not rel.adjacency and rel.payload is None,
+					"A lazy relationship endpoint has plain storage and no maximum cardinality")
+			if rel.kind is RelKind.TREE:
+				V(rel.peer is not None and rel.peer is not rel and rel.peer.kind is RelKind.MANY 
+					and rel.peer.max is None and not rel.peer.lazy,
+					"The peer of a tree endpoint is a plain MANY endpoint")
+			if rel.payload is not None:
+				V(rel.kind is RelKind.MANY, "An edge relationship is a MANY relationship")
+				V(rel.peer is not None and rel.peer.payload is not None, "The peer of an edge relationship is an edge relationship")
+				if rel.peer is not None and rel.payload and rel.peer.payload:
+					V(rel.payload == rel.peer.payload, "Peer edge relationships have the same payload")
 				
 
 
@@ -1154,6 +1326,47 @@ def validate_classes(S, **kwargs):
 	
 
 
+#
+#  Validation for model objects
+#
+
+
+class ObjectValidation(Validation):
+	"""This validation validates model objects, for constraints of their
+	classes which are not enforced when the objects are updated, such as the
+	minimum cardinality of relationships.
+	It can be used most conveniently via function validate_objects().
+	"""
+
+	def validate_object(self, obj):
+		mcls = model_class(type(obj))
+		with self.section("Object {0}", obj) as V:
+			for rel in mcls.all_relationships:
+				self.validate_cardinality(obj, rel)
+			return V.passed_section()
+
+	def validate_cardinality(self, obj, rel):
+		if rel.min==0 and rel.max is None:
+			return
+		value = getattr(obj, rel.name)
+		if rel.kind in (RelKind.ONE, RelKind.TREE):
+			count = 0 if value is None else 1
+		else:
+			count = len(value)
+		self(count >= rel.min, "Relationship '{0}' has at least {1} objects", rel.name, rel.min)
+		if rel.max is not None:
+			self(count <= rel.max, "Relationship '{0}' has at most {1} objects", rel.name, rel.max)
+
+
+def validate_objects(S, **kwargs):
+	"""Validate an iterable of model objects and return True if all are valid."""
+	vld = ObjectValidation(**kwargs)
+	for obj in S:
+		vld.validate_object(obj)
+	return vld.passed()
+
+
+
 #
 # The mf CORE model classes
 #
@@ -0,0 +1,317 @@
+'''
+Regular path queries over relationships.
+
+A regular path query selects the objects reachable from a set of seed
+objects by a path of relationships which matches a regular expression,
+e.g., ``(outgoing.destination)+ | incoming.source``. The syntax is:
+
+* a relationship name, which is followed on every object that has a
+  relationship of that name (and no object is reached from objects
+  that have no such relationship),
+* ``e1.e2``, for paths matching ``e1`` followed by paths matching ``e2``,
+* ``e1|e2``, for paths matching either ``e1`` or ``e2``,
+* ``e*``, ``e+`` and ``e?``, for paths matching zero or more, one or more,
+  or at most one repetitions of ``e``,
+* parentheses, for grouping.
+
+Expressions can also be built by :py:func:`seq`, :py:func:`alt`,
+:py:func:`star`, :py:func:`plus` and :py:func:`opt`, whose arguments are
+expression strings, relationship endpoints or descriptors (which are
+followed only on objects of their owner class), or other expressions.
+
+A query is compiled into a finite automaton over relationships, and it is
+evaluated by a breadth-first traversal of the product of the object graph
+and the automaton, keeping a set of seen objects per automaton state.
+
+@author: vsam
+'''
+import re
+from .instrument import relationship_descriptor, _path_descriptor, _reader
+
+
+#
+#  Expressions
+#
+#  An expression is a tuple: ('rel', label), ('seq', e1, e2), ('alt', e1, e2),
+#  ('star', e), ('plus', e) or ('opt', e). A label is a relationship name or
+#  a relationship descriptor.
+#
+
+_token = re.compile(r'\s*(?:([A-Za-z_]\w*)|(.))')
+
+
+def parse(text):
+    """Parse the string form of a regular path query, and return the
+    expression."""
+    tokens = []
+    for m in _token.finditer(text):
+        if m.group(1):
+            tokens.append(('name', m.group(1), m.start(1)))
+        elif m.group(2):
+            if m.group(2) not in '().|*+?':
+                raise ValueError("unexpected character %r at %d in %r" % (m.group(2), m.start(2), text))
+            tokens.append((m.group(2), m.group(2), m.start(2)))
+    tokens.append(('end', None, len(text)))
+    pos = 0
+
+    def peek():
+        return tokens[pos][0]
+
+    def expect(kind):
+        nonlocal pos
+        tok = tokens[pos]
+        if tok[0] != kind:
+            raise ValueError("expected %s at %d in %r" % (kind, tok[2], text))
+        pos += 1
+        return tok[1]
+
+    def alternation():
+        e = sequence()
+        while peek() == '|':
+            expect('|')
+            e = ('alt', e, sequence())
+        return e
+
+    def sequence():
+        e = postfix()
+        while peek() == '.':
+            expect('.')
+            e = ('seq', e, postfix())
+        return e
+
+    def postfix():
+        e = atom()
+        while peek() in ('*', '+', '?'):
+            e = ({'*':'star', '+':'plus', '?':'opt'}[expect(peek())], e)
+        return e
+
+    def atom():
+        if peek() == '(':
+            expect('(')
+            e = alternation()
+            expect(')')
+            return e
+        return ('rel', expect('name'))
+
+    e = alternation()
+    expect('end')
+    return e
+
+
+def expression(e):
+    """Return the expression of a string, relationship endpoint or
+    descriptor, or expression."""
+    if isinstance(e, str):
+        return parse(e)
+    elif isinstance(e, tuple):
+        return e
+    else:
+        return ('rel', _path_descriptor(e))
+
+
+def seq(*exprs):
+    """The concatenation of expressions."""
+    result = expression(exprs[0])
+    for e in exprs[1:]:
+        result = ('seq', result, expression(e))
+    return result
+
+
+def alt(*exprs):
+    """The alternation of expressions."""
+    result = expression(exprs[0])
+    for e in exprs[1:]:
+        result = ('alt', result, expression(e))
+    return result
+
+
+def star(e):
+    """Zero or more repetitions of an expression."""
+    return ('star', expression(e))
+
+
+def plus(e):
+    """One or more repetitions of an expression."""
+    return ('plus', expression(e))
+
+
+def opt(e):
+    """Zero or one repetitions of an expression."""
+    return ('opt', expression(e))
+
+
+#
+#  Automata
+#
+
+
+class PathAutomaton:
+    """A finite automaton over relationship labels, without empty
+    transitions.
+
+    States are numbered ``0..n-1``. ``transitions[q]`` is a list of pairs
+    ``(label, targets)``, ``start`` is the set of initial states and
+    ``accepting`` the set of accepting states.
+    """
+
+    def __init__(self, e):
+        # Thompson construction: eps[q] lists the empty transitions and
+        # moves[q] the labelled ones, of each state
+        eps = []
+        moves = []
+        def state():
+            eps.append([])
+            moves.append([])
+            return len(eps)-1
+
+        def build(e):
+            # return the (entry, exit) states of a fragment for e
+            kind = e[0]
+            if kind == 'rel':
+                a, b = state(), state()
+                moves[a].append((e[1], b))
+            elif kind == 'seq':
+                a, m1 = build(e[1])
+                m2, b = build(e[2])
+                eps[m1].append(m2)
+            elif kind == 'alt':
+                a, b = state(), state()
+                for sub in e[1:]:
+                    x, y = build(sub)
+                    eps[a].append(x)
+                    eps[y].append(b)
+            elif kind in ('star', 'plus', 'opt'):
+                a, b = state(), state()
+                x, y = build(e[1])
+                eps[a].append(x)
+                eps[y].append(b)
+                if kind != 'opt':
+                    eps[y].append(x)
+                if kind != 'plus':
+                    eps[a].append(b)
+            else:
+                raise ValueError("unknown expression %r" % (kind,))
+            return a, b
+
+        entry, final = build(e)
+
+        def closure(q):
+            seen = {q}
+            stack = [q]
+            while stack:
+                for r in eps[stack.pop()]:
+                    if r not in seen:
+                        seen.add(r)
+                        stack.append(r)
+            return seen
+
+        # remove empty transitions, keeping only the states which are
+        # entered by a labelled transition (plus the entry)
+        closures = {}
+        number = {}
+        order = [entry]
+        number[entry] = 0
+        self.transitions = []
+        self.accepting = set()
+        i = 0
+        while i < len(order):
+            q = order[i]
+            closures[q] = closure(q)
+            if final in closures[q]:
+                self.accepting.add(i)
+            bylabel = {}
+            for p in closures[q]:
+                for label, r in moves[p]:
+                    if r not in number:
+                        number[r] = len(order)
+                        order.append(r)
+                    bylabel.setdefault(label, set()).add(number[r])
+            self.transitions.append([(label, frozenset(t)) for label, t in bylabel.items()])
+            i += 1
+        self.start = {0}
+
+    def __len__(self):
+        return len(self.transitions)
+
+
+#
+#  Queries
+#
+
+
+class RegularPathQuery:
+    """A compiled regular path query (see the module documentation).
+
+    Calling the query on an iterable of seed objects returns an iterator
+    over the objects reached in an accepting state, each once, in
+    breadth-first order.
+    """
+
+    def __init__(self, expr):
+        self.expr = expression(expr)
+        self.automaton = PathAutomaton(self.expr)
+        self.moves = {}
+
+    def resolve(self, q, cls):
+        """Return the transitions of state ``q`` on objects of class ``cls``,
+        as a list of pairs ``(reader, targets)``, where ``reader(obj)`` 
+        returns the objects associated to ``obj``."""
+        try:
+            return self.moves[(q, cls)]
+        except KeyError:
+            pass
+        moves = []
+        for label, targets in self.automaton.transitions[q]:
+            if isinstance(label, str):
+                desc = getattr(cls, label, None)
+            else:
+                desc = label if getattr(cls, label.name, None) is label else None
+            if isinstance(desc, relationship_descriptor):
+                moves.append((_reader(desc), targets))
+        self.moves[(q, cls)] = moves
+        return moves
+
+    def __call__(self, seed):
+        A = self.automaton
+        accepting = A.accepting
+        seen = [set() for q in range(len(A))]
+        result = set()
+        frontier = []
+        for s in seed:
+            for q in A.start:
+                if s not in seen[q]:
+                    seen[q].add(s)
+                    frontier.append((s, q))
+
+        while frontier:
+            layer = []
+            for x, q in frontier:
+                if q in accepting and x not in result:
+                    result.add(x)
+                    yield x
+                try:
+                    moves = self.moves[(q, type(x))]
+                except KeyError:
+                    moves = self.resolve(q, type(x))
+                for reader, targets in moves:
+                    for y in reader(x):
+                        for r in targets:
+                            if y not in seen[r]:
+                                seen[r].add(y)
+                                layer.append((y, r))
+            frontier = layer
+
+
+_query_cache = {}
+
+
+def path_query(expr):
+    """Return the compiled :py:class:`RegularPathQuery` of an expression.
+    Queries given as strings are cached."""
+    if not isinstance(expr, str):
+        return RegularPathQuery(expr)
+    try:
+        return _query_cache[expr]
+    except KeyError:
+        q = _query_cache[expr] = RegularPathQuery(expr)
+        return q
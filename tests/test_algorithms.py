@@ -0,0 +1,200 @@
+'''
+Test module for algorithms
+
+@author: vsam
+'''
+
+import random
+import pytest
+from modeling.mf import *
+from modeling.algorithms import strongly_connected_components, topological_sort, \
+    weakly_connected_components, condensation, pagerank, personalized_pagerank, \
+    degree_centrality, core_numbers, k_core
+
+
+@model
+class Vertex:
+    outgoing = refs()
+    incoming = refs()
+    parent = ref()
+    children = refs(inv=parent)
+    rank = attr(float, default=0.0)
+
+
+@model
+class Edge:
+    source = ref(inv=Vertex.outgoing)
+    destination = ref(inv=Vertex.incoming)
+
+
+path = (Vertex.outgoing, Edge.destination)
+
+
+def random_graph(rng, n, m, acyclic=False):
+    V = [Vertex() for i in range(n)]
+    for i in range(m):
+        a, b = rng.randrange(n), rng.randrange(n)
+        if acyclic and a >= b:
+            continue
+        e = Edge()
+        e.source, e.destination = V[a], V[b]
+    return V
+
+
+def test_strongly_connected_components():
+    rng = random.Random(37)
+    V = random_graph(rng, 60, 70)
+    closure = {v: set(transitive_closure([v], path)) for v in V}
+
+    components = strongly_connected_components(V, path)
+    assert {x for c in components for x in c} == set(V)
+    assert sum(len(c) for c in components) == len(V)
+    position = {x: i for i, c in enumerate(components) for x in c}
+    for v in V:
+        assert {w for w in V if v in closure[w] and w in closure[v]} == set(components[position[v]])
+        for e in v.outgoing:
+            assert position[v] <= position[e.destination]
+
+    components, links = condensation(V, path)
+    for i, c in enumerate(components):
+        expected = {position[e.destination] for x in c for e in x.outgoing} - {i}
+        assert links[i] == sorted(expected)
+        assert all(j > i for j in links[i])
+
+    # only the objects reachable from the given ones
+    assert {x for c in strongly_connected_components(V[:1], path) for x in c} == closure[V[0]]
+
+
+def test_topological_sort():
+    rng = random.Random(41)
+    V = random_graph(rng, 50, 120, acyclic=True)
+    order = topological_sort(V, path)
+    assert set(order) == set(V) and len(order) == len(V)
+    position = {x: i for i, x in enumerate(order)}
+    for v in V:
+        for e in v.outgoing:
+            assert position[v] < position[e.destination]
+
+    # a self-loop is a cycle
+    e = Edge()
+    e.source = e.destination = V[10]
+    with pytest.raises(ValueError):
+        topological_sort(V, path)
+
+    for i in range(1, len(V)):
+        V[i].parent = V[(i-1) // 2]
+    assert topological_sort([V[-1]], Vertex.parent)[-1] is V[0]
+    assert topological_sort(V[:1], Vertex.children)[0] is V[0]
+
+
+def test_weakly_connected_components():
+    rng = random.Random(43)
+    V = random_graph(rng, 80, 50)
+    components = weakly_connected_components(V, path)
+    assert sum(len(c) for c in components) == len(V)
+
+    # brute force, with the links in both directions
+    neighbours = {v: set() for v in V}
+    for v in V:
+        for e in v.outgoing:
+            neighbours[v].add(e.destination)
+            neighbours[e.destination].add(v)
+    for c in components:
+        reached = {c[0]}
+        stack = [c[0]]
+        while stack:
+            for w in neighbours[stack.pop()]:
+                if w not in reached:
+                    reached.add(w)
+                    stack.append(w)
+        assert reached == set(c)
+
+    # a long chain does not exhaust the stack
+    chain = [Vertex() for i in range(5000)]
+    for a, b in zip(chain, chain[1:]):
+        b.parent = a
+    assert weakly_connected_components(chain[-1:], Vertex.parent) == [chain[::-1]]
+    assert strongly_connected_components(chain[:1], Vertex.children) == [[x] for x in chain]
+
+
+def test_pagerank():
+    pytest.importorskip("numpy")
+    rng = random.Random(47)
+    V = random_graph(rng, 40, 90)
+
+    def reference(p, alpha=0.85):
+        # plain power iteration, over the vertices
+        x = dict(p)
+        for it in range(200):
+            new = {v: (1 - alpha) * p[v] for v in V}
+            for v in V:
+                targets = [e.destination for e in v.outgoing if e.destination is not None]
+                for w in targets:
+                    new[w] += alpha * x[v] / len(targets)
+                if not targets:
+                    for w in V:
+                        new[w] += alpha * x[v] * p[w]
+            x = new
+        return x
+
+    ranks = pagerank(V, path)
+    assert set(ranks) == set(V)
+    assert sum(ranks.values()) == pytest.approx(1.0)
+    expected = reference({v: 1/len(V) for v in V})
+    for v in V:
+        assert ranks[v] == pytest.approx(expected[v], abs=1e-6)
+
+    sources = V[:3]
+    ranks = personalized_pagerank(sources, path, attr='rank')
+    reached = set(transitive_closure(sources, path))
+    assert set(ranks) == reached
+    expected = reference({v: (1/3 if v in sources else 0.0) for v in V})
+    for v in reached:
+        assert ranks[v] == pytest.approx(expected[v], abs=1e-6)
+        assert v.rank == ranks[v]
+
+    with pytest.raises(RuntimeError):
+        pagerank(V, path, max_iter=2)
+    assert pagerank([], path) == {}
+
+
+def test_degree_centrality():
+    pytest.importorskip("numpy")
+    rng = random.Random(53)
+    V = random_graph(rng, 30, 60)
+    out = degree_centrality(V, path)
+    inc = degree_centrality(V, path, incoming=True)
+    for v in V:
+        assert out[v] * 29 == pytest.approx(len([e for e in v.outgoing if e.destination is not None]))
+        assert inc[v] * 29 == pytest.approx(len([e for e in v.incoming if e.source is not None]))
+
+
+def test_core_numbers():
+    pytest.importorskip("numpy")
+    rng = random.Random(59)
+    V = random_graph(rng, 60, 150)
+
+    def degrees(S):
+        # links within S, in both directions
+        deg = {v: 0 for v in S}
+        for v in S:
+            for e in v.outgoing:
+                if e.destination in deg:
+                    deg[v] += 1
+                    deg[e.destination] += 1
+        return deg
+
+    def brute_core(k):
+        S = set(V)
+        while True:
+            deg = degrees(S)
+            low = {v for v in S if deg[v] < k}
+            if not low:
+                return S
+            S -= low
+
+    core = core_numbers(V, path)
+    for k in range(max(core.values()) + 2):
+        expected = brute_core(k)
+        assert {v for v in V if core[v] >= k} == expected
+        assert set(k_core(V, path, k)) == expected
@@ -0,0 +1,61 @@
+'''
+Test module for csr
+
+@author: vsam
+'''
+
+import random
+import pytest
+from modeling.mf import *
+from modeling.csr import csr_neighbours, csr_bfs, csr_closure, csr_degree
+
+np = pytest.importorskip("numpy")
+
+
+def test_to_csr():
+
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs()
+        parent = ref()
+        children = refs(inv=parent)
+
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+
+    rng = random.Random(11)
+    V = [Vertex() for i in range(50)]
+    for i in range(120):
+        e = Edge()
+        e.source, e.destination = rng.choice(V), rng.choice(V)
+    for v in V[1:]:
+        v.parent = rng.choice(V[:V.index(v)])
+
+    objects = V[:40] + V[:5]
+    id_map, indptr, indices = to_csr((Vertex.outgoing, Edge.destination), objects)
+    assert list(id_map) == V[:40]
+    assert indptr[0] == 0 and indptr[-1] == len(indices)
+    ids = {v: i for i, v in enumerate(id_map)}
+    for v, i in ids.items():
+        expected = sorted(ids[e.destination] for e in v.outgoing if e.destination in ids)
+        assert sorted(indices[indptr[i]:indptr[i+1]]) == expected
+
+    assert list(csr_degree(indptr, indices)) == [len(indices[indptr[i]:indptr[i+1]]) for i in range(40)]
+    assert list(csr_degree(indptr, indices, incoming=True)) == [list(indices).count(i) for i in range(40)]
+    assert sorted(csr_neighbours(indptr, indices, np.array([0, 1]))) == \
+        sorted(list(indices[indptr[0]:indptr[1]]) + list(indices[indptr[1]:indptr[2]]))
+
+    # hop counts agree with the traversal of the object graph
+    id_map, indptr, indices = to_csr((Vertex.outgoing, Edge.destination), V)
+    hops, parent = bfs_tree([V[0]], (Vertex.outgoing, Edge.destination))
+    dist = csr_bfs(indptr, indices, 0)
+    assert {id_map[i]: d for i, d in enumerate(dist) if d >= 0} == hops
+    assert set(id_map[csr_closure(indptr, indices, [0])]) == set(hops)
+    assert max(csr_bfs(indptr, indices, [0], max_hops=1)) <= 1
+
+    id_map, indptr, indices = to_csr(Vertex.parent, V)
+    assert list(csr_degree(indptr, indices)) == [0] + [1]*49
+    assert csr_closure(indptr, indices, 49)[0]
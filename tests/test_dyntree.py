@@ -0,0 +1,67 @@
+'''
+Test module for dyntree
+
+@author: vsam
+'''
+
+import random
+from modeling.dyntree import LinkCutForest
+
+
+class Item:
+    def __init__(self, i):
+        self.i = i
+        self.parent = None
+
+
+def test_link_cut_forest():
+    F = LinkCutForest('_node')
+    X = [Item(i) for i in range(5)]
+
+    assert F.root_of(X[0]) is X[0]
+    assert F.depth(X[0]) == 0
+
+    # 0 <- 1 <- 2,  1 <- 3
+    F.link(X[1], X[0])
+    F.link(X[2], X[1])
+    F.link(X[3], X[1])
+    assert F.root_of(X[2]) is X[0]
+    assert [F.depth(x) for x in X] == [0, 1, 2, 2, 0]
+    assert F.lca(X[2], X[3]) is X[1]
+    assert F.lca(X[2], X[4]) is None
+    assert F.is_ancestor(X[0], X[3])
+    assert not F.is_ancestor(X[2], X[3])
+
+    F.cut(X[1])
+    assert F.root_of(X[3]) is X[1]
+    assert F.depth(X[2]) == 1
+    F.cut(X[1])
+    assert F.depth(X[1]) == 0
+
+
+def test_link_cut_forest_random():
+    rng = random.Random(2)
+    F = LinkCutForest('_node')
+    X = [Item(i) for i in range(100)]
+
+    def ancestors(x):
+        chain = []
+        while x.parent is not None:
+            x = x.parent
+            chain.append(x)
+        return chain
+
+    for step in range(2000):
+        a, b = rng.choice(X), rng.choice(X)
+        if a.parent is not None:
+            F.cut(a)
+            a.parent = None
+        elif a is not b and a not in ancestors(b):
+            F.link(a, b)
+            a.parent = b
+
+        x, y = rng.choice(X), rng.choice(X)
+        chain = ancestors(x)
+        assert F.depth(x) == len(chain)
+        assert F.root_of(x) is (chain[-1] if chain else x)
+        assert F.is_ancestor(y, x) == (y is x or y in chain)
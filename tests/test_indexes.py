@@ -0,0 +1,425 @@
+'''
+Test module for indexes
+
+@author: vsam
+'''
+
+import random
+import pytest
+from modeling.mf import *
+from modeling.indexes import ReachabilityIndex, DynamicTopologicalOrder, ClosureCache, \
+    TreeIntervalIndex, JumpPointerIndex
+
+
+def test_reachability_index():
+
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs(lazy=True)
+
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+
+    rng = random.Random(7)
+    V = [Vertex() for i in range(25)]
+    E = []
+    def connect(u, v):
+        e = Edge()
+        e.source, e.destination = u, v
+        E.append(e)
+    for i in range(20):
+        connect(rng.choice(V), rng.choice(V))
+
+    path = (Vertex.outgoing, Edge.destination)
+    index = ReachabilityIndex(path, V[:5])
+    closure = compile_path(path)
+
+    def check():
+        for v in V:
+            expected = set(closure([v]))
+            assert index.reachable_from(v) == expected
+            for w in V:
+                assert index.reachable(v, w) == (w in expected)
+
+    check()
+    for step in range(60):
+        if E and rng.random() < 0.4:
+            e = E.pop(rng.randrange(len(E)))
+            if rng.random() < 0.5:
+                e.source = None
+            else:
+                e.destination = None
+        else:
+            connect(rng.choice(V), rng.choice(V))
+        if step % 10 == 0:
+            check()
+    check()
+    assert index.stats['links'] > 0 and index.stats['unlinks'] > 0
+    assert index.stats['pairs_added'] - index.stats['pairs_removed'] == len(index)
+
+    # after closing, the index is no longer maintained
+    index.close()
+    links = index.stats['links']
+    connect(V[0], V[1])
+    assert index.stats['links'] == links
+
+
+def test_reachability_index_symmetric():
+
+    @model
+    class Node:
+        neighbours = refs(inv=True)
+
+    a, b, c, d = (Node() for i in range(4))
+    index = ReachabilityIndex(Node.neighbours, [a])
+    a.neighbours.add(b)
+    b.neighbours.add(c)
+    assert index.reachable(a, c) and index.reachable(c, a)
+    assert not index.reachable(a, d)
+    c.neighbours.remove(b)
+    assert index.reachable(b, a) and not index.reachable(a, c)
+
+    # links outside the stored sets store nothing until queried
+    stored = set(index.reach)
+    e, f = Node(), Node()
+    e.neighbours.add(f)
+    d.neighbours.add(e)
+    assert set(index.reach) == stored
+    assert index.reachable(d, f) and not index.reachable(f, a)
+    index.close()
+
+
+def test_dynamic_topological_order():
+
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs()
+
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+
+    def has_cycle(V):
+        # a vertex graph is acyclic iff repeatedly removing sinks empties it
+        out = {v: {e.destination for e in v.outgoing if e.destination is not None} for v in V}
+        while True:
+            sinks = [v for v in out if not out[v]]
+            if not sinks:
+                return bool(out)
+            for v in sinks:
+                del out[v]
+            for v in out:
+                out[v].difference_update(sinks)
+
+    rng = random.Random(13)
+    V = [Vertex() for i in range(20)]
+    E = []
+    found = []
+    order = DynamicTopologicalOrder((Vertex.outgoing, Edge.destination), V[:3], on_cycle=found.append)
+    assert not order.has_cycle()
+
+    for step in range(300):
+        if len(E) > 25 or (E and rng.random() < 0.3):
+            e = E.pop(rng.randrange(len(E)))
+            e.destination = None
+        else:
+            # mostly forward links, to reach both acyclic and cyclic states
+            a, b = sorted(rng.sample(range(20), 2))
+            if rng.random() < 0.1:
+                a, b = b, a
+            e = Edge()
+            e.source, e.destination = V[a], V[b]
+            E.append(e)
+
+        assert order.has_cycle() == has_cycle(V)
+        for cycle in order.cycles():
+            assert cycle[0] is cycle[-1]
+            for x, y in zip(cycle, cycle[1:]):
+                assert y is x.destination if isinstance(x, Edge) else y in x.outgoing
+        # every link not held back by a cycle respects the order
+        for e in E:
+            links = [((e.source, 0), (e, 1)), ((e, 1), (e.destination, 0))]
+            for x, y in links:
+                if x in order.ord and (x, y) not in order.back:
+                    assert order.ord[x] < order.ord[y]
+            if order.back.keys().isdisjoint(links) and e.source in order.order():
+                assert order.precedes(e.source, e.destination)
+
+    assert found and order.stats['cycles'] >= len(found)
+    order.close()
+
+
+def test_dynamic_topological_order_updates():
+
+    @model
+    class Node:
+        nxt = ref()
+        prv = refs(inv=nxt)
+
+    # re-pointing a link of a held-back cycle to an unordered object
+    a, b, c = Node(), Node(), Node()
+    order = DynamicTopologicalOrder(Node.nxt, [a, b])
+    b.nxt = a
+    a.nxt = b
+    assert order.has_cycle()
+    b.nxt = c
+    assert not order.has_cycle()
+    assert order.precedes(a, b) and order.precedes(b, c)
+    order.close()
+
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs()
+
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+
+    rng = random.Random(61)
+    V = [Vertex() for i in range(12)]
+    E = []
+    order = DynamicTopologicalOrder((Vertex.outgoing, Edge.destination), V)
+    for step in range(400):
+        op = rng.random()
+        if E and op < 0.4:
+            rng.choice(E).destination = rng.choice(V + [None])
+        elif E and op < 0.5:
+            rng.choice(E).source = rng.choice(V)
+        elif E and op < 0.6:
+            swap(rng.choice(E), 'source', 'destination')
+        elif E and op < 0.7:
+            e = rng.choice(E)
+            if e.source is not None:
+                move(e, e.source.outgoing, rng.choice(V).outgoing)
+        else:
+            e = Edge()
+            e.source, e.destination = rng.choice(V), rng.choice(V)
+            E.append(e)
+
+        # every link not held back by a cycle respects the order
+        order.has_cycle()
+        for e in E:
+            for x, y in [((e.source, 0), (e, 1)), ((e, 1), (e.destination, 0))]:
+                if x[0] is not None and y[0] is not None and (x, y) not in order.back:
+                    assert order.ord[x] < order.ord[y]
+        assert len(set(order.ord.values())) == len(order.ord)
+    assert order.stats['cycles'] > 0
+    order.close()
+
+
+def test_closure_cache():
+
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs(lazy=True)
+        parent = ref()
+        children = ref_list(inv=parent)
+        friends = refs(inv=True, adjacency=True)
+
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+
+    rng = random.Random(17)
+    V = [Vertex() for i in range(30)]
+    E = []
+    for i in range(40):
+        e = Edge()
+        e.source, e.destination = rng.choice(V), rng.choice(V)
+        E.append(e)
+    for v in V[1:]:
+        v.parent = rng.choice(V[:V.index(v)])
+
+    cache = ClosureCache()
+    paths = [(Vertex.outgoing, Edge.destination), (Vertex.incoming, Edge.source),
+             Vertex.parent, Vertex.children, Vertex.friends]
+
+    def check(seed):
+        for path in paths:
+            expected = set(transitive_closure(seed, path))
+            result = cache.closure(seed, path)
+            assert set(result) == expected and len(result) == len(expected)
+
+    check(V[:2])
+    assert cache.stats['misses'] == len(paths)
+    check(V[:2])
+    check(V[1::-1])
+    assert cache.stats['hits'] == 2*len(paths)
+
+    for step in range(40):
+        op = rng.randrange(5)
+        if op == 0:
+            e = Edge()
+            e.source, e.destination = rng.choice(V), rng.choice(V)
+            E.append(e)
+        elif op == 1:
+            E.pop(rng.randrange(len(E))).destination = rng.choice([None, rng.choice(V)])
+        elif op == 2:
+            v = rng.choice(V[1:])
+            v.parent = rng.choice(V[:V.index(v)])
+        elif op == 3:
+            rng.choice(V).children.reverse()
+        else:
+            rng.choice(V).friends.add(rng.choice(V))
+        check(V[:2])
+        check([rng.choice(V)])
+    assert cache.stats['invalidated'] > 0
+
+    # eviction
+    small = ClosureCache(maxsize=3)
+    for v in V[:5]:
+        small.closure([v], Vertex.parent)
+    assert len(small) == 3 and small.stats['evicted'] == 2
+    small.closure([V[4]], Vertex.parent)
+    assert small.stats['hits'] == 1
+    bounded = ClosureCache(maxobjects=len(V))
+    for v in V[:5]:
+        bounded.closure([v], Vertex.children)
+    assert bounded.objects <= len(V) or len(bounded) == 1
+
+
+def test_tree_interval_index():
+
+    @model
+    class Node:
+        parent = ref()
+        children = refs(inv=parent)
+        friends = refs(inv=True)
+
+    rng = random.Random(23)
+    N = [Node() for i in range(40)]
+    for i in range(1, 40):
+        N[i].parent = rng.choice(N[:i] + [None]*3)
+
+    index = TreeIntervalIndex(Node.children, N)
+    assert index.parent is Node.parent
+
+    def check():
+        for a in N:
+            ancestors = set(transitive_closure([a], Node.parent))
+            for b in N:
+                assert index.is_ancestor(b, a) == (b in ancestors)
+
+    check()
+    assert index.stats['relabeled'] == 1
+
+    # new leaves and detached leaves do not need relabeling
+    for i in range(10):
+        x = Node()
+        x.parent = rng.choice(N)
+        N.append(x)
+    leaf = N[-1]
+    leaf.parent = None
+    leaf.parent = N[0]
+    check()
+    assert index.stats['relabeled'] == 1 and index.stats['inserted'] >= 10
+
+    # other changes relabel lazily
+    for step in range(20):
+        x = rng.choice(N)
+        candidates = [y for y in N if not index.is_ancestor(x, y)]
+        x.parent = rng.choice(candidates + [None])
+        check()
+    assert index.stats['relabeled'] > 1
+
+    with pytest.raises(ValueError):
+        TreeIntervalIndex(Node.friends)
+    index.close()
+
+
+def test_tree_interval_index_unseeded():
+
+    @model
+    class Node:
+        parent = ref()
+        children = refs(inv=parent)
+
+    def is_ancestor(a, b):
+        while b is not None:
+            if b is a:
+                return True
+            b = b.parent
+        return False
+
+    rng = random.Random(67)
+    N = [Node() for i in range(30)]
+    for i in range(1, 30):
+        N[i].parent = rng.choice(N[:i] + [None])
+
+    # no objects are known at first, and queries change the labels
+    index = TreeIntervalIndex(Node.parent)
+    assert index.label(N[-1])[0] <= index.label(N[-1])[1]
+    index = TreeIntervalIndex(Node.parent)
+    for step in range(300):
+        if step % 10 == 0:
+            x = rng.choice(N)
+            x.parent = rng.choice([y for y in N if not is_ancestor(x, y)] + [None])
+        elif step % 10 == 5:
+            x = Node()
+            x.parent = rng.choice(N)
+            N.append(x)
+        a, b = rng.choice(N), rng.choice(N)
+        assert index.is_ancestor(a, b) == is_ancestor(a, b)
+    assert index.stats['relabeled'] > 1
+    index.close()
+
+
+def test_jump_pointer_index():
+
+    @model
+    class Version:
+        previous = ref()
+        next = refs(inv=previous)
+
+    rng = random.Random(29)
+    V = [Version() for i in range(300)]
+    for i in range(1, 300):
+        # mostly long chains
+        V[i].previous = V[i-1] if rng.random() < 0.9 else rng.choice(V[:i] + [None])
+
+    index = JumpPointerIndex(Version.previous)
+
+    def ancestors(x):
+        return list(transitive_closure([x], Version.previous))
+
+    def check(sample):
+        for x in sample:
+            chain = ancestors(x)
+            assert index.depth(x) == len(chain) - 1
+            assert index.root(x) is chain[-1]
+            for k in (0, 1, 2, 5, len(chain)//2, len(chain)-1, len(chain)):
+                assert index.level_ancestor(x, k) is (chain[k] if k < len(chain) else None)
+            y = rng.choice(V)
+            other = ancestors(y)
+            common = [a for a in chain if a in other]
+            assert index.lca(x, y) is (common[0] if common else None)
+
+    check(V)
+    computed = index.stats['computed']
+
+    # appending to chains does not invalidate the index
+    for i in range(50):
+        v = Version()
+        v.previous = rng.choice(V)
+        V.append(v)
+    check(V[-50:])
+    assert index.stats['invalidated'] == 0
+    assert index.stats['computed'] == computed + 50
+
+    # other changes do
+    for step in range(10):
+        x = rng.choice(V)
+        candidates = [y for y in V if x not in ancestors(y)]
+        x.previous = rng.choice(candidates + [None])
+        check(rng.sample(V, 30))
+    assert index.stats['invalidated'] > 0
+    index.close()
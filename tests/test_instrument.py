@@ -7,7 +7,7 @@ from modeling.instrument import Associator, SingletonAssociation, SetAssociation
     OrderedAssociation, AssociationDuplicateError, attribute_descriptor,\
     one_relationship_descriptor, many_relationship_descriptor,\
     ordered_relationship_descriptor, SingletonAssociator, SetAssociator,\
-    OrderedAssociator, PeerlessAssociator, attr_descriptor
+    OrderedAssociator, PeerlessAssociator, attr_descriptor, AssociationTypeError
 import pytest
 
 
@@ -49,6 +49,157 @@ def test_SetAssociation():
     assert S.isdisjoint(set())
     
 
+def test_SetAssociation_snapshot_iteration():
+    
+    S = SetAssociation(None, PeerlessAssociator(int))
+    S.assign({1,2,3})
+    
+    # mutating from inside the loop body
+    seen = set()
+    for x in S:
+        seen.add(x)
+        S.discard(x)
+        S.add(x+10)
+    assert seen == {1,2,3}
+    assert S == {11,12,13}
+    
+    # an outstanding snapshot is not affected by writes
+    it = iter(S)
+    storage = S.elements
+    S.add(20)
+    assert S.elements is not storage
+    assert set(it) == {11,12,13}
+    assert S == {11,12,13,20}
+    
+    # only the first write after a snapshot copies the list
+    iter(S)
+    storage = S.elements
+    S.add(21)
+    assert S.elements is not storage and not S.shared
+    storage = S.elements
+    S.discard(11)
+    S.add(22)
+    assert S.elements is storage
+    
+    # clear while iterating
+    for x in S:
+        S.clear()
+    assert len(S)==0
+
+
+def test_SetAssociation_any_sample():
+    import random
+    
+    S = SetAssociation(None, PeerlessAssociator(int))
+    with pytest.raises(KeyError):
+        S.any()
+    
+    S.assign(range(100))
+    assert S.any() in S
+    for x in range(0, 100, 3):
+        S.discard(x)
+    assert S.any() in S
+    assert set(S.elements) == set(S) and len(S.elements) == len(S)
+    assert all(S.elements[i] == x for x, i in S.values.items())
+    
+    rng = random.Random(1)
+    sample = S.sample(10, rng)
+    assert len(set(sample)) == 10 and set(sample) <= set(S)
+    assert S.sample(10, random.Random(1)) == sample
+    assert sorted(S.sample(len(S))) == sorted(S)
+    with pytest.raises(ValueError):
+        S.sample(len(S)+1)
+
+
+def test_association_versions():
+    S = SetAssociation(None, PeerlessAssociator(int))
+    v = S.version
+    S.add(1)
+    S.add(1)
+    assert S.version == v+1
+    S.discard(2)
+    assert S.version == v+1
+    S.discard(1)
+    S.link_many([3, 4])
+    S.clear()
+    assert S.version == v+4
+
+    L = OrderedAssociation(None, PeerlessAssociator(int))
+    v = L.version
+    L.assign([1, 2, 3])
+    L[0] = 5
+    L[1:2] = [6, 7]
+    del L[0]
+    L.insert(0, 8)
+    L.reverse()
+    L.sort()
+    assert L.version == v+9
+
+
+def test_OrderedAssociation_snapshot_iteration():
+    
+    L = OrderedAssociation(None, PeerlessAssociator(int))
+    L.assign([1,2,3])
+    
+    for x in L:
+        L.remove(x)
+        L.append(x+10)
+    assert list(L) == [11,12,13]
+    
+    it = iter(L)
+    L.reverse()
+    L.insert(0, 5)
+    assert list(it) == [11,12,13]
+    assert list(L) == [5,13,12,11]
+    
+    iter(L)
+    seq = L.seq
+    L.sort()
+    assert L.seq is not seq and not L.shared
+    seq = L.seq
+    L.reverse()
+    L.reverse()
+    assert L.seq is seq
+    assert list(L) == [5,11,12,13]
+
+
+@pytest.mark.parametrize('cls', [SetAssociation, OrderedAssociation])
+def test_snapshot_threads(cls):
+    import sys, threading
+
+    # the writer replaces k by k+N, so the contents are always a range
+    # of N or N+1 integers; readers in other threads check every snapshot
+    N = 20
+    C = cls(None, PeerlessAssociator(int))
+    C.link_many(list(range(N)))
+    done = threading.Event()
+    errors = []
+
+    def reader():
+        while not done.is_set():
+            got = [x for x in C]
+            lo = min(got)
+            if sorted(got) != list(range(lo, lo+len(got))) or len(got) not in (N, N+1):
+                errors.append(got)
+                return
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        readers = [threading.Thread(target=reader) for i in range(3)]
+        for t in readers:
+            t.start()
+        for k in range(200000):
+            C.link(k+N)
+            C.unlink(k)
+        done.set()
+        for t in readers:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
+    
+
 
 
 
@@ -619,6 +770,108 @@ def test_relationship_descriptor_one_to_ordered():
         etc.contents.remove(15)
     
 
+def test_relationship_descriptor_codegen():
+    class Node:
+        pass
+    
+    Node.mate = one_relationship_descriptor('mate', Node)
+    Node.mate.initialize(Node.mate)
+    
+    # the class was replaced by a compiled subclass
+    assert type(Node.mate) is not one_relationship_descriptor
+    assert isinstance(Node.mate, one_relationship_descriptor)
+    assert Node.mate.generic_class is one_relationship_descriptor
+    
+    a, b, c = Node(), Node(), Node()
+    a.mate = b
+    assert b.mate is a
+    c.mate = b
+    assert b.mate is c
+    assert a.mate is None
+    
+    # self-loop
+    a.mate = a
+    assert a.mate is a
+    a.mate = c
+    assert c.mate is a
+    assert b.mate is None
+    
+    with pytest.raises(ValueError):
+        a.mate = 1
+    with pytest.raises(AssociationTypeError):
+        Node.mate.validate_object(1)
+
+
+@pytest.mark.parametrize("kind1,kind2", [
+    ('ONE','ONE'), ('ONE','MANY'), ('MANY','ONE'), ('MANY','MANY'),
+    ('ONE','ORDERED'), ('ORDERED','MANY'), ('ONE',None), ('MANY',None)])
+def test_relationship_descriptor_observers(kind1, kind2):
+    from random import choice, randint
+    Desc = {'ONE': one_relationship_descriptor,
+            'MANY': many_relationship_descriptor,
+            'ORDERED': ordered_relationship_descriptor}
+    
+    class Node:
+        pass
+    
+    Node.a = Desc[kind1]('a', Node)
+    if kind2 is None:
+        # symmetric
+        Node.a.initialize(Node.a)
+        Node.b = Node.a
+    else:
+        Node.b = Desc[kind2]('b', Node)
+        Node.a.initialize(Node.b)
+        Node.b.initialize(Node.a)
+    
+    # maintain the set of links from the notifications
+    links = set()
+    def observer(own, other, linked):
+        if linked:
+            assert (own, other) not in links
+            links.add((own, other))
+        else:
+            links.remove((own, other))
+        if kind2 is None:
+            # symmetric links are not oriented
+            if linked:
+                links.add((other, own))
+            else:
+                links.discard((other, own))
+    Node.a.observe(observer)
+    
+    def members(d, n):
+        v = d.__get__(n, Node)
+        if isinstance(d, one_relationship_descriptor):
+            return [] if v is None else [v]
+        return list(v)
+    
+    def actual():
+        L = set()
+        for n in nodes:
+            L.update((n, x) for x in members(Node.a, n))
+            L.update((x, n) for x in members(Node.b, n))
+        return L
+    
+    def update(d, kind, n, x):
+        if kind == 'ONE':
+            d.__set__(n, x)
+        elif x is not None:
+            c = d.__get__(n, Node)
+            if x in c:
+                c.remove(x)
+            elif kind == 'MANY':
+                c.add(x)
+            else:
+                c.insert(randint(0, len(c)), x)
+    
+    nodes = [Node() for i in range(8)]
+    for it in range(300):
+        update(Node.a, kind1, choice(nodes), choice(nodes+[None]))
+        update(Node.b, kind2 or kind1, choice(nodes), choice(nodes+[None]))
+        assert links == actual()
+
+
 def test_attribute_codegen():
 
     class Foo:
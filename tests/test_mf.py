@@ -666,6 +666,886 @@ def test_forward_declarations():
     
     
 
+def test_cardinality():
+    from modeling.instrument import AssociationCardinalityError
+    
+    @model
+    class Res:
+        owner_edges = refs(max=1)
+    
+    @model
+    class Edge:
+        src = ref(inv=Res.owner_edges)
+        tags = ref_list(inv=True, max=2)
+    
+    assert validate_classes({Res, Edge})
+    
+    r = Res()
+    e1, e2, e3, e4 = Edge(), Edge(), Edge(), Edge()
+    e1.src = r
+    with pytest.raises(AssociationCardinalityError):
+        e2.src = r
+    assert e2.src is None
+    assert set(r.owner_edges) == {e1}
+    
+    with pytest.raises(AssociationCardinalityError):
+        r.owner_edges.add(e2)
+    assert e2.src is None
+    
+    # replacing the member keeps the count
+    e1.src = None
+    e2.src = r
+    assert set(r.owner_edges) == {e2}
+    
+    # ordered, symmetric
+    e1.tags.append(e2)
+    e1.tags.append(e3)
+    with pytest.raises(AssociationCardinalityError):
+        e4.tags.append(e1)    # e1 is full
+    assert len(e4.tags) == 0
+    with pytest.raises(AssociationCardinalityError):
+        e1.tags[:] = [e2, e3, e1]
+    assert list(e1.tags) == [e2, e3]
+    assert list(e3.tags) == [e1]
+    
+
+def test_validate_objects_cardinality():
+    
+    @model
+    class Project:
+        members = refs(min=1, max=2)
+        
+    @model
+    class Member:
+        project = ref(inv=Project.members)
+        
+    p = Project()
+    assert not validate_objects([p])
+    m = Member()
+    m.project = p
+    assert validate_objects([p, m])
+    
+    with pytest.raises(ValueError):
+        refs(min=-1)
+    with pytest.raises(ValueError):
+        refs(max=0)
+
+
+def test_relationship_view():
+    from random import choice, randint
+    
+    @model
+    class Node:
+        out = refs()
+        inc = refs()
+        
+    @model
+    class Arc:
+        src = ref(inv=Node.out)
+        dst = ref(inv=Node.inc)
+        weight = attr(int, default=0)
+        
+    @model
+    class Hub:
+        spokes = refs(inv=True)
+    
+    nodes = [Node() for i in range(5)]
+    arcs = [Arc() for i in range(20)]
+    
+    heavy = Node.out.where(lambda a: a.weight > 5, depends_on=['weight'])
+    linked = Node.out.where(lambda a: a.dst is not None, depends_on=['dst'])
+    
+    # materialize the view of some nodes before any changes
+    heavy(nodes[0])
+    
+    for it in range(500):
+        a = choice(arcs)
+        op = randint(0, 4)
+        if op == 0:
+            a.src = choice(nodes + [None])
+        elif op == 1:
+            a.weight = randint(0, 10)
+        elif op == 2:
+            choice(nodes).out.add(a)
+        elif op == 3:
+            choice(nodes).out.discard(a)
+        else:
+            a.dst = choice(nodes + [None])
+        
+        for n in nodes:
+            assert heavy(n) == {x for x in n.out if x.weight > 5}
+            assert linked(n) == {x for x in n.out if x.dst is not None}
+    
+    with pytest.raises(TypeError):
+        heavy(nodes[0]).add(arcs[0])
+
+    # a closed view is no longer maintained
+    calls = []
+    spy = Node.out.where(lambda a: calls.append(a) or True, depends_on=['weight', 'dst'])
+    spy(nodes[0])
+    spy.close()
+    heavy.close()
+    assert not any(hasattr(n, spy.slot) or hasattr(n, heavy.slot) for n in nodes)
+    assert Arc.weight.observers == []
+    del calls[:]
+    arcs[0].weight += 1
+    arcs[0].dst = nodes[1]
+    nodes[0].out.add(arcs[1])
+    assert calls == []
+    assert linked(nodes[0]) == {x for x in nodes[0].out if x.dst is not None}
+
+    # symmetric relationships
+    hubs = [Hub() for i in range(4)]
+    big = Hub.spokes.where(lambda h: len(h.spokes) > 1, depends_on=['spokes'])
+    for h in hubs:
+        big(h)
+    hubs[0].spokes.add(hubs[1])
+    hubs[0].spokes.add(hubs[2])
+    hubs[3].spokes.add(hubs[3])
+    assert big(hubs[1]) == {hubs[0]}
+    assert big(hubs[0]) == set()
+    hubs[1].spokes.add(hubs[2])
+    assert big(hubs[0]) == {hubs[1], hubs[2]}
+    assert big(hubs[3]) == set()
+    hubs[3].spokes.add(hubs[0])
+    assert big(hubs[3]) == {hubs[0], hubs[3]}
+
+
+def test_rewiring():
+    from modeling.instrument import AssociationCardinalityError
+    
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs(max=2)
+    
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+        
+    a, b, c = Vertex(), Vertex(), Vertex()
+    e = Edge()
+    e.source, e.destination = a, b
+    
+    swap(e, 'source', 'destination')
+    assert e.source is b and e.destination is a
+    assert set(a.incoming) == {e} and set(b.outgoing) == {e}
+    assert len(a.outgoing) == 0 and len(b.incoming) == 0
+    
+    # a failing swap changes nothing
+    for i in range(2):
+        f = Edge()
+        f.destination = b
+    with pytest.raises(AssociationCardinalityError):
+        swap(e, 'source', 'destination')
+    assert e.source is b and e.destination is a
+    
+    with pytest.raises(TypeError):
+        swap(e, 'source', 'foo')
+
+
+def test_move():
+    
+    @model
+    class Table:
+        rows = ref_list()
+        tags = ref_list()
+    
+    @model
+    class Row:
+        table = ref(inv=Table.rows)
+        tagged = refs(inv=Table.tags)
+        
+    t1, t2 = Table(), Table()
+    rows = [Row() for i in range(4)]
+    t1.rows = rows[:3]
+    t2.rows = rows[3:]
+    
+    links = []
+    Table.rows.observe(lambda t, r, linked: links.append((t, r, linked)))
+    
+    # within the same container, the peer is not touched
+    move(rows[2], t1.rows, t1.rows, 0)
+    assert list(t1.rows) == [rows[2], rows[0], rows[1]]
+    assert links == []
+    
+    # between containers of the same relationship
+    move(rows[0], t1.rows, t2.rows, 0)
+    assert list(t1.rows) == [rows[2], rows[1]]
+    assert list(t2.rows) == [rows[0], rows[3]]
+    assert rows[0].table is t2
+    assert links == [(t1, rows[0], False), (t2, rows[0], True)]
+    
+    with pytest.raises(ValueError):
+        move(rows[0], t1.rows, t2.rows)
+    
+    # many-to-ordered
+    t1.tags = rows
+    move(rows[1], t1.tags, t2.tags)
+    assert list(t2.tags) == [rows[1]]
+    assert set(rows[1].tagged) == {t2}
+    assert rows[1] not in t1.tags
+    
+    replace(t1.tags, rows[0], rows[1])
+    assert list(t1.tags) == [rows[1], rows[2], rows[3]]
+    assert set(rows[0].tagged) == set()
+    t3 = Table()
+    replace(rows[2].tagged, t1, t3)
+    assert set(rows[2].tagged) == {t3}
+    assert list(t3.tags) == [rows[2]]
+    assert list(t1.tags) == [rows[1], rows[3]]
+
+    # between different relationships
+    from modeling.instrument import AssociationCardinalityError, AssociationDuplicateError
+
+    @model
+    class Shelf:
+        items = ref_list()
+        picks = refs(max=1)
+
+    @model
+    class Item:
+        shelf = ref(inv=Shelf.items)
+        picked = refs(inv=Shelf.picks, max=1)
+
+    s1, s2 = Shelf(), Shelf()
+    items = [Item() for i in range(3)]
+    s1.items = items
+
+    # ref_list to refs
+    move(items[0], s1.items, s2.picks)
+    assert list(s1.items) == items[1:]
+    assert items[0].shelf is None
+    assert set(s2.picks) == {items[0]}
+    assert set(items[0].picked) == {s2}
+
+    # a full target, a full peer side and a duplicate leave the source as it was
+    with pytest.raises(AssociationCardinalityError):
+        move(items[1], s1.items, s2.picks)
+    s1.picks.add(items[2])
+    with pytest.raises(AssociationCardinalityError):
+        move(items[2], s1.items, s2.picks)
+    s1.items.append(items[0])
+    with pytest.raises(AssociationDuplicateError):
+        move(items[0], s1.items, s2.picks)
+    assert list(s1.items) == items[1:] + [items[0]]
+    assert all(x.shelf is s1 for x in items)
+    assert set(s2.picks) == {items[0]}
+    assert set(s1.picks) == {items[2]}
+
+
+def test_adjacency_symmetric_relationship():
+    from modeling.instrument import AdjacencyAssociation, AssociationCardinalityError
+    
+    @model
+    class Vertex:
+        adjacent = refs(inv=True, adjacency=True)
+        hub = refs(inv=True, adjacency=True, max=2)
+    
+    assert validate_classes([Vertex])
+    with pytest.raises(ValueError):
+        refs(adjacency=True)
+    
+    V = [Vertex() for i in range(5)]
+    for u in V:
+        for v in V:
+            if u is not v:
+                u.adjacent.add(v)
+    for u in V:
+        assert isinstance(u.adjacent, AdjacencyAssociation)
+        assert len(u.adjacent) == 4
+        assert u not in u.adjacent
+        
+    links = []
+    Vertex.adjacent.observe(lambda a, b, linked: links.append((a, b, linked)))
+    
+    # single-call edge removal and insertion, notified once
+    Vertex.adjacent.disconnect(V[0], V[1])
+    assert V[1] not in V[0].adjacent and V[0] not in V[1].adjacent
+    assert links == [(V[0], V[1], False)]
+    Vertex.adjacent.connect(V[1], V[0])
+    assert V[1] in V[0].adjacent and V[0] in V[1].adjacent
+    assert len(links) == 2
+    
+    # self-loops
+    V[0].adjacent.add(V[0])
+    assert V[0] in V[0].adjacent and len(V[0].adjacent) == 5
+    V[0].adjacent.discard(V[0])
+    assert len(V[0].adjacent) == 4
+    
+    # iteration over a snapshot, while mutating
+    for v in V[0].adjacent:
+        V[0].adjacent.discard(v)
+        assert V[0] not in v.adjacent
+    assert len(V[0].adjacent) == 0
+
+    # containers persist, and the ids of objects without neighbours are reused
+    desc = Vertex.adjacent
+    assert V[0].adjacent is V[0].adjacent
+    assert V[0].adjacent.node == -1 and desc.free == [0]
+    assert list(V[1].adjacent.ids) == sorted(V[1].adjacent.ids)
+    assert desc.neighbours(V[1]) == [desc.nodes[i] for i in V[1].adjacent.ids]
+    w = Vertex()
+    w.adjacent.add(V[1])
+    assert w.adjacent.node == 0 and desc.nodes[0] is w and desc.free == []
+    assert set(V[1].adjacent) == set(V[2:]) | {w}
+    w.adjacent.clear()
+    assert desc.nodes[0] is None and w not in V[1].adjacent
+    assert set(V[1].adjacent.sample(3)) == set(V[2:])
+    assert V[1].adjacent.any() in V[2:]
+    
+    V[0].adjacent = V[1:3]
+    assert set(V[0].adjacent) == {V[1], V[2]}
+    
+    V[0].hub.add(V[1])
+    V[0].hub.add(V[2])
+    with pytest.raises(AssociationCardinalityError):
+        V[3].hub.add(V[0])
+    assert V[0] not in V[3].hub
+
+    assert validate_objects(V)
+
+
+def test_adjacency_memory():
+    import random, tracemalloc
+
+    def edge_memory(adjacency):
+        @model
+        class Vertex:
+            adjacent = refs(inv=True, adjacency=adjacency)
+
+        rng = random.Random(3)
+        V = [Vertex() for i in range(500)]
+        edges = [(rng.choice(V), rng.choice(V)) for i in range(2000)]
+        tracemalloc.start()
+        for a, b in edges:
+            a.adjacent.add(b)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size
+
+    assert edge_memory(True) < edge_memory(False) / 2
+
+
+def test_edge_relationship():
+    from modeling.instrument import EdgeAssociation
+    
+    @model
+    class City:
+        roads = edge_refs(payload={'length':'d', 'name':None})
+        incoming = edge_refs(inv=roads)
+        
+    assert validate_classes([City])
+    
+    a, b, c = City(), City(), City()
+    a.roads.add(b, length=10.0, name='ab')
+    a.roads.add(c, length=20.0)
+    c.roads.add(b)
+    
+    assert isinstance(a.roads, EdgeAssociation)
+    assert len(a.roads) == 2 and b in a.roads
+    assert a.roads[b] == (10.0, 'ab')
+    assert a.roads[c].length == 20.0 and a.roads[c].name is None
+    assert sorted((r.length, r.name is None) for x, r in b.incoming) == [(0.0, True), (10.0, False)]
+    assert {x for x, r in b.incoming} == {a, c}
+    assert City.roads.table is City.incoming.table
+    assert len(City.roads.table) == 3
+    
+    # payload updates are seen from both ends
+    a.roads.add(b, length=15.0)
+    assert b.incoming[a] == (15.0, 'ab')
+    City.incoming.update(c, a, name='ac')
+    assert a.roads[c].name == 'ac'
+    
+    with pytest.raises(TypeError):
+        a.roads.add(b, width=3)
+    with pytest.raises(TypeError):
+        a.roads.add(1)
+    
+    # removal from either end, while iterating
+    for x, r in b.incoming:
+        b.incoming.discard(x)
+    assert len(b.incoming) == 0 and b not in a.roads and b not in c.roads
+    assert len(City.roads.table) == 1
+    
+    a.roads = [b, (c, {'length':5.0})]
+    assert a.roads[c].length == 5.0 and a.roads[b].length == 0.0
+    assert len(City.roads.table) == 2
+    
+    links = []
+    City.roads.observe(lambda own, other, linked: links.append((own, other, linked)))
+    c.incoming.remove(a)
+    assert links == [(a, c, False)]
+    
+    @model
+    class Place:
+        near = edge_refs(inv=True, payload=('distance',))
+    
+    p, q = Place(), Place()
+    p.near.add(q, distance=1)
+    assert q.near[p].distance == 1
+    q.near.discard(p)
+    assert len(p.near) == 0
+
+
+def test_load_edges():
+    from modeling.instrument import AssociationDuplicateError, AssociationCardinalityError
+    
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = ref_list(max=3)
+        parent = ref()
+        children = refs(inv=parent)
+        adjacent = refs(inv=True)
+    
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+        
+    V = [Vertex() for i in range(6)]
+    E = [Edge() for i in range(6)]
+    
+    links = []
+    Vertex.outgoing.observe(lambda v, e, linked: links.append((v, e, linked)))
+    assert load_edges(Vertex.outgoing, [0, 0, 1, 2, 3, 3], list(range(6, 12)), V+E) == 6
+    assert [e.source for e in E] == [V[0], V[0], V[1], V[2], V[3], V[3]]
+    assert set(V[0].outgoing) == {E[0], E[1]}
+    assert len(links) == 6
+    
+    # nothing is changed by a failing batch
+    with pytest.raises(AssociationCardinalityError):
+        load_edges(Edge.destination, [E[0], E[0]], [V[0], V[1]])
+    with pytest.raises(AssociationCardinalityError):
+        load_edges(Edge.source, [E[0]], [V[1]])
+    with pytest.raises(AssociationDuplicateError):
+        load_edges(Vertex.outgoing, [V[4], V[4]], [E[0], E[0]])
+    with pytest.raises(AssociationDuplicateError):
+        load_edges(Vertex.outgoing, [V[0]], [E[0]])
+    with pytest.raises(TypeError):
+        load_edges(Vertex.outgoing, [V[4]], [V[5]])
+    with pytest.raises(ValueError):
+        load_edges(Vertex.outgoing, [V[4]], [])
+    assert all(e.destination is None for e in E)
+    
+    load_edges(Vertex.incoming, [V[1], V[1], V[1]], E[:3])
+    assert list(V[1].incoming) == E[:3]
+    assert E[2].destination is V[1]
+    with pytest.raises(AssociationCardinalityError):
+        load_edges(Vertex.incoming, [V[1]], [E[3]])
+    
+    load_edges(Vertex.parent, V[1:4], [V[0]]*3)
+    assert set(V[0].children) == set(V[1:4])
+    assert V[2].parent is V[0]
+    
+    load_edges(Vertex.adjacent, [V[0], V[1], V[2]], [V[1], V[2], V[2]])
+    assert set(V[1].adjacent) == {V[0], V[2]}
+    assert set(V[2].adjacent) == {V[1], V[2]}
+    with pytest.raises(AssociationDuplicateError):
+        load_edges(Vertex.adjacent, [V[3], V[4]], [V[4], V[3]])
+    with pytest.raises(AssociationDuplicateError):
+        load_edges(Vertex.adjacent, [V[1]], [V[0]])
+        
+    numpy = pytest.importorskip('numpy')
+    load_edges(Vertex.adjacent, numpy.array([3, 4]), numpy.array([4, 5]), V)
+    assert set(V[4].adjacent) == {V[3], V[5]}
+
+    # handle arrays are checked by the vectorized pre-pass
+    W = [Vertex() for i in range(4)]
+    F = [Edge() for i in range(8)]
+    objs = W + F
+    h = numpy.array
+    with pytest.raises(AssociationDuplicateError):
+        load_edges(Vertex.outgoing, h([0, 0]), h([4, 4]), objs)
+    with pytest.raises(AssociationCardinalityError):
+        load_edges(Vertex.outgoing, h([0, 1]), h([4, 4]), objs)
+    with pytest.raises(AssociationCardinalityError):
+        load_edges(Vertex.incoming, h([0, 0, 0, 0]), h([4, 5, 6, 7]), objs)
+    with pytest.raises(AssociationDuplicateError):
+        load_edges(Vertex.adjacent, h([0, 1]), h([1, 0]), W)
+    with pytest.raises(TypeError):
+        load_edges(Vertex.outgoing, h([0]), h([1]), objs)
+    assert all(f.source is None and f.destination is None for f in F)
+
+    assert load_edges(Vertex.outgoing, h([0, 0, 1, 2]), h([4, 5, 6, 7]), objs) == 4
+    assert set(W[0].outgoing) == {F[0], F[1]} and F[2].source is W[1]
+    load_edges(Vertex.incoming, h([3, 3, 3]), h([4, 5, 6]), objs)
+    assert list(W[3].incoming) == F[:3] and F[1].destination is W[3]
+    with pytest.raises(AssociationDuplicateError):
+        load_edges(Vertex.outgoing, h([0]), h([4]), objs)
+    with pytest.raises(AssociationCardinalityError):
+        load_edges(Vertex.outgoing, h([3]), h([4]), objs)
+    with pytest.raises(AssociationCardinalityError):
+        load_edges(Vertex.incoming, h([3]), h([7]), objs)
+    load_edges(Vertex.adjacent, h([0, 1, 2]), h([1, 2, 2]), W)
+    assert set(W[1].adjacent) == {W[0], W[2]} and set(W[2].adjacent) == {W[1], W[2]}
+    with pytest.raises(AssociationDuplicateError):
+        load_edges(Vertex.adjacent, h([1]), h([0]), W)
+
+
+def test_lazy_relationship():
+    
+    @model
+    class Node:
+        outgoing = refs()
+        incoming = refs(lazy=True)
+        members = ref_list(lazy=True)
+        
+    @model
+    class Arc:
+        source = ref(inv=Node.outgoing)
+        destination = ref(inv=Node.incoming)
+        groups = refs(inv=Node.members)
+        
+    assert validate_classes([Node, Arc])
+    with pytest.raises(ValueError):
+        refs(lazy=True, max=2)
+    
+    N = [Node() for i in range(3)]
+    A = [Arc() for i in range(6)]
+    for i,a in enumerate(A):
+        a.source, a.destination = N[i%3], N[(i+1)%3]
+    
+    # writes are logged
+    assert len(Node.incoming.log) == 6*3
+    assert not hasattr(N[1], Node.incoming.attr_name)
+    # and applied on first read
+    assert set(N[1].incoming) == {A[0], A[3]}
+    assert Node.incoming.log == []
+    
+    # moves and removals
+    A[0].destination = N[2]
+    A[3].destination = None
+    A[3].destination = N[1]
+    Node.incoming.flush()
+    assert set(N[1].incoming) == {A[3]}
+    assert set(N[2].incoming) == {A[0], A[1], A[4]}
+    
+    # writes to the lazy side are eager on its peer
+    N[0].incoming.add(A[0])
+    assert A[0].destination is N[0]
+    assert A[0] not in N[2].incoming
+    N[0].incoming.discard(A[0])
+    assert A[0].destination is None and len(N[0].incoming) == 2
+    
+    for a in A:
+        a.groups.add(N[0])
+    A[2].groups.discard(N[0])
+    A[2].groups.add(N[0])
+    assert list(N[0].members) == [A[0], A[1], A[3], A[4], A[5], A[2]]
+    
+    A[1].groups = []
+    assert A[1] not in N[0].members
+
+    # held containers apply the pending updates when read
+    h, m = N[1].incoming, N[0].members
+    A[5].destination = N[1]
+    assert Node.incoming.log
+    assert A[5] in h and len(h) == 2
+    assert set(h) == {A[3], A[5]}
+    A[1].groups.add(N[0])
+    assert m[-1] is A[1] and A[1] in m
+    A[1].groups.discard(N[0])
+    assert list(m) == [A[0], A[3], A[4], A[5], A[2]]
+
+    # the invariant holds when read
+    for n in N:
+        for a in n.incoming:
+            assert a.destination is n
+    for a in A:
+        if a.destination is not None:
+            assert a in a.destination.incoming
+
+
+def test_tree_relationship():
+    from modeling.instrument import AssociationCycleError
+    
+    @model
+    class Folder:
+        parent = parent_ref()
+        children = refs(inv=parent)
+    
+    assert validate_classes([Folder])
+    
+    F = [Folder() for i in range(8)]
+    # 0 <- 1 <- 2 <- 3,  0 <- 4 <- 5,  6 <- 7
+    F[1].parent = F[0]
+    F[2].parent = F[1]
+    F[3].parent = F[2]
+    F[0].children.add(F[4])
+    F[4].children.add(F[5])
+    F[7].parent = F[6]
+    
+    tree = Folder.parent
+    assert tree.root_of(F[3]) is F[0] and tree.root_of(F[7]) is F[6]
+    assert [tree.depth(f) for f in F] == [0, 1, 2, 3, 1, 2, 0, 1]
+    assert tree.is_ancestor(F[1], F[3]) and tree.is_ancestor(F[3], F[3])
+    assert not tree.is_ancestor(F[3], F[1]) and not tree.is_ancestor(F[6], F[3])
+    assert tree.lca(F[3], F[5]) is F[0] and tree.lca(F[2], F[3]) is F[2]
+    assert tree.lca(F[3], F[7]) is None
+    
+    # cycles are rejected, from both ends, without changes
+    with pytest.raises(AssociationCycleError):
+        F[1].parent = F[3]
+    with pytest.raises(AssociationCycleError):
+        F[0].parent = F[0]
+    with pytest.raises(AssociationCycleError):
+        F[3].children.add(F[0])
+    assert F[1].parent is F[0] and F[0].parent is None
+    assert F[0] not in F[3].children
+    
+    # re-parenting a subtree
+    F[1].parent = F[5]
+    assert tree.depth(F[3]) == 5 and tree.root_of(F[3]) is F[0]
+    assert F[1] in F[5].children and F[1] not in F[0].children
+    F[5].children.discard(F[1])
+    assert F[1].parent is None
+    assert tree.root_of(F[3]) is F[1] and tree.depth(F[3]) == 2
+    F[6].parent = F[3]
+    assert tree.root_of(F[7]) is F[1] and tree.depth(F[7]) == 4
+    
+    with pytest.raises(AssociationCycleError):
+        move(F[6], F[3].children, F[7].children)
+    move(F[6], F[3].children, F[0].children)
+    assert F[6].parent is F[0] and tree.depth(F[7]) == 2
+    
+    G = [Folder() for i in range(3)]
+    with pytest.raises(AssociationCycleError):
+        load_edges(Folder.parent, G, [G[1], G[2], G[0]])
+    assert all(g.parent is None for g in G)
+    load_edges(Folder.children, [G[0], G[1]], [G[1], G[2]])
+    assert tree.depth(G[2]) == 2
+    
+    # agreement with the parent chains
+    import random
+    rng = random.Random(1)
+    T = [Folder() for i in range(50)]
+    for step in range(500):
+        a, b = rng.choice(T), rng.choice(T + [None])
+        try:
+            a.parent = b
+        except AssociationCycleError:
+            pass
+    for t in T:
+        chain = [t]
+        while chain[-1].parent is not None:
+            chain.append(chain[-1].parent)
+        assert tree.root_of(t) is chain[-1]
+        assert tree.depth(t) == len(chain)-1
+
+
+def test_compile_path():
+    import random
+    
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs(lazy=True)
+        parent = ref()
+        children = ref_list(inv=parent)
+        
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+        
+    rng = random.Random(3)
+    V = [Vertex() for i in range(40)]
+    for i in range(80):
+        e = Edge()
+        e.source, e.destination = rng.choice(V), rng.choice(V)
+    for v in V[1:]:
+        v.parent = rng.choice(V[:V.index(v)])
+        
+    def reachable(seed, succ):
+        seen, stack = set(), list(seed)
+        while stack:
+            x = stack.pop()
+            if x not in seen:
+                seen.add(x)
+                stack.extend(succ(x))
+        return seen
+    
+    forward = compile_path((Vertex.outgoing, Edge.destination))
+    assert compile_path([Vertex.outgoing, Edge.destination]) is forward
+    for v in V[:5]:
+        expected = reachable([v], lambda x: [e.destination for e in x.outgoing])
+        assert set(forward([v])) == expected
+        assert len(list(forward([v]))) == len(expected)
+    
+    # the lazy endpoint is flushed before it is read
+    e = Edge()
+    e.source, e.destination = V[0], V[1]
+    backward = compile_path((Vertex.incoming, Edge.source))
+    assert V[0] in set(backward([V[1]]))
+    assert set(backward([V[1]])) == reachable([V[1]], lambda x: [e.source for e in x.incoming])
+    
+    ancestors = compile_path(Vertex.parent)
+    chain = list(ancestors([V[-1]]))
+    assert chain[0] is V[-1] and chain[-1] is V[0]
+    assert set(compile_path(Vertex.children)([V[0]])) == set(V)
+    
+    # relationship endpoints of the model are accepted as well
+    mV = model_class(Vertex)
+    assert set(transitive_closure([V[0]], mV.get_relationship('children'))) == set(V)
+    
+    with pytest.raises(ValueError):
+        compile_path(())
+
+
+def test_shortest_path():
+    import random
+
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs()
+
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+
+    rng = random.Random(5)
+    V = [Vertex() for i in range(60)]
+    for i in range(90):
+        e = Edge()
+        e.source, e.destination = rng.choice(V), rng.choice(V)
+
+    path = (Vertex.outgoing, Edge.destination)
+    hops, parent = bfs_tree([V[0]], path)
+    assert set(hops) == set(compile_path(path)([V[0]]))
+    for v, h in hops.items():
+        p = path_to(parent, v)
+        assert p[0] is V[0] and p[-1] is v
+        assert len(p) == 2*h + 1
+        assert all(p[i].destination is p[i+1] for i in range(1, len(p), 2))
+        assert all(p[i+1] in p[i].outgoing for i in range(0, len(p)-1, 2))
+    with pytest.raises(KeyError):
+        path_to(parent, Vertex())
+
+    # hop counts are shortest
+    for v, h in hops.items():
+        if h > 0:
+            assert min(hops[p.source] for p in v.incoming if p.source in hops) == h-1
+
+    # early exit and hop limit
+    target = max(hops, key=hops.get)
+    h2, p2 = bfs_tree([V[0]], path, targets=[target])
+    assert h2[target] == hops[target] and len(h2) <= len(hops)
+    h3, p3 = bfs_tree([V[0]], path, max_hops=1)
+    assert set(h3) == {v for v in hops if hops[v] <= 1}
+
+    for a in V[:10]:
+        for b in V[:10]:
+            p1 = shortest_path(a, b, path)
+            p2 = shortest_path(a, b, path, bidirectional=True)
+            if p1 is None:
+                assert p2 is None
+                continue
+            assert len(p1) == len(p2)
+            assert p2[0] is a and p2[-1] is b
+            assert all(p2[i].destination is p2[i+1] for i in range(1, len(p2), 2))
+            assert all(p2[i+1] in p2[i].outgoing for i in range(0, len(p2)-1, 2))
+    assert shortest_path(V[0], V[0], path, bidirectional=True) == [V[0]]
+
+    @model
+    class Node:
+        next = ref()
+    with pytest.raises(ValueError):
+        shortest_path(Node(), Node(), Node.next, bidirectional=True)
+
+
+def test_restricted_closure():
+
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs()
+        active = attr(bool, default=True)
+
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+        weight = attr(int, default=0)
+
+    # a binary tree of vertices, numbered in breadth-first order
+    V = [Vertex() for i in range(31)]
+    for i in range(1, 31):
+        e = Edge()
+        e.source, e.destination, e.weight = V[(i-1)//2], V[i], i % 2
+    path = (Vertex.outgoing, Edge.destination)
+
+    assert set(transitive_closure([V[0]], path)) == set(V)
+    assert list(transitive_closure([V[0]], path, max_depth=2)) == V[:7]
+    assert list(transitive_closure([V[0]], path, limit=5)) == V[:5]
+    assert list(transitive_closure([V[0]], path, limit=0)) == []
+
+    V[1].active = False
+    active = lambda x: not isinstance(x, Vertex) or x.active
+    result = list(transitive_closure([V[0]], path, node=active))
+    assert V[1] not in result and V[3] not in result and V[2] in result
+    assert len(result) == 16
+
+    pruned = list(transitive_closure([V[0]], path, prune=lambda x: x is V[2]))
+    assert V[2] in pruned and V[5] not in pruned and len(pruned) == 17
+
+    odd = list(transitive_closure([V[0]], path, edge=lambda x, y: not isinstance(x, Edge) or x.weight))
+    assert odd == [V[0], V[1], V[3], V[7], V[15]]
+
+    # options combine, and are checked as the traversal proceeds
+    visited = []
+    def check(x):
+        visited.append(x)
+        return active(x)
+    result = list(transitive_closure([V[0]], path, max_depth=3, node=check, limit=3))
+    assert result == [V[0], V[2], V[5]]
+    assert len(visited) < 10
+
+
+def test_batched_closure():
+
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs()
+        parent = ref()
+        children = refs(inv=parent)
+
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+
+    # chains of five vertices, with some links between them, and cycles
+    V = [Vertex() for i in range(40)]
+    for i in range(40):
+        targets = [(i*7 + 3) % 40] if i % 3 == 0 else []
+        if i % 5 != 4:
+            targets.append(i+1)
+        for j in targets:
+            e = Edge()
+            e.source, e.destination = V[i], V[j]
+    for i in range(1, 40):
+        V[i].parent = V[(i-1)//3]
+    path = (Vertex.outgoing, Edge.destination)
+
+    seeds = V[::3] + [V[0]]
+    masks = reachability_masks(seeds, path)
+    for i, s in enumerate(seeds):
+        closure = set(transitive_closure([s], path))
+        assert {x for x, m in masks.items() if m >> i & 1} == closure
+    assert set(masks) == set(transitive_closure(seeds, path))
+
+    for seed, closure in batched_closure(seeds, Vertex.parent):
+        assert sorted(closure, key=V.index) == sorted(transitive_closure([seed], Vertex.parent), key=V.index)
+    assert len(list(batched_closure(seeds, path))) == len(seeds)
+    assert list(batched_closure([], path)) == []
+
+
 def test_inherited_relationships():
     pass
     
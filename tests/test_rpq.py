@@ -0,0 +1,71 @@
+'''
+Test module for rpq
+
+@author: vsam
+'''
+
+import random
+import pytest
+from modeling.mf import *
+from modeling.rpq import parse, seq, alt, star, plus, opt, path_query, PathAutomaton
+
+
+def test_parse():
+    assert parse("a") == ('rel', 'a')
+    assert parse("a.b|c") == ('alt', ('seq', ('rel', 'a'), ('rel', 'b')), ('rel', 'c'))
+    assert parse("(a . b)+ | c*?") == ('alt', ('plus', ('seq', ('rel', 'a'), ('rel', 'b'))),
+                                       ('opt', ('star', ('rel', 'c'))))
+    for bad in ["", "a.", "(a", "a)", "a b", "a-b", "|a"]:
+        with pytest.raises(ValueError):
+            parse(bad)
+
+    assert len(PathAutomaton(parse("a.b"))) == 3
+    A = PathAutomaton(parse("a*"))
+    assert A.start <= A.accepting
+
+
+def test_path_query():
+
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs()
+        parent = ref()
+        children = refs(inv=parent)
+
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+
+    rng = random.Random(19)
+    V = [Vertex() for i in range(30)]
+    for i in range(40):
+        e = Edge()
+        e.source, e.destination = rng.choice(V), rng.choice(V)
+    for v in V[1:]:
+        v.parent = rng.choice(V[:V.index(v)])
+
+    forward = (Vertex.outgoing, Edge.destination)
+    for v in V[:5]:
+        closure = set(transitive_closure([v], forward))
+        assert set(path_query("(outgoing.destination)*")([v])) == closure
+        successors = {e.destination for x in closure for e in x.outgoing}
+        assert set(path_query("(outgoing.destination)+")([v])) == successors
+        assert set(path_query(plus(seq(Vertex.outgoing, Edge.destination)))([v])) == successors
+
+        # mixed directions and alternatives, in one traversal
+        expected = successors | {e.source for e in v.incoming}
+        assert set(path_query("(outgoing.destination)+ | incoming.source")([v])) == expected
+        assert set(path_query(alt(plus("outgoing.destination"), seq(Vertex.incoming, "source")))([v])) == expected
+
+        siblings = set(v.parent.children) if v.parent is not None else set()
+        assert set(path_query("parent.children")([v])) == siblings
+        assert set(path_query(seq(opt(Vertex.parent), "children"))([v])) == siblings | set(v.children)
+        assert set(path_query(star("parent"))([v])) == set(transitive_closure([v], Vertex.parent))
+
+    # results are unique, and relationships are followed only where they exist
+    result = list(path_query("(outgoing|destination)*")(V))
+    assert len(result) == len(set(result))
+    assert list(path_query("children")([Edge()])) == []
+    assert path_query("parent") is path_query("parent")
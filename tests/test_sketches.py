@@ -0,0 +1,71 @@
+'''
+Test module for sketches
+
+@author: vsam
+'''
+
+import random
+import pytest
+from modeling.mf import *
+
+np = pytest.importorskip("numpy")
+from modeling.sketches import ReachabilitySketch
+
+
+def test_reachability_sketch():
+
+    @model
+    class Vertex:
+        outgoing = refs()
+        incoming = refs()
+
+    @model
+    class Edge:
+        source = ref(inv=Vertex.outgoing)
+        destination = ref(inv=Vertex.incoming)
+
+    rng = random.Random(31)
+    V = [Vertex() for i in range(400)]
+    E = []
+    def connect(u, v):
+        e = Edge()
+        e.source, e.destination = u, v
+        E.append(e)
+    for i in range(500):
+        connect(rng.choice(V), rng.choice(V))
+
+    path = (Vertex.outgoing, Edge.destination)
+    sketch = ReachabilitySketch(path, V, precision=10)
+    error = 1.04 / 2**5
+
+    def check(sample):
+        for v in sample:
+            exact = len(set(transitive_closure([v], path)))
+            assert abs(sketch.count(v) - exact) <= 6*error*exact + 2
+
+    check(V)
+    assert sketch.stats['rebuilt'] == 1
+
+    # new links, and new vertices, are merged without rebuilding
+    for i in range(100):
+        if i % 4 == 0:
+            w = Vertex()
+            connect(w, rng.choice(V))
+            V.append(w)
+        else:
+            connect(rng.choice(V), rng.choice(V))
+    assert not sketch.stale and sketch.stats['merged'] > 0
+    check(V)
+    fresh = ReachabilitySketch(path, V, precision=10)
+    assert sketch.counts() == fresh.counts()
+    assert sketch.stats['rebuilt'] == 1
+
+    # removed links are applied by rebuilding
+    E.pop().destination = None
+    assert sketch.stale
+    check(rng.sample(V, 50))
+    assert sketch.stats['rebuilt'] == 2
+    sketch.close()
+
+    with pytest.raises(ValueError):
+        ReachabilitySketch(path, V, precision=20)